@@ -0,0 +1,101 @@
+"""Benchmark the size and parse time of request bodies per codec.
+
+Run from the presidio directory:
+
+    python -m scripts.benchmark_body_codec
+"""
+
+import argparse
+import gzip
+import io
+from typing import Any, List, Optional, Tuple
+
+from scripts.benchmark_json_codec import generate_document, measure
+from server import body_codec, json_codec
+from server.body_codec import CBOR, JSON, MSGPACK, BodyCodec
+
+
+def encode(data: Any, content_type: str, content_encoding: Optional[str]) -> bytes:
+    """Serialize and compress a request body like a client would."""
+
+    if content_type == MSGPACK:
+        body = body_codec.msgpack.packb(data, use_bin_type=True)
+    elif content_type == CBOR:
+        body = body_codec.cbor2.dumps(data)
+    else:
+        body = json_codec.dumps(data)
+
+    if content_encoding == "gzip":
+        return gzip.compress(body)
+    if content_encoding == "zstd":
+        return body_codec.zstandard.ZstdCompressor().compress(body)
+    return body
+
+
+def available_codecs() -> List[Tuple[str, Optional[str]]]:
+    """Return the content types and encodings whose modules are installed."""
+
+    content_types = [JSON]
+    if body_codec.msgpack is not None:
+        content_types.append(MSGPACK)
+    if body_codec.cbor2 is not None:
+        content_types.append(CBOR)
+
+    content_encodings: List[Optional[str]] = [None, "gzip"]
+    if body_codec.zstandard is not None:
+        content_encodings.append("zstd")
+
+    codecs = [
+        (content_type, content_encoding)
+        for content_type in content_types
+        for content_encoding in content_encodings
+    ]
+    return codecs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the request bodies of the supported content types "
+        "and encodings"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Numbers of leaf values of the payloads. Default: 100 1000 10000",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=0.5,
+        help="Approximate time spent per measurement. Default: 0.5",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    print(f"{'leaves':>8} {'codec':<28} {'bytes':>9} {'ratio':>7} {'parse':>11}")
+    for size in args.sizes:
+        request_obj = {
+            "json_to_analyze": generate_document(size, args.seed),
+            "derive_purpose": "benchmark",
+        }
+        json_size = len(encode(request_obj, JSON, None))
+
+        for content_type, content_encoding in available_codecs():
+            body = encode(request_obj, content_type, content_encoding)
+            codec = BodyCodec(content_type, content_encoding)
+            if codec.load(io.BytesIO(body)) != request_obj:
+                raise AssertionError(f"{content_type} decoded a different body")
+
+            def load() -> Any:
+                return codec.load(io.BytesIO(body))
+
+            repeat = max(1, int(args.seconds / max(measure(load, 10), 1e-7)))
+            name = content_type.split("/")[1] + (
+                f" + {content_encoding}" if content_encoding else ""
+            )
+            print(
+                f"{size:>8} {name:<28} {len(body):>9} "
+                f"{len(body) / json_size:>7.1%} {measure(load, repeat) * 1e6:>9.1f}us"
+            )
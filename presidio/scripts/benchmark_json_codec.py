@@ -0,0 +1,114 @@
+"""Benchmark parsing and serializing request bodies per payload size.
+
+Run from the presidio directory:
+
+    python -m scripts.benchmark_json_codec
+"""
+
+import argparse
+import json
+import random
+import string
+import time
+from typing import Any, Callable, Dict, List
+
+from server import json_codec
+
+
+def generate_document(leaves: int, seed: int) -> Dict[str, Any]:
+    """
+    Generate a `json_to_analyze` document of product reviews.
+    :param leaves: Approximate number of leaf values
+    :param seed: Seed of the random generator
+    :return: The document
+    """
+
+    rng = random.Random(seed)
+
+    def word() -> str:
+        return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+
+    reviews = [
+        {
+            "id": index,
+            "reviewer": f"{word().capitalize()} {word().capitalize()}",
+            "text": " ".join(word() for _ in range(rng.randint(5, 30))),
+            "rating": {"stars": rng.randint(1, 5), "color": "red"},
+            "verified": rng.random() < 0.5,
+        }
+        for index in range(max(1, leaves // 6))
+    ]
+    return {"id": rng.randint(0, 1000), "title": word(), "reviews": reviews}
+
+
+def measure(function: Callable[[], Any], repeat: int) -> float:
+    """Return the seconds per call of the function."""
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def stdlib_dumps(data: Any, sort_keys: bool) -> bytes:
+    """Serialize like the service did with the standard library."""
+
+    return json.dumps(
+        data, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the standard library JSON module with the codec of "
+        "the service"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="Numbers of leaf values of the payloads. Default: 10 100 1000 10000",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=0.5,
+        help="Approximate time spent per measurement. Default: 0.5",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    codec = "orjson" if json_codec.orjson is not None else "standard library"
+    print(f"Codec: {codec}")
+    print(
+        f"{'leaves':>8} {'bytes':>9} "
+        f"{'parse':>17} {'canonical dump':>17} {'response dump':>17}"
+    )
+
+    response = ["EMAIL_ADDRESS", "PERSON", "PHONE_NUMBER", "URL"]
+    for size in args.sizes:
+        body = json.dumps({"json_to_analyze": generate_document(size, args.seed)})
+        encoded = body.encode("utf-8")
+        document = json.loads(body)
+        if json_codec.loads(encoded) != document:
+            raise AssertionError("The codec parsed a different document")
+
+        timings: List[str] = []
+        for stdlib, fast in (
+            (lambda: json.loads(encoded), lambda: json_codec.loads(encoded)),
+            (
+                lambda: stdlib_dumps(document, sort_keys=True),
+                lambda: json_codec.dumps(document, sort_keys=True),
+            ),
+            (
+                lambda: stdlib_dumps(response, sort_keys=True),
+                lambda: json_codec.dumps(response, sort_keys=True),
+            ),
+        ):
+            repeat = max(1, int(args.seconds / max(measure(stdlib, 10), 1e-7)))
+            before = measure(stdlib, repeat)
+            after = measure(fast, repeat)
+            timings.append(f"{before * 1e6:7.1f}->{after * 1e6:7.1f}us")
+
+        print(f"{size:>8} {len(encoded):>9} " + " ".join(timings))
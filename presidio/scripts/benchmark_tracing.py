@@ -0,0 +1,127 @@
+"""Benchmark the throughput of /batchanalyze per share of traced requests.
+
+Run from the presidio directory:
+
+    python -m scripts.benchmark_tracing
+
+Every sample ratio is measured in a process of its own, since the tracer
+provider is global. The spans are encoded like the OTLP exporter does, but
+not sent anywhere.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from typing import Sequence
+
+from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+from scripts.benchmark_json_codec import generate_document
+
+
+class EncodingSpanExporter(SpanExporter):
+    """Exporter serializing the spans into OTLP protobuf, then dropping them."""
+
+    def __init__(self):
+        self.spans = 0
+        self.bytes = 0
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        """Encode the spans."""
+
+        self.spans += len(spans)
+        self.bytes += len(encode_spans(spans).SerializeToString())
+        return SpanExportResult.SUCCESS
+
+
+def run(sample_ratio: float, requests: int, leaves: int, seed: int) -> None:
+    """Serve the requests in this process, and print the results."""
+
+    from server.server import Server
+    from server.tracing import setup_tracing
+
+    exporter = EncodingSpanExporter()
+    provider = setup_tracing(sample_ratio, exporter=exporter)
+    # Without caches, every request is analyzed.
+    client = Server({"enable_cache": False}).app.test_client()
+
+    bodies = [
+        {"json_to_analyze": generate_document(leaves, seed + index)}
+        for index in range(requests)
+    ]
+    client.post("/batchanalyze", json=bodies[0])
+
+    start = time.perf_counter()
+    for body in bodies:
+        response = client.post("/batchanalyze", json=body)
+        if response.status_code != 200:
+            raise AssertionError(f"Request failed: {response.data!r}")
+    # Includes exporting the remaining spans.
+    provider.shutdown()
+    seconds = time.perf_counter() - start
+
+    print(
+        f"{sample_ratio:>7.0%} {requests / seconds:>10.1f} "
+        f"{exporter.spans:>8} {exporter.bytes:>10}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of /batchanalyze with tracing at "
+        "several sample ratios"
+    )
+    parser.add_argument(
+        "--ratios",
+        type=float,
+        nargs="+",
+        default=[0, 0.01, 1],
+        help="Shares of traced requests. Default: 0 0.01 1",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Number of requests per ratio. Default: 200",
+    )
+    parser.add_argument(
+        "--leaves",
+        type=int,
+        default=100,
+        help="Number of leaf values per request. Default: 100",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--ratio", type=float, help="Measure a single ratio in this process"
+    )
+    args = parser.parse_args()
+
+    if args.ratio is not None:
+        run(args.ratio, args.requests, args.leaves, args.seed)
+        sys.exit()
+
+    print(f"{'sampled':>7} {'requests/s':>10} {'spans':>8} {'bytes':>10}")
+    for ratio in args.ratios:
+        # The result is the last line, after the log of the server.
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "scripts.benchmark_tracing",
+                "--ratio",
+                str(ratio),
+                "--requests",
+                str(args.requests),
+                "--leaves",
+                str(args.leaves),
+                "--seed",
+                str(args.seed),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        print(result.stdout.splitlines()[-1])
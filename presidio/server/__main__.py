@@ -1,53 +1,211 @@
 """REST API server for analyzer."""
 
 import os
+from typing import Callable, Dict, TypeVar
 
-from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from waitress import serve
 
+from .prefork import PreforkServer, available_cpus
 from .server import Server
+from .tracing import setup_tracing
 
 DEFAULT_PORT = "3000"
+DEFAULT_CACHE_MAX_BYTES = str(64 * 1024 * 1024)
+DEFAULT_LEAF_CACHE_MAX_BYTES = str(32 * 1024 * 1024)
+DEFAULT_SUBTREE_CACHE_MAX_BYTES = str(16 * 1024 * 1024)
+DEFAULT_PERSISTENT_CACHE_MAX_BYTES = str(256 * 1024 * 1024)
+DEFAULT_WORKERS = "1"
+DEFAULT_MICRO_BATCH_SIZE = "32"
+DEFAULT_NLP_BATCH_SIZE = "64"
+DEFAULT_MIN_NUMBER_DIGITS = "4"
+DEFAULT_STREAM_BATCH_SIZE = "64"
+DEFAULT_MAX_CONCURRENCY = "32"
+DEFAULT_MAX_QUEUE_MS = "100"
+DEFAULT_REQUEST_BUDGET_MS = "0"
+DEFAULT_TRACE_SAMPLE_RATIO = "1"
+DEFAULT_MAX_BODY_BYTES = str(64 * 1024 * 1024)
+DEFAULT_MAX_REQUEST_BODY_BYTES = str(1024 * 1024 * 1024)
+CHANNEL_REQUEST_LOOKAHEAD = 4
+
+T = TypeVar("T")
+
+
+def parse_purposes(value: str, convert: Callable[[str], T]) -> Dict[str, T]:
+    """
+    Parse a setting per calling service, such as `billing=2,support=1`.
+    :param value: Comma separated `derive_purpose=value` pairs
+    :param convert: Converts a value
+    :return: The values by purpose
+    """
+
+    purposes = {}
+    for pair in value.split(","):
+        if pair.strip():
+            purpose, _, purpose_value = pair.rpartition("=")
+            purposes[purpose.strip()] = convert(purpose_value.strip())
+    return purposes
+
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", DEFAULT_PORT))
     enable_cache = (
         os.environ.get("PRESIDIO_ENABLE_CACHE") or "false"
     ).lower() != "false"
-
-    processor = BatchSpanProcessor(OTLPSpanExporter())
-
-    provider = TracerProvider(
-        resource=Resource.create(
-            {
-                SERVICE_NAME: "prose.presidio",
-            }
+    cache_max_bytes = int(
+        os.environ.get("PRESIDIO_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)
+    )
+    leaf_cache_max_bytes = int(
+        os.environ.get("PRESIDIO_LEAF_CACHE_MAX_BYTES", DEFAULT_LEAF_CACHE_MAX_BYTES)
+    )
+    subtree_cache_max_bytes = int(
+        os.environ.get(
+            "PRESIDIO_SUBTREE_CACHE_MAX_BYTES", DEFAULT_SUBTREE_CACHE_MAX_BYTES
         )
     )
-    provider.add_span_processor(processor)
+    cache_ttl_seconds = float(os.environ.get("PRESIDIO_CACHE_TTL_SECONDS") or 0)
+    cache_policy = (os.environ.get("PRESIDIO_CACHE_POLICY") or "tinylfu").lower()
+    cache_key_rules_file = os.environ.get("PRESIDIO_CACHE_KEY_RULES")
+    persistent_cache_path = os.environ.get("PRESIDIO_PERSISTENT_CACHE_PATH")
+    persistent_cache_max_bytes = int(
+        os.environ.get(
+            "PRESIDIO_PERSISTENT_CACHE_MAX_BYTES", DEFAULT_PERSISTENT_CACHE_MAX_BYTES
+        )
+    )
+    micro_batch_wait_ms = float(os.environ.get("PRESIDIO_MICRO_BATCH_WAIT_MS") or 0)
+    micro_batch_size = int(
+        os.environ.get("PRESIDIO_MICRO_BATCH_SIZE", DEFAULT_MICRO_BATCH_SIZE)
+    )
+    nlp_batch_size = int(
+        os.environ.get("PRESIDIO_NLP_BATCH_SIZE", DEFAULT_NLP_BATCH_SIZE)
+    )
+    entities = [
+        entity.strip()
+        for entity in (os.environ.get("PRESIDIO_ENTITIES") or "").split(",")
+        if entity.strip()
+    ]
+    lexical_prefilter = (
+        os.environ.get("PRESIDIO_LEXICAL_PREFILTER") or "true"
+    ).lower() != "false"
+    stream_batch_size = int(
+        os.environ.get("PRESIDIO_STREAM_BATCH_SIZE", DEFAULT_STREAM_BATCH_SIZE)
+    )
+    concurrency_limiter = (
+        os.environ.get("PRESIDIO_CONCURRENCY_LIMITER") or "true"
+    ).lower() != "false"
+    max_concurrency = int(
+        os.environ.get("PRESIDIO_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+    )
+    max_queue_ms = float(os.environ.get("PRESIDIO_MAX_QUEUE_MS", DEFAULT_MAX_QUEUE_MS))
+    request_budget_ms = float(
+        os.environ.get("PRESIDIO_REQUEST_BUDGET_MS", DEFAULT_REQUEST_BUDGET_MS)
+    )
+    purpose_weights = parse_purposes(
+        os.environ.get("PRESIDIO_PURPOSE_WEIGHTS") or "", float
+    )
+    purpose_concurrency = parse_purposes(
+        os.environ.get("PRESIDIO_PURPOSE_CONCURRENCY") or "", int
+    )
+    # Requests are queued by the limiter rather than by waitress, so that
+    # excess requests are shed right away. Every request in flight or queued
+    # needs a thread for that.
+    threads = int(
+        os.environ.get("PRESIDIO_THREADS")
+        or (2 * max_concurrency if concurrency_limiter else 4)
+    )
+    type_filter = (os.environ.get("PRESIDIO_TYPE_FILTER") or "true").lower() != "false"
+    min_number_digits = int(
+        os.environ.get("PRESIDIO_MIN_NUMBER_DIGITS", DEFAULT_MIN_NUMBER_DIGITS)
+    )
+    pattern_scanner = (
+        os.environ.get("PRESIDIO_PATTERN_SCANNER") or "false"
+    ).lower() != "false"
+    max_body_bytes = int(
+        os.environ.get("PRESIDIO_MAX_BODY_BYTES", DEFAULT_MAX_BODY_BYTES)
+    )
+    # Waitress reads the whole body of a request before the server gets it,
+    # streams included, and answers larger bodies with 413.
+    max_request_body_bytes = int(
+        os.environ.get(
+            "PRESIDIO_MAX_REQUEST_BODY_BYTES", DEFAULT_MAX_REQUEST_BODY_BYTES
+        )
+    )
+    trace_sample_ratio = float(
+        os.environ.get("PRESIDIO_TRACE_SAMPLE_RATIO", DEFAULT_TRACE_SAMPLE_RATIO)
+    )
+    workers = os.environ.get("PRESIDIO_WORKERS") or DEFAULT_WORKERS
+    workers = available_cpus() if workers == "auto" else int(workers)
 
-    trace.set_tracer_provider(provider)
+    # With several workers, the exporter thread is started in every worker
+    # after the fork. Until then, the instrumentation uses a proxy tracer.
+    if workers == 1:
+        setup_tracing(trace_sample_ratio)
 
     server = Server(
         {
             "enable_cache": enable_cache,
+            "cache_max_bytes": cache_max_bytes,
+            "leaf_cache_max_bytes": leaf_cache_max_bytes,
+            "subtree_cache_max_bytes": subtree_cache_max_bytes,
+            "cache_ttl_seconds": cache_ttl_seconds or None,
+            "cache_policy": cache_policy,
+            "cache_key_rules_file": cache_key_rules_file,
+            "persistent_cache_path": persistent_cache_path,
+            "persistent_cache_max_bytes": persistent_cache_max_bytes,
+            "micro_batch_wait_seconds": micro_batch_wait_ms / 1000,
+            "micro_batch_size": micro_batch_size,
+            "nlp_batch_size": nlp_batch_size,
+            "entities": entities,
+            "lexical_prefilter": lexical_prefilter,
+            "type_filter": type_filter,
+            "min_number_digits": min_number_digits,
+            "stream_batch_size": stream_batch_size,
+            "concurrency_limiter": concurrency_limiter,
+            "max_concurrency": max_concurrency,
+            "max_queue_seconds": max_queue_ms / 1000,
+            "purpose_weights": purpose_weights,
+            "purpose_concurrency": purpose_concurrency,
+            "request_budget_seconds": request_budget_ms / 1000 or None,
+            "workers": workers,
+            "pattern_scanner": pattern_scanner,
+            "max_body_bytes": max_body_bytes,
         }
     )
-    FlaskInstrumentor().instrument_app(
-        server.app,
-        excluded_urls="/health",
-    )
 
-    serve(
-        server.app,
-        host="0.0.0.0",
-        port=port,
-        connection_limit=10000,
-        backlog=2048,
-        asyncore_use_poll=True,
-    )
+    if workers == 1:
+        serve(
+            server.app,
+            host="0.0.0.0",
+            port=port,
+            connection_limit=10000,
+            backlog=2048,
+            asyncore_use_poll=True,
+            threads=threads,
+            # Keeps reading while a request is analyzed, to notice when its
+            # client disconnects.
+            channel_request_lookahead=CHANNEL_REQUEST_LOOKAHEAD,
+            max_request_body_size=max_request_body_bytes,
+        )
+    else:
+
+        def after_fork(worker_id: int) -> None:
+            setup_tracing(trace_sample_ratio)
+            server.metrics.select_worker(worker_id)
+
+        prefork_server = PreforkServer(
+            server.app,
+            workers=workers,
+            host="0.0.0.0",
+            port=port,
+            backlog=2048,
+            serve_options={
+                "connection_limit": 10000,
+                "asyncore_use_poll": True,
+                "threads": threads,
+                "channel_request_lookahead": CHANNEL_REQUEST_LOOKAHEAD,
+                "max_request_body_size": max_request_body_bytes,
+            },
+            after_fork=after_fork,
+            on_exit=server.metrics.retire_worker,
+        )
+        server.workers_health = prefork_server.health
+        prefork_server.run()
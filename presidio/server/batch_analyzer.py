@@ -0,0 +1,577 @@
+"""Batch analysis of JSON documents with memoization of leaves and subtrees."""
+
+import hashlib
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import (
+    AbstractSet,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from opentelemetry import trace
+from presidio_analyzer import AnalyzerEngine, DictAnalyzerResult, RecognizerResult
+from presidio_analyzer.batch_analyzer_engine import BatchAnalyzerEngine
+from presidio_analyzer.nlp_engine import NlpArtifacts
+
+from .cache import ResultCache
+from .deadline import Deadline
+from .helpers import digest_subtrees, iter_json
+from .metrics import RequestProfile
+from .prefilter import FULL, LexicalPrefilter, Route, TypeFilter
+from .tracing import epoch_ns, tracer
+
+
+def leaf_cache_key(key: str, text: str, language: str) -> bytes:
+    """
+    Compute the key under which the entity types of a leaf value are cached.
+    Whitespace of the value is normalized and the dictionary key is included,
+    since the analyzer uses it as context for the decision.
+    :param key: Dictionary key of the value
+    :param text: String representation of the value
+    :param language: Language of the value
+    :return: Fixed-size digest
+    """
+
+    normalized = " ".join(text.split())
+    return hashlib.blake2b(
+        f"{language}\x00{key}\x00{normalized}".encode("utf-8", "surrogatepass"),
+        digest_size=16,
+    ).digest()
+
+
+@dataclass
+class _Node:
+    """Leaf value or nested subtree of the analyzed data, awaiting analysis."""
+
+    path: Tuple[str, ...]
+    value: Any
+    # Set for leaf values.
+    text: Optional[str] = None
+    route: Route = FULL
+    leaf_key: Optional[bytes] = None
+    # Set for subtrees, whose cached entity types are `None` on a miss.
+    subtree_key: Optional[bytes] = None
+
+    @property
+    def key(self) -> str:
+        """Dictionary key of the value, the index of list items."""
+        return self.path[-1] if self.path else ""
+
+
+@dataclass
+class _AnalysisState:
+    """State of the analysis of a single dictionary, shared by its passes."""
+
+    language: str
+    keys_to_skip: Set[str] = field(default_factory=set)
+    # The analysis stops once the deadline expired, if any.
+    deadline: Optional[Deadline] = None
+    # Receives the seconds per stage and the number of leaf values, if any.
+    profile: Optional[RequestProfile] = None
+    # Seconds spent per stage of the analysis, and the end of the last time
+    # the analysis ran, before yielding a result or at its end.
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    active_until: float = 0.0
+    # Span of the analysis, parent of the spans of its batches, and the span
+    # of the recognizers over all batches, started with the first of them.
+    span: trace.Span = trace.INVALID_SPAN
+    recognizers_span: Optional[trace.Span] = None
+    recognized_values: int = 0
+    # Merkle digests of the nested dictionaries and lists by their id.
+    digests: Optional[Dict[int, bytes]] = None
+    # Results of the distinct (key, text) pairs of the leaves, and entity
+    # types of the subtrees by cache key, `None` for those that missed the
+    # cache and are yet to be analyzed.
+    leaves: Dict[
+        Tuple[str, str], Optional[Union[List[RecognizerResult], FrozenSet[str]]]
+    ] = field(default_factory=dict)
+    subtrees: Dict[bytes, Optional[FrozenSet[str]]] = field(default_factory=dict)
+    # Number of leaf values, and of those repeating an earlier (key, text) pair.
+    leaf_values: int = 0
+    duplicate_leaf_values: int = 0
+    # Nodes in document order, and the texts among them to run through the
+    # NLP pipeline in the next batch.
+    pending_nodes: List[_Node] = field(default_factory=list)
+    pending_texts: Dict[str, None] = field(default_factory=dict)
+    nlp_artifacts: Dict[str, NlpArtifacts] = field(default_factory=dict)
+    # Subtrees that missed the cache, innermost last, with the entity types
+    # found in them so far.
+    open_subtrees: List[Tuple[_Node, Set[str]]] = field(default_factory=list)
+
+
+class CachingBatchAnalyzerEngine(BatchAnalyzerEngine):
+    """
+    BatchAnalyzerEngine remembering the entity types detected in leaf values.
+
+    Values seen in an earlier request are not analyzed again, instead the
+    cached set of entity types is returned in place of the recognizer results.
+    The same holds for nested dictionaries: every dictionary is identified by
+    a Merkle digest of its content, so a sub-object shared with an earlier
+    request is answered with its cached set of entity types as a whole.
+
+    The data is traversed iteratively, straight from the parsed request and
+    without copying it, so memory is bounded by the depth of the data and the
+    batch size. The leaf values left to analyze are run through the NLP
+    pipeline together in batches, which are collected as the traversal goes.
+    So a consumer that stops iterating the results early, saves the
+    traversal and the NLP pipeline runs of the remaining values as well.
+
+    Leaf values repeated within the data under the same key are analyzed once
+    and share the results of their first occurrence.
+
+    With a deadline, the analysis checks it before every NLP batch and every
+    leaf value analyzed, and stops once it expired, returning the results so
+    far. Subtrees left incomplete are not cached.
+
+    The time spent per stage is measured for every analysis: digesting the
+    subtrees, cache lookups, the NLP pipeline, the recognizers, the consumer
+    of the results, and the traversal in between. When the request is traced,
+    the analysis has a span with these times and the number of leaf values,
+    with a span for the NLP pipeline of every batch, and one for the
+    recognizers from the first batch to the last.
+
+    With a prefilter, every leaf value is only analyzed by the recognizers
+    and the NER model that could find something in it. A type filter drops
+    booleans and short numbers before that.
+
+    :param analyzer_engine: AnalyzerEngine instance to use for handling
+    the leaf values
+    :param leaf_cache: Cache for the entity types of leaf values, `None`
+    disables memoization of leaves
+    :param subtree_cache: Cache for the entity types of nested dictionaries,
+    `None` disables memoization of subtrees
+    :param batch_size: Number of leaf values run through the NLP pipeline at
+    once, `None` runs all values of the data in a single batch
+    :param prefilter: Routes leaf values to the recognizers that could match,
+    `None` analyzes every value with all recognizers
+    :param type_filter: Drops leaf values that cannot carry any entity by
+    their type, `None` analyzes values of all types
+    """
+
+    def __init__(
+        self,
+        analyzer_engine: Optional[AnalyzerEngine] = None,
+        leaf_cache: Optional[ResultCache] = None,
+        subtree_cache: Optional[ResultCache] = None,
+        batch_size: Optional[int] = None,
+        prefilter: Optional[LexicalPrefilter] = None,
+        type_filter: Optional[TypeFilter] = None,
+    ):
+        super().__init__(analyzer_engine=analyzer_engine)
+        self.leaf_cache = leaf_cache
+        self.subtree_cache = subtree_cache
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+        self.type_filter = type_filter
+        self._supported_entities: Dict[str, List[str]] = {}
+        # Leaves share the few distinct combinations of entity types.
+        self._interned: Dict[FrozenSet[str], FrozenSet[str]] = {}
+
+        self.analyses = 0
+        self.leaf_values = 0
+        self.duplicate_leaf_values = 0
+        self.duplicate_ratio_sum = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the number of analyzed documents and leaf values, and the share
+        of leaf values repeating an earlier one of the same document.
+        """
+
+        return {
+            "analyses": self.analyses,
+            "leaf_values": self.leaf_values,
+            "duplicate_leaf_values": self.duplicate_leaf_values,
+            "duplicate_ratio": (
+                self.duplicate_leaf_values / self.leaf_values if self.leaf_values else 0
+            ),
+            "average_duplicate_ratio": (
+                self.duplicate_ratio_sum / self.analyses if self.analyses else 0
+            ),
+        }
+
+    def analyze_dict(
+        self,
+        input_dict: Union[Dict[str, Any], List[Any]],
+        language: str,
+        keys_to_skip: Optional[List[str]] = None,
+        deadline: Optional[Deadline] = None,
+        profile: Optional[RequestProfile] = None,
+        **kwargs,
+    ) -> Iterator[DictAnalyzerResult]:
+        """
+        Analyze the leaf values of parsed JSON.
+
+        Unlike `BatchAnalyzerEngine.analyze_dict`, the nested dictionaries and
+        lists are flattened: a result is returned for every leaf value, keyed
+        by its dot-separated path, with list indexes as keys. The dictionary
+        key of the value is the context of its analysis. Whenever a leaf cache
+        is configured, the recognizer results are replaced by the set of
+        detected entity types. With a subtree cache, nested dictionaries and
+        lists found in the cache are returned as a whole, with their set of
+        entity types.
+
+        :param input_dict: The input dictionary or list for analysis
+        :param language: Input language
+        :param keys_to_skip: Dot-separated paths of the keys to ignore during
+        analysis
+        :param deadline: Stops the analysis once expired, `None` for none
+        :param profile: Receives the seconds per stage and the number of leaf
+        values, once the analysis ends
+        :param kwargs: Additional keyword arguments
+        for the `AnalyzerEngine.analyze` method.
+        """
+
+        # The context of a value is its own key.
+        kwargs.pop("context", None)
+
+        state = _AnalysisState(
+            language=language,
+            keys_to_skip=set(keys_to_skip or ()),
+            deadline=deadline,
+            profile=profile,
+        )
+        if self.subtree_cache is not None and not keys_to_skip:
+            state.digests = {}
+
+        return self._analyze(input_dict, state, **kwargs)
+
+    def analyze_dicts(
+        self,
+        input_dicts: List[Any],
+        language: str,
+        **kwargs,
+    ) -> Iterator[Tuple[int, DictAnalyzerResult]]:
+        """
+        Analyze the leaf values of several JSON documents in one traversal.
+
+        The documents share the NLP batches and the repeated leaf values, and
+        each of them is a subtree of its own for the subtree cache. The
+        results follow `analyze_dict`, with paths relative to their document.
+
+        :param input_dicts: The input dictionaries or lists for analysis
+        :param language: Input language
+        :param kwargs: Additional keyword arguments
+        for the `AnalyzerEngine.analyze` method.
+        :return: Position of the document in `input_dicts` and result
+        """
+
+        for result in self.analyze_dict(input_dicts, language, **kwargs):
+            position, _, key = result.key.partition(".")
+            yield (
+                int(position),
+                DictAnalyzerResult(
+                    key=key,
+                    value=result.value,
+                    recognizer_results=result.recognizer_results,
+                ),
+            )
+
+    def _analyze(
+        self, data: Any, state: _AnalysisState, **kwargs
+    ) -> Iterator[DictAnalyzerResult]:
+        start = state.active_until = time.perf_counter()
+        state.span = tracer.start_span("presidio.analyze")
+        try:
+            if state.digests is not None:
+                digest_subtrees(data, state.digests)
+                self._add_seconds(state, "digest", start)
+
+            for path, value in iter_json(
+                data, descend=partial(self._descend, state=state)
+            ):
+                if not isinstance(value, (dict, list)):
+                    self._add_leaf(path, value, state)
+
+                # Values that need no NLP pipeline run are analyzed right away.
+                if not state.pending_texts or (
+                    self.batch_size is not None
+                    and len(state.pending_texts) >= self.batch_size
+                ):
+                    yield from self._analyze_pending(state, **kwargs)
+                    if state.deadline is not None and state.deadline.exceeded:
+                        return
+
+            yield from self._analyze_pending(state, **kwargs)
+            if state.deadline is None or not state.deadline.exceeded:
+                self._close_subtrees(0, state)
+            state.active_until = time.perf_counter()
+        finally:
+            # Counts the values reached, also when the consumer stopped early.
+            self._record_duplicates(state)
+            self._record_stages(state, start)
+
+    def _record_duplicates(self, state: _AnalysisState) -> None:
+        self.analyses += 1
+        self.leaf_values += state.leaf_values
+        self.duplicate_leaf_values += state.duplicate_leaf_values
+        if state.leaf_values:
+            self.duplicate_ratio_sum += state.duplicate_leaf_values / state.leaf_values
+
+    def _record_stages(self, state: _AnalysisState, start: float) -> None:
+        # What the other stages leave of the time until the last result, is
+        # the traversal of the data.
+        stage_seconds = state.stage_seconds
+        stage_seconds["flatten"] = max(
+            0.0, state.active_until - start - sum(stage_seconds.values())
+        )
+
+        if state.span.is_recording():
+            state.span.set_attributes(
+                {
+                    "presidio.leaves": state.leaf_values,
+                    "presidio.duplicate_leaves": state.duplicate_leaf_values,
+                    "presidio.partial": state.deadline is not None
+                    and state.deadline.exceeded,
+                    **{
+                        f"presidio.{stage}_seconds": seconds
+                        for stage, seconds in stage_seconds.items()
+                    },
+                }
+            )
+        # Ends with the last result, not when the consumer drops the results.
+        end_time = epoch_ns(state.active_until)
+        if state.recognizers_span is not None:
+            state.recognizers_span.set_attribute(
+                "presidio.values", state.recognized_values
+            )
+            state.recognizers_span.end(end_time=end_time)
+        state.span.end(end_time=end_time)
+
+        if state.profile is not None:
+            for stage, seconds in stage_seconds.items():
+                state.profile.add(stage, seconds)
+            state.profile.leaves += state.leaf_values
+
+    @staticmethod
+    def _add_seconds(state: _AnalysisState, stage: str, start: float) -> None:
+        state.stage_seconds[stage] = (
+            state.stage_seconds.get(stage, 0.0) + time.perf_counter() - start
+        )
+
+    def _descend(
+        self, path: Tuple[str, ...], value: Any, state: _AnalysisState
+    ) -> bool:
+        # Containers that are not descended into are yielded as leaves and
+        # ignored there.
+        if not value or ".".join(path) in state.keys_to_skip:
+            return False
+        if state.digests is None:
+            return True
+
+        cache_key = state.language.encode() + state.digests[id(value)]
+        if cache_key not in state.subtrees:
+            start = time.perf_counter()
+            state.subtrees[cache_key] = self.subtree_cache.get(cache_key)
+            self._add_seconds(state, "cache", start)
+        state.pending_nodes.append(_Node(path=path, value=value, subtree_key=cache_key))
+        return state.subtrees[cache_key] is None
+
+    def _add_leaf(
+        self, path: Tuple[str, ...], value: Any, state: _AnalysisState
+    ) -> None:
+        if not value or ".".join(path) in state.keys_to_skip:
+            return
+        if type(value) not in (str, int, bool, float):
+            raise ValueError(f"type {type(value)} is unsupported.")
+        if self.type_filter is not None and not self.type_filter.accepts(value):
+            return
+
+        node = _Node(path=path, value=value, text=str(value))
+        state.pending_nodes.append(node)
+        state.leaf_values += 1
+
+        # Repeated values are answered by the analysis of their first
+        # occurrence, which precedes them.
+        if (node.key, node.text) in state.leaves:
+            state.duplicate_leaf_values += 1
+            return
+
+        state.leaves[node.key, node.text] = None
+        if self.prefilter is not None:
+            node.route = self.prefilter.route(node.text)
+
+        if self.leaf_cache is not None:
+            start = time.perf_counter()
+            node.leaf_key = leaf_cache_key(node.key, node.text, state.language)
+            state.leaves[node.key, node.text] = self.leaf_cache.get(node.leaf_key)
+            self._add_seconds(state, "cache", start)
+            if state.leaves[node.key, node.text] is not None:
+                return
+
+        if node.route.run_ner:
+            state.pending_texts[node.text] = None
+
+    def _analyze_pending(
+        self, state: _AnalysisState, **kwargs
+    ) -> Iterator[DictAnalyzerResult]:
+        if state.deadline is not None and state.deadline.expired():
+            return
+
+        state.nlp_artifacts = {}
+        if state.pending_texts:
+            start = time.perf_counter()
+            texts = list(state.pending_texts)
+            with tracer.start_as_current_span(
+                "presidio.nlp",
+                context=trace.set_span_in_context(state.span),
+                attributes={"presidio.texts": len(texts)},
+            ):
+                nlp_artifacts_batch = self.analyzer_engine.nlp_engine.process_batch(
+                    texts=texts, language=state.language
+                )
+                for text, (_, nlp_artifacts) in zip(texts, nlp_artifacts_batch):
+                    state.nlp_artifacts[text] = nlp_artifacts
+            self._add_seconds(state, "nlp", start)
+
+        nodes = state.pending_nodes
+        state.pending_nodes = []
+        state.pending_texts = {}
+
+        if not nodes:
+            return
+
+        # A single span for all batches, since values that need no NLP
+        # pipeline run are flushed one at a time. Not the current span, as the
+        # results are yielded while it is open.
+        if state.recognizers_span is None:
+            state.recognizers_span = tracer.start_span(
+                "presidio.recognizers", context=trace.set_span_in_context(state.span)
+            )
+        state.recognized_values += len(nodes)
+        yield from self._analyze_nodes(nodes, state, **kwargs)
+        state.active_until = time.perf_counter()
+
+    def _analyze_nodes(
+        self, nodes: List[_Node], state: _AnalysisState, **kwargs
+    ) -> Iterator[DictAnalyzerResult]:
+        for node in nodes:
+            self._close_subtrees(len(node.path), state)
+            if (
+                node.text is not None
+                and state.deadline is not None
+                and state.deadline.expired()
+            ):
+                return
+
+            if node.subtree_key is not None:
+                results = state.subtrees[node.subtree_key]
+                if results is None:
+                    state.open_subtrees.append((node, set()))
+                    continue
+            else:
+                results = self._analyze_leaf(node, state, **kwargs)
+
+            if state.open_subtrees:
+                state.open_subtrees[-1][1].update(
+                    results
+                    if isinstance(results, AbstractSet)
+                    else (result.entity_type for result in results)
+                )
+
+            # The time until the consumer asks for the next result is spent
+            # extracting what it needs from this one.
+            state.active_until = time.perf_counter()
+            yield DictAnalyzerResult(
+                key=".".join(node.path), value=node.value, recognizer_results=results
+            )
+            self._add_seconds(state, "extract", state.active_until)
+
+    def _close_subtrees(self, depth: int, state: _AnalysisState) -> None:
+        # Subtrees end where a value at their own depth or above follows.
+        while state.open_subtrees and len(state.open_subtrees[-1][0].path) >= depth:
+            node, found = state.open_subtrees.pop()
+            entity_types = self._intern(frozenset(found))
+            self.subtree_cache.set(
+                node.subtree_key,
+                entity_types,
+                size=sum(len(entity_type) for entity_type in entity_types),
+            )
+            state.subtrees[node.subtree_key] = entity_types
+            if state.open_subtrees:
+                state.open_subtrees[-1][1].update(entity_types)
+
+    def _analyze_leaf(
+        self, node: _Node, state: _AnalysisState, **kwargs
+    ) -> Union[List[RecognizerResult], FrozenSet[str]]:
+        results = state.leaves.get((node.key, node.text))
+        if results is not None:
+            return results
+
+        results = self._run_analyzer(node, state, **kwargs)
+        if self.leaf_cache is not None:
+            results = self._intern(frozenset(result.entity_type for result in results))
+            self.leaf_cache.set(
+                node.leaf_key,
+                results,
+                size=sum(len(entity_type) for entity_type in results),
+            )
+        state.leaves[node.key, node.text] = results
+
+        return results
+
+    def _run_analyzer(
+        self, node: _Node, state: _AnalysisState, **kwargs
+    ) -> List[RecognizerResult]:
+        text = node.text
+        language = state.language
+        route = node.route
+        if self.prefilter is not None:
+            self.prefilter.record(route)
+
+        if not route.analyze:
+            return []
+
+        if route.excluded_entities:
+            kwargs["entities"] = [
+                entity
+                for entity in kwargs.get("entities")
+                or self._get_supported_entities(language)
+                if entity not in route.excluded_entities
+            ]
+            # No entities at all would make the analyzer look for all of them.
+            if not kwargs["entities"]:
+                return []
+
+        if route.run_ner:
+            nlp_artifacts = state.nlp_artifacts.get(text)
+        else:
+            # Without tokens, the context enhancement only uses the key.
+            nlp_artifacts = NlpArtifacts(
+                entities=[],
+                tokens=[],
+                tokens_indices=[],
+                lemmas=[],
+                nlp_engine=None,
+                language=language,
+            )
+
+        start = time.perf_counter()
+        results = self.analyzer_engine.analyze(
+            text=text,
+            language=language,
+            context=[node.key],
+            nlp_artifacts=nlp_artifacts,
+            **kwargs,
+        )
+        self._add_seconds(state, "recognizers", start)
+        return results
+
+    def _get_supported_entities(self, language: str) -> List[str]:
+        if language not in self._supported_entities:
+            self._supported_entities[language] = (
+                self.analyzer_engine.get_supported_entities(language)
+            )
+        return self._supported_entities[language]
+
+    def _intern(self, entity_types: FrozenSet[str]) -> FrozenSet[str]:
+        return self._interned.setdefault(entity_types, entity_types)
@@ -0,0 +1,304 @@
+"""Compressed and binary request and response bodies."""
+
+import gzip
+import io
+import zlib
+from contextlib import contextmanager
+from typing import IO, Any, Dict, Iterator, Optional, Tuple, Type
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+from . import json_codec
+from .helpers import iter_json
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is in the Pipfile, its bodies are unsupported without it
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    # msgpack is in the Pipfile, its bodies are unsupported without it
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    # cbor2 is in the Pipfile, its bodies are unsupported without it
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# Accepted content types by their mimetype, with the older MessagePack ones.
+CONTENT_TYPES: Dict[str, str] = {
+    JSON: JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    CBOR: CBOR,
+}
+CONTENT_ENCODINGS = ("identity", "gzip", "zstd")
+
+# Raised by a corrupt or truncated compressed body, `BadGzipFile` is an
+# `OSError`.
+DECOMPRESSION_ERRORS: Tuple[Type[Exception], ...] = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# Raised by a body that cannot be parsed, the errors of MessagePack and JSON
+# are `ValueError`s.
+PARSE_ERRORS: Tuple[Type[Exception], ...] = (ValueError, TypeError)
+if cbor2 is not None:
+    PARSE_ERRORS += (cbor2.CBORError,)
+
+# Types of the values of parsed JSON. MessagePack and CBOR have binary strings
+# and tagged values besides.
+JSON_SCALARS = (str, int, float, bool, type(None))
+
+# Bytes read from the request stream at a time.
+READ_SIZE = 64 * 1024
+
+
+class BodyCodec:
+    """
+    Decodes a request body by its `Content-Type` and `Content-Encoding`, and
+    encodes the response the same way.
+
+    The body is decompressed while it is read from the request stream, so the
+    compressed body is never held in memory as a whole. The decompressed bytes
+    are parsed at once, which is faster than parsing from the stream. Reading
+    stops with 413 Request Entity Too Large once they exceed `max_bytes`, so a
+    small compressed body cannot expand without bounds.
+
+    :param content_type: Mimetype of the body, JSON when empty
+    :param content_encoding: Compression of the body, none when empty
+    :param max_bytes: Largest decompressed body, or line of a streamed body,
+    `None` for no limit
+    """
+
+    def __init__(
+        self,
+        content_type: Optional[str],
+        content_encoding: Optional[str],
+        max_bytes: Optional[int] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.content_type = CONTENT_TYPES.get(content_type or JSON)
+        if self.content_type is None:
+            raise UnsupportedMediaType(
+                f"Unsupported Content-Type '{content_type}', expected one of "
+                f"{sorted(CONTENT_TYPES)}"
+            )
+
+        self.content_encoding = (content_encoding or "identity").strip().lower()
+        if self.content_encoding not in CONTENT_ENCODINGS:
+            raise UnsupportedMediaType(
+                f"Unsupported Content-Encoding '{content_encoding}', expected one "
+                f"of {list(CONTENT_ENCODINGS)}"
+            )
+
+        for name, required, module in (
+            ("zstandard", self.content_encoding == "zstd", zstandard),
+            ("msgpack", self.content_type == MSGPACK, msgpack),
+            ("cbor2", self.content_type == CBOR, cbor2),
+        ):
+            if required and module is None:
+                raise UnsupportedMediaType(f"{name} is not installed")
+
+    @property
+    def is_plain_json(self) -> bool:
+        """Whether the body is uncompressed JSON."""
+        return self.content_type == JSON and self.content_encoding == "identity"
+
+    def decompress(self, stream: IO[bytes]) -> IO[bytes]:
+        """Wrap the request stream in a stream of the decompressed body."""
+
+        if self.content_encoding == "gzip":
+            return gzip.GzipFile(fileobj=stream, mode="rb")
+        if self.content_encoding == "zstd":
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream))
+        return stream
+
+    def read(self, stream: IO[bytes]) -> bytes:
+        """
+        Read and decompress a request body.
+        :param stream: Request stream
+        :return: Decompressed body, 413 if it exceeds `max_bytes`, 400 if it
+        cannot be decompressed
+        """
+
+        body = self.decompress(stream)
+        if self.max_bytes is None:
+            with self._decompressing():
+                return body.read()
+
+        chunks = []
+        size = 0
+        while True:
+            with self._decompressing():
+                chunk = body.read(min(READ_SIZE, self.max_bytes + 1 - size))
+            if not chunk:
+                return b"".join(chunks)
+
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise RequestEntityTooLarge(
+                    f"The decompressed body exceeds {self.max_bytes} bytes"
+                )
+            chunks.append(chunk)
+
+    def lines(self, stream: IO[bytes]) -> Iterator[bytes]:
+        """
+        Read and decompress the lines of a request body, one at a time.
+        :param stream: Request stream
+        :return: Iterator of the lines, 413 once one exceeds `max_bytes`, 400
+        once the body cannot be decompressed
+        """
+
+        body = self.decompress(stream)
+        while True:
+            with self._decompressing():
+                if self.max_bytes is None:
+                    line = body.readline()
+                else:
+                    # Up to the limit, and the newline ending a line of that size.
+                    line = body.readline(self.max_bytes + 1)
+            if self.max_bytes is not None and (
+                len(line) > self.max_bytes and not line.endswith(b"\n")
+            ):
+                raise RequestEntityTooLarge(
+                    f"A decompressed line exceeds {self.max_bytes} bytes"
+                )
+            if not line:
+                return
+            yield line
+
+    @contextmanager
+    def _decompressing(self) -> Iterator[None]:
+        """Answer a body that cannot be decompressed with 400 Bad Request."""
+
+        try:
+            yield
+        except DECOMPRESSION_ERRORS as e:
+            raise BadRequest(f"Invalid {self.content_encoding} body. {e}") from e
+
+    def load(self, stream: IO[bytes]) -> Any:
+        """
+        Decode a request body.
+        :param stream: Request stream
+        :return: Parsed body, 400 if it cannot be parsed or has values JSON
+        does not have
+        """
+
+        body = self.read(stream)
+        try:
+            if self.content_type == MSGPACK:
+                document = msgpack.unpackb(body, raw=False)
+            elif self.content_type == CBOR:
+                document = cbor2.loads(body)
+            else:
+                return json_codec.loads(body)
+        except PARSE_ERRORS as e:
+            raise BadRequest(f"Invalid {self.content_type} body. {e}") from e
+
+        _check_json_types(document)
+        return document
+
+    def dump(self, json_body: bytes) -> bytes:
+        """
+        Encode a response body like the request body.
+        :param json_body: Response body serialized as JSON
+        :return: Response body in the content type and encoding of the request
+        """
+
+        if self.content_type == JSON:
+            body = json_body
+        else:
+            data = json_codec.loads(json_body)
+            if self.content_type == MSGPACK:
+                body = msgpack.packb(data, use_bin_type=True)
+            else:
+                body = cbor2.dumps(data)
+
+        if self.content_encoding == "gzip":
+            return gzip.compress(body)
+        if self.content_encoding == "zstd":
+            # Unlike a streamed body, the frame records the size of the content.
+            return zstandard.ZstdCompressor().compress(body)
+        return body
+
+    def compressor(self) -> "StreamCompressor":
+        """Return a compressor of a streamed response body."""
+        return StreamCompressor(self.content_encoding)
+
+    def headers(self) -> Dict[str, str]:
+        """Return the `Content-Encoding` header of the response, if any."""
+
+        if self.content_encoding == "identity":
+            return {}
+        return {"Content-Encoding": self.content_encoding}
+
+
+def _check_json_types(document: Any) -> None:
+    """
+    Answer a decoded document with values JSON does not have, such as binary
+    strings, tagged values or keys other than strings, with 400 Bad Request.
+    """
+
+    def check_keys(path: Tuple[str, ...], container: Any) -> bool:
+        if isinstance(container, dict):
+            for key in container:
+                if not isinstance(key, str):
+                    raise BadRequest(
+                        f"Unsupported {type(key).__name__} key in "
+                        f"'{'.'.join(path)}', keys must be strings"
+                    )
+        return True
+
+    check_keys((), document)
+    for path, value in iter_json(document, descend=check_keys):
+        if type(value) not in JSON_SCALARS:
+            raise BadRequest(
+                f"Unsupported {type(value).__name__} value at '{'.'.join(path)}'"
+            )
+
+
+class StreamCompressor:
+    """
+    Compresses a response body sent in parts. Every part is flushed, so the
+    client can decompress it as soon as it arrives.
+
+    :param content_encoding: Compression of the body
+    """
+
+    def __init__(self, content_encoding: str):
+        self.content_encoding = content_encoding
+        self._compressor: Any = None
+        if content_encoding == "gzip":
+            self._compressor = zlib.compressobj(wbits=31)
+        elif content_encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress and flush a part of the body."""
+
+        if self._compressor is None:
+            return data
+        if self.content_encoding == "gzip":
+            return self._compressor.compress(data) + self._compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self) -> bytes:
+        """Return the end of the compressed body."""
+
+        if self._compressor is None:
+            return b""
+        return self._compressor.flush()
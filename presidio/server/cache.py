@@ -0,0 +1,214 @@
+"""Bounded in-memory cache for analysis results."""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# Rough number of bytes that every cache entry costs on top of its key and
+# value (dict slot, tuple and bookkeeping fields).
+ENTRY_OVERHEAD_BYTES = 96
+
+CACHE_POLICIES = ("lru", "tinylfu")
+
+
+def _sizeof_key(key: Hashable) -> int:
+    if isinstance(key, (bytes, str)):
+        return len(key)
+    return 0
+
+
+class FrequencySketch:
+    """
+    Count-min sketch estimating how often a key was accessed recently.
+    Counters saturate at 15 and are halved periodically, so the estimates
+    age and the sketch follows changes in the popularity of keys.
+    :param width: Number of counters in each row of the sketch
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int):
+        self.width = width
+        self.rows: List[List[int]] = [[0] * width for _ in range(self.DEPTH)]
+        self.additions = 0
+        self.sample_size = 10 * width
+
+    def _indexes(self, key: Hashable) -> List[int]:
+        return [hash((seed, key)) % self.width for seed in range(self.DEPTH)]
+
+    def increment(self, key: Hashable) -> None:
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def _age(self) -> None:
+        for row in self.rows:
+            for index, count in enumerate(row):
+                row[index] = count >> 1
+        self.additions //= 2
+
+
+class ResultCache:
+    """
+    Thread-safe cache bounded by the total number of bytes of its entries.
+    Entries are evicted in least recently used order. With the `tinylfu`
+    policy a new entry is only admitted when it was requested at least as
+    often as the entry it would evict, which keeps one-off requests from
+    flushing popular results out of the cache.
+    :param max_bytes: Upper bound for the size of all keys and values
+    :param ttl_seconds: Default time to live of an entry, `None` for no expiry
+    :param policy: Eviction policy, either `lru` or `tinylfu`
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl_seconds: Optional[float] = None,
+        policy: str = "tinylfu",
+    ):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(
+                f"Unknown cache policy '{policy}', expected one of {CACHE_POLICIES}"
+            )
+
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.policy = policy
+        self.sketch = (
+            FrequencySketch(width=min(max(max_bytes // 1024, 1024), 1 << 20))
+            if policy == "tinylfu"
+            else None
+        )
+
+        # key -> (value, size in bytes, expiry timestamp or None)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, Optional[float]]]"
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the cached value for `key` or `None` when it is missing or
+        expired.
+        """
+
+        with self._lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key, size)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl_seconds: Optional[float] = None,
+        size: Optional[int] = None,
+        expires_at: Optional[float] = None,
+    ) -> bool:
+        """
+        Store `value` under `key`.
+        :param key: Cache key
+        :param value: Value to store, usually serialized bytes
+        :param ttl_seconds: Time to live overriding the default of the cache
+        :param size: Size of the value in bytes, defaults to `len(value)`
+        :param expires_at: Expiry timestamp overriding any time to live, e.g.
+        of an entry stored before
+        :return: Whether the value was admitted into the cache
+        """
+
+        size = (
+            (len(value) if size is None else size)
+            + _sizeof_key(key)
+            + ENTRY_OVERHEAD_BYTES
+        )
+        if size > self.max_bytes:
+            return False
+
+        if expires_at is None:
+            ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+            expires_at = time.time() + ttl_seconds if ttl_seconds else None
+
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._remove(key, previous[1])
+            elif not self._admit(key, size):
+                self.rejections += 1
+                return False
+
+            self._evict(self.max_bytes - size)
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            self.sets += 1
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters describing the state and efficiency of the cache."""
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "sets": self.sets,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejections": self.rejections,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _admit(self, key: Hashable, size: int) -> bool:
+        if self.sketch is None or self._bytes + size <= self.max_bytes:
+            return True
+
+        victim = next(iter(self._entries))
+        return self.sketch.estimate(key) >= self.sketch.estimate(victim)
+
+    def _evict(self, budget: int) -> None:
+        now = time.time()
+        while self._bytes > budget and self._entries:
+            key, (_, size, expires_at) = self._entries.popitem(last=False)
+            self._bytes -= size
+            if expires_at is not None and expires_at <= now:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def _remove(self, key: Hashable, size: int) -> None:
+        del self._entries[key]
+        self._bytes -= size
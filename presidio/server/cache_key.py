@@ -0,0 +1,343 @@
+"""Cache keys for the analysis of JSON documents."""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+import yaml
+
+from . import json_codec
+from .helpers import _items
+
+DIGEST_SIZE = 16
+
+# Actions a rule can apply to the fields it matches, as a whole, without
+# applying any rule within them:
+# - `drop` removes the field from the analysis and from the cache key,
+# - `exclude` removes the field from the cache key only. Elements of a list
+#   after an excluded one move up, so the key equals that of the list without
+#   it,
+# - `placeholder` replaces the value by a marker of its Python type in the
+#   cache key only, see `_PLACEHOLDERS`. Integers and floats have different
+#   markers, and a string equal to a marker gives the same key as the marker.
+RULE_ACTIONS = ("drop", "exclude", "placeholder")
+
+# Number of counterfactual keys remembered per rule to tell whether a cache
+# hit would also have happened without the rule.
+SEEN_KEYS_PER_RULE = 65536
+
+_PLACEHOLDERS = {
+    str: "<string>",
+    int: "<integer>",
+    float: "<number>",
+    bool: "<boolean>",
+    type(None): "<null>",
+    dict: "<object>",
+    list: "<array>",
+}
+
+
+def canonical_digest(data: Any) -> bytes:
+    """
+    Hash the canonical serialization of a JSON document. Object keys are
+    sorted, so documents that only differ in the order of their keys share
+    the digest.
+    :param data: JSON document
+    :return: Fixed-size digest of the document
+    """
+
+    return hashlib.blake2b(
+        json_codec.dumps(data, sort_keys=True), digest_size=DIGEST_SIZE
+    ).digest()
+
+
+@dataclass
+class KeyRule:
+    """
+    Normalization rule for fields of `json_to_analyze`.
+
+    :param name: Name of the rule reported in the counters
+    :param paths: Dotted paths of the matched fields. Every segment is a glob
+    matched against object keys and list indexes, `**` matches any number of
+    segments, e.g. `podname`, `reviews.*.timestamp` or `**.request_id`.
+    :param action: One of `RULE_ACTIONS`
+    """
+
+    name: str
+    paths: List[str]
+    action: str
+    segments: List[List[str]] = field(init=False)
+
+    def __post_init__(self):
+        if self.action not in RULE_ACTIONS:
+            raise ValueError(
+                f"Unknown action '{self.action}' of cache key rule '{self.name}', "
+                f"expected one of {RULE_ACTIONS}"
+            )
+        if not self.paths or not all(self.paths):
+            raise ValueError(f"Cache key rule '{self.name}' needs non-empty paths")
+
+        self.segments = [path.split(".") for path in self.paths]
+
+
+@dataclass
+class NormalizedDocument:
+    """
+    Result of applying the cache key rules to a document.
+
+    :param original: Document as received
+    :param document: Document to analyze
+    :param key_document: Document to derive the cache key from
+    :param matched_fields: Paths and values of the fields matched by every
+    rule that matched at least one field, by the index of the rule
+    """
+
+    original: Any
+    document: Any
+    key_document: Any
+    matched_fields: Dict[int, List[Tuple[Tuple[Any, ...], Any]]]
+
+    @property
+    def applied_rules(self) -> FrozenSet[int]:
+        """Indexes of the rules that matched at least one field."""
+        return frozenset(self.matched_fields)
+
+
+@dataclass
+class _Frame:
+    """Object or list being normalized, with the copies built so far."""
+
+    node: Any
+    states: FrozenSet[Tuple[int, int, int]]
+    # Key of the node in its parent, `None` for the root.
+    key: Any
+    items: Iterator[Tuple[Any, Any]]
+    document: Any
+    key_document: Any
+    changed: bool = False
+
+
+class KeyNormalizer:
+    """
+    Applies declarative rules removing volatile fields, such as request ids or
+    timestamps, from cache keys. For every rule it counts the requests it
+    applied to, how many of those were cache hits, and how many of those hits
+    would have been misses without the rule.
+    :param rules: Rules in order of precedence
+    """
+
+    def __init__(self, rules: List[KeyRule]):
+        self.rules = rules
+        # Every state is a triple of (index of the rule, index of the path of
+        # the rule, index of the next segment of the path to match).
+        self._initial_states = self._closure(
+            {
+                (rule_index, path_index, 0)
+                for rule_index, rule in enumerate(rules)
+                for path_index in range(len(rule.segments))
+            }
+        )
+
+        self._lock = threading.Lock()
+        self._applied = [0] * len(rules)
+        self._hits = [0] * len(rules)
+        self._rescued_hits = [0] * len(rules)
+        self._seen_keys: List["OrderedDict[bytes, None]"] = [
+            OrderedDict() for _ in rules
+        ]
+
+    @classmethod
+    def from_file(cls, path: str) -> "KeyNormalizer":
+        """
+        Load rules from a yaml file with a list of rules under `rules`, each
+        with a `name`, a list of `paths` and an `action`.
+        :param path: Location of the yaml file
+        """
+
+        with open(path) as f:
+            configuration = yaml.safe_load(f) or {}
+
+        return cls(
+            [
+                KeyRule(name=rule["name"], paths=rule["paths"], action=rule["action"])
+                for rule in configuration.get("rules") or []
+            ]
+        )
+
+    def normalize(self, json_to_analyze: Any) -> NormalizedDocument:
+        """
+        Apply all rules to a document. The document itself is not modified,
+        objects and lists on the paths to matched fields are copied instead.
+        :param json_to_analyze: JSON document to analyze
+        """
+
+        matched_fields: Dict[int, List[Tuple[Tuple[Any, ...], Any]]] = {}
+        document, key_document = self._apply(
+            json_to_analyze, self._initial_states, matched_fields
+        )
+        return NormalizedDocument(
+            original=json_to_analyze,
+            document=document,
+            key_document=key_document,
+            matched_fields=matched_fields,
+        )
+
+    def record(self, normalized: NormalizedDocument, key: bytes, hit: bool) -> None:
+        """
+        Update the counters of the rules applied to a request.
+
+        Without a rule, the key of the request would also depend on the values
+        of the fields the rule matched. So instead of normalizing the document
+        again without the rule, its counterfactual key is derived from the key
+        of the request and those values only.
+        :param normalized: Normalized document of the request
+        :param key: Cache key of the request, from `canonical_digest`
+        :param hit: Whether the request was answered from the cache
+        """
+
+        for rule_index, fields in normalized.matched_fields.items():
+            counterfactual_key = hashlib.blake2b(
+                key + json_codec.dumps(fields, sort_keys=True),
+                digest_size=DIGEST_SIZE,
+            ).digest()
+
+            with self._lock:
+                seen_keys = self._seen_keys[rule_index]
+                seen_before = counterfactual_key in seen_keys
+                seen_keys[counterfactual_key] = None
+                seen_keys.move_to_end(counterfactual_key)
+                if len(seen_keys) > SEEN_KEYS_PER_RULE:
+                    seen_keys.popitem(last=False)
+
+                self._applied[rule_index] += 1
+                if hit:
+                    self._hits[rule_index] += 1
+                    if not seen_before:
+                        self._rescued_hits[rule_index] += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return the counters of every rule."""
+
+        with self._lock:
+            return {
+                rule.name: {
+                    "applied": self._applied[index],
+                    "hits": self._hits[index],
+                    "rescued_hits": self._rescued_hits[index],
+                }
+                for index, rule in enumerate(self.rules)
+            }
+
+    def _closure(
+        self, states: Set[Tuple[int, int, int]]
+    ) -> FrozenSet[Tuple[int, int, int]]:
+        # `**` also matches zero segments, so it can be skipped right away.
+        todo = list(states)
+        closed = set(states)
+        while todo:
+            rule_index, path_index, segment_index = todo.pop()
+            segments = self.rules[rule_index].segments[path_index]
+            if segment_index < len(segments) and segments[segment_index] == "**":
+                skipped = (rule_index, path_index, segment_index + 1)
+                if skipped not in closed:
+                    closed.add(skipped)
+                    todo.append(skipped)
+        return frozenset(closed)
+
+    def _advance(
+        self, states: FrozenSet[Tuple[int, int, int]], key: str
+    ) -> Tuple[FrozenSet[Tuple[int, int, int]], Optional[int]]:
+        advanced = set()
+        matched_rule = None
+        for rule_index, path_index, segment_index in states:
+            segments = self.rules[rule_index].segments[path_index]
+            if segment_index == len(segments):
+                continue
+
+            segment = segments[segment_index]
+            if segment == "**":
+                advanced.add((rule_index, path_index, segment_index))
+                advanced.add((rule_index, path_index, segment_index + 1))
+            elif fnmatchcase(key, segment):
+                advanced.add((rule_index, path_index, segment_index + 1))
+
+        advanced = self._closure(advanced)
+        for rule_index, path_index, segment_index in advanced:
+            if segment_index == len(self.rules[rule_index].segments[path_index]) and (
+                matched_rule is None or rule_index < matched_rule
+            ):
+                matched_rule = rule_index
+
+        return advanced, matched_rule
+
+    def _apply(
+        self,
+        node: Any,
+        states: FrozenSet[Tuple[int, int, int]],
+        matched_fields: Dict[int, List[Tuple[Tuple[Any, ...], Any]]],
+    ) -> Tuple[Any, Any]:
+        # Iterative, so that deeply nested documents do not exhaust the stack.
+        if not states or not isinstance(node, (dict, list)):
+            return node, node
+
+        stack = [self._frame(node, states, None)]
+        while stack:
+            frame = stack[-1]
+            for key, value in frame.items:
+                child_states, matched_rule = self._advance(frame.states, str(key))
+                if matched_rule is None:
+                    if child_states and isinstance(value, (dict, list)):
+                        # The copies of the value are added once it is done.
+                        stack.append(self._frame(value, child_states, key))
+                        break
+                    self._append(frame.document, key, value)
+                    self._append(frame.key_document, key, value)
+                    continue
+
+                # The path is only built for the few matched fields.
+                path = tuple(ancestor.key for ancestor in stack[1:])
+                matched_fields.setdefault(matched_rule, []).append(
+                    ((*path, key), value)
+                )
+                frame.changed = True
+                action = self.rules[matched_rule].action
+                if action != "drop":
+                    self._append(frame.document, key, value)
+                if action == "placeholder":
+                    self._append(
+                        frame.key_document, key, _PLACEHOLDERS.get(type(value))
+                    )
+            else:
+                stack.pop()
+                if frame.changed:
+                    document, key_document = frame.document, frame.key_document
+                else:
+                    document = key_document = frame.node
+                if not stack:
+                    return document, key_document
+
+                parent = stack[-1]
+                parent.changed = parent.changed or frame.changed
+                self._append(parent.document, frame.key, document)
+                self._append(parent.key_document, frame.key, key_document)
+
+    @staticmethod
+    def _frame(node: Any, states: FrozenSet[Tuple[int, int, int]], key: Any) -> _Frame:
+        return _Frame(
+            node=node,
+            states=states,
+            key=key,
+            items=_items(node),
+            document={} if isinstance(node, dict) else [],
+            key_document={} if isinstance(node, dict) else [],
+        )
+
+    @staticmethod
+    def _append(container: Any, key: Any, value: Any) -> None:
+        if isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
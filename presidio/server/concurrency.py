@@ -0,0 +1,279 @@
+"""Adaptive limit of the requests analyzed concurrently."""
+
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional
+
+# Callers beyond this number share the class of the empty purpose, so that
+# arbitrary purposes cannot grow the counters without bounds.
+MAX_CLASSES = 64
+
+
+@dataclass
+class _Waiter:
+    """Request waiting for a slot."""
+
+    tag: float
+    enqueued: float
+    granted: bool = False
+
+
+@dataclass
+class _CallerClass:
+    """Queue and counters of the requests of one calling service."""
+
+    weight: float
+    max_concurrency: Optional[int]
+    queue: Deque[_Waiter] = field(default_factory=deque)
+    # Virtual time tag of the last queued request.
+    last_tag: float = 0.0
+    in_flight: int = 0
+    accepted: int = 0
+    shed: int = 0
+    queue_seconds: float = 0.0
+    latency_seconds: float = 0.0
+    completed: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the state, counters and average times of the class."""
+
+        return {
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self.queue),
+            "accepted": self.accepted,
+            "shed": self.shed,
+            "average_queue_ms": (
+                self.queue_seconds / self.accepted * 1000 if self.accepted else 0
+            ),
+            "average_latency_ms": (
+                self.latency_seconds / self.completed * 1000 if self.completed else 0
+            ),
+        }
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of requests analyzed at the same time, adapting the limit
+    to the measured latency, and sheds the requests beyond it.
+
+    The limit follows the gradient between the long-term and the short-term
+    average latency: while requests take as long as usual and the limit is
+    used, the limit grows with its square root, and when the latency rises
+    because the analysis falls behind, the limit shrinks in proportion. A
+    request over the limit waits for a free slot for at most
+    `max_queue_seconds`, behind at most `limit` other requests, and is
+    rejected otherwise, so overload is answered right away instead of queuing
+    requests until the clients time out.
+
+    Every calling service, as named by the `derive_purpose` of its requests,
+    has a queue of its own. Free slots are handed to the queues by weighted
+    fair queueing, so a service gets a share of the slots in proportion to its
+    weight while others are waiting, and a surge of one service fills its own
+    queue only: once all queues are full, the requests of services beyond
+    their share are shed first.
+
+    :param initial_limit: Limit before any latency was measured
+    :param min_limit: Lower bound of the limit
+    :param max_limit: Upper bound of the limit
+    :param max_queue_seconds: Longest time a request waits for a free slot
+    :param tolerance: Ratio of the short-term to the long-term latency that is
+    still not considered a rise
+    :param smoothing: Weight of a new limit against the current one
+    :param weights: Weights of calling services by purpose, 1 for the others
+    :param max_concurrency: Largest number of requests of a calling service in
+    flight at the same time by purpose, unlimited for the others
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        max_queue_seconds: float = 0.1,
+        tolerance: float = 1.5,
+        smoothing: float = 0.2,
+        weights: Optional[Dict[str, float]] = None,
+        max_concurrency: Optional[Dict[str, int]] = None,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue_seconds = max_queue_seconds
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.weights = weights or {}
+        self.max_concurrency = max_concurrency or {}
+
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.queue_depth = 0
+        self._classes: Dict[str, _CallerClass] = {}
+        self._condition = threading.Condition()
+        # Virtual time of the fair queueing, the tag of the last granted slot.
+        self._virtual_time = 0.0
+        # Average latencies in seconds, `None` until the first request ends.
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+
+        self.accepted = 0
+        self.queued = 0
+        self.shed = 0
+
+    def acquire(self, purpose: str = "") -> Optional[float]:
+        """
+        Take a slot for a request, waiting for one if needed.
+        :param purpose: Calling service of the request
+        :return: Start time of the request to pass to `release`, `None` if the
+        request is shed
+        """
+
+        with self._condition:
+            caller = self._caller(purpose)
+            if self.queue_depth >= int(self.limit) and not self._below_share(caller):
+                caller.shed += 1
+                self.shed += 1
+                return None
+
+            now = time.monotonic()
+            tag = max(self._virtual_time, caller.last_tag) + 1 / caller.weight
+            caller.last_tag = tag
+            waiter = _Waiter(tag=tag, enqueued=now)
+            caller.queue.append(waiter)
+            self.queue_depth += 1
+            self._dispatch()
+
+            if not waiter.granted:
+                self.queued += 1
+                self._condition.wait_for(
+                    lambda: waiter.granted, timeout=self.max_queue_seconds
+                )
+                if not waiter.granted:
+                    caller.queue.remove(waiter)
+                    self.queue_depth -= 1
+                    caller.shed += 1
+                    self.shed += 1
+                    return None
+
+            start = time.monotonic()
+            caller.queue_seconds += start - waiter.enqueued
+            caller.accepted += 1
+            self.accepted += 1
+            return start
+
+    def release(self, start: float, purpose: str = "") -> None:
+        """
+        Free the slot of a request and update the limit with its latency.
+        :param start: Start time returned by `acquire`
+        :param purpose: Calling service of the request
+        """
+
+        latency = time.monotonic() - start
+        with self._condition:
+            caller = self._caller(purpose)
+            caller.in_flight -= 1
+            caller.latency_seconds += latency
+            caller.completed += 1
+
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self._update(latency, in_flight)
+            self._dispatch()
+
+    def retry_after(self) -> int:
+        """Return the seconds a shed client should wait before retrying."""
+        return max(1, math.ceil(self._long_latency or 0))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the limit, the requests in flight and queued, and counters."""
+
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "accepted": self.accepted,
+                "queued": self.queued,
+                "shed": self.shed,
+                "short_latency_ms": (self._short_latency or 0) * 1000,
+                "long_latency_ms": (self._long_latency or 0) * 1000,
+                "purposes": {
+                    purpose: caller.stats() for purpose, caller in self._classes.items()
+                },
+            }
+
+    def _caller(self, purpose: str) -> _CallerClass:
+        if purpose not in self._classes and len(self._classes) >= MAX_CLASSES:
+            purpose = ""
+        if purpose not in self._classes:
+            self._classes[purpose] = _CallerClass(
+                weight=self.weights.get(purpose, 1.0),
+                max_concurrency=self.max_concurrency.get(purpose),
+            )
+        return self._classes[purpose]
+
+    def _below_share(self, caller: _CallerClass) -> bool:
+        # The share of the queue of a service, among the services waiting.
+        waiting = [other for other in self._classes.values() if other.queue]
+        total_weight = sum(other.weight for other in waiting)
+        if caller not in waiting:
+            total_weight += caller.weight
+        return len(caller.queue) < int(self.limit) * caller.weight / total_weight
+
+    def _dispatch(self) -> None:
+        # Grant free slots to the queued requests with the smallest tags.
+        while self.in_flight < int(self.limit):
+            eligible = [
+                caller
+                for caller in self._classes.values()
+                if caller.queue
+                and (
+                    caller.max_concurrency is None
+                    or caller.in_flight < caller.max_concurrency
+                )
+            ]
+            if not eligible:
+                return
+
+            caller = min(eligible, key=lambda caller: caller.queue[0].tag)
+            waiter = caller.queue.popleft()
+            waiter.granted = True
+            self._virtual_time = waiter.tag
+            self.queue_depth -= 1
+            caller.in_flight += 1
+            self.in_flight += 1
+            self._condition.notify_all()
+
+    def _update(self, latency: float, in_flight: int) -> None:
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+            return
+
+        self._short_latency += (latency - self._short_latency) * 0.5
+        self._long_latency += (latency - self._long_latency) * 0.01
+        # Recover the baseline after a long overload more quickly.
+        if self._long_latency > 2 * self._short_latency:
+            self._long_latency *= 0.95
+
+        gradient = max(
+            0.5,
+            min(1.0, self.tolerance * self._long_latency / self._short_latency),
+        )
+        # Below half of the limit, the latency says nothing about a higher one.
+        if gradient == 1.0 and in_flight < self.limit / 2:
+            return
+
+        if gradient < 1.0:
+            new_limit = self.limit * gradient
+        else:
+            new_limit = self.limit + math.sqrt(self.limit)
+        self.limit = min(
+            self.max_limit,
+            max(
+                self.min_limit,
+                self.limit * (1 - self.smoothing) + new_limit * self.smoothing,
+            ),
+        )
@@ -0,0 +1,107 @@
+"""Deadlines of analysis requests."""
+
+import time
+from typing import Callable, Dict, Optional
+
+# Header with the milliseconds from the arrival of a request by which the
+# client needs the answer.
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+# Response header flagging entity types found before the deadline only.
+PARTIAL_HEADER = "X-Partial-Result"
+
+
+class Deadline:
+    """
+    Time by which a request is answered, and whether its client is still
+    waiting. The analysis checks it between batches and leaves, and stops
+    once it expired.
+
+    :param seconds: Seconds from now to the deadline, `None` for none
+    :param client_disconnected: Returns whether the client closed the
+    connection, `None` if the server cannot tell
+    """
+
+    def __init__(
+        self,
+        seconds: Optional[float],
+        client_disconnected: Optional[Callable[[], bool]] = None,
+    ):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+        self.client_disconnected = client_disconnected
+        # Set once the deadline expired or the client disconnected.
+        self.exceeded = False
+        self.disconnected = False
+
+    def expired(self) -> bool:
+        """Return whether the work for the request should stop."""
+
+        if not self.exceeded:
+            if self.client_disconnected is not None and self.client_disconnected():
+                self.exceeded = self.disconnected = True
+            elif self.expires_at is not None and time.monotonic() >= self.expires_at:
+                self.exceeded = True
+        return self.exceeded
+
+
+class DeadlinePolicy:
+    """
+    Sets the deadlines of requests, by their header or else the configured
+    budget, whichever is earlier, and counts the requests stopped by them.
+
+    :param budget_seconds: Longest time to analyze a request, `None` for no
+    limit besides the header
+    """
+
+    def __init__(self, budget_seconds: Optional[float] = None):
+        self.budget_seconds = budget_seconds
+
+        self.deadlines = 0
+        self.partial = 0
+        self.abandoned = 0
+
+    def start(
+        self,
+        header: Optional[str],
+        client_disconnected: Optional[Callable[[], bool]] = None,
+    ) -> Deadline:
+        """
+        Start the deadline of a request.
+        :param header: Value of the deadline header, if any
+        :param client_disconnected: Returns whether the client closed the
+        connection
+        :return: The deadline
+        """
+
+        seconds = self.budget_seconds
+        if header:
+            try:
+                requested = max(0.0, float(header) / 1000)
+            except ValueError:
+                # A malformed header leaves the budget in place.
+                requested = None
+            if requested is not None and (seconds is None or requested < seconds):
+                seconds = requested
+
+        if seconds is not None:
+            self.deadlines += 1
+        return Deadline(seconds, client_disconnected)
+
+    def record(self, deadline: Deadline) -> None:
+        """Count a request whose analysis stopped at its deadline."""
+
+        if deadline.disconnected:
+            self.abandoned += 1
+        elif deadline.exceeded:
+            self.partial += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of requests with a deadline, answered partially
+        past it, and abandoned as their client disconnected.
+        """
+
+        return {
+            "deadlines": self.deadlines,
+            "partial": self.partial,
+            "abandoned": self.abandoned,
+        }
@@ -1,52 +1,183 @@
-from typing import Any, Iterator, Set
+import copy
+import hashlib
+from itertools import count
+from operator import itemgetter
+from typing import (
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from presidio_analyzer import DictAnalyzerResult, RecognizerRegistry, RecognizerResult
+
+
+def _items(container: Union[Dict[str, Any], List[Any]]) -> Iterator[Tuple[str, Any]]:
+    # List items are keyed by their index, as a string like dictionary keys.
+    if isinstance(container, dict):
+        return iter(container.items())
+    return zip(map(str, count()), container)
+
+
+def iter_json(
+    data: Any,
+    descend: Optional[Callable[[Tuple[str, ...], Any], bool]] = None,
+) -> Iterator[Tuple[Tuple[str, ...], Any]]:
+    """
+    Iterate over the leaf values of parsed JSON, without recursion and
+    without copying the data. Memory is bounded by the depth of the data.
+    :param data: Parsed JSON
+    :param descend: Called with the path and value of every nested dictionary
+    and list before iterating over it. Containers it returns `False` for are
+    yielded as a whole instead.
+    :return: Path and value of every leaf, in document order. The path holds
+    the keys from the root to the value, with list indexes as strings.
+    """
+
+    if not isinstance(data, (dict, list)):
+        yield (), data
+        return
+
+    stack = [((), _items(data))]
+    while stack:
+        path, items = stack[-1]
+        for key, value in items:
+            value_path = path + (key,)
+            if isinstance(value, (dict, list)) and (
+                descend is None or descend(value_path, value)
+            ):
+                stack.append((value_path, _items(value)))
+                break
+            yield value_path, value
+        else:
+            stack.pop()
+
+
+def _sorted_items(
+    container: Union[Dict[str, Any], List[Any]],
+) -> Iterator[Tuple[str, Any]]:
+    return iter(sorted(_items(container), key=itemgetter(0)))
+
 
-from presidio_analyzer import DictAnalyzerResult, RecognizerResult
+def _leaf_digest(data: Any) -> bytes:
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(type(data).__name__.encode())
+    hasher.update(b"\x00")
+    hasher.update(str(data).encode("utf-8", "surrogatepass"))
+    return hasher.digest()
 
 
-def convert_all_lists_to_dicts(data: Any) -> Any:
+def digest_subtrees(data: Any, digests: Dict[int, bytes]) -> bytes:
     """
-    Recursively transforms all lists into dictionaries.
-    :param data: Incoming data
-    :return: Transformed data
+    Computes a Merkle digest of every dictionary and list in the data.
+    The digest of a dictionary covers its keys and the digests of its values,
+    independent of the order of the keys. Lists are digested like
+    dictionaries keyed by the indexes of their items.
+    :param data: Parsed JSON
+    :param digests: Receives the digest of every dictionary and list under
+    its `id`
+    :return: Digest of the data
     """
 
-    if not isinstance(data, (list, dict)):
-        return data
+    if not isinstance(data, (dict, list)):
+        return _leaf_digest(data)
+
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(b"dict")
+    stack = [(data, _sorted_items(data), hasher)]
+    while stack:
+        container, items, hasher = stack[-1]
+        for key, value in items:
+            encoded_key = str(key).encode("utf-8", "surrogatepass")
+            hasher.update(len(encoded_key).to_bytes(4, "little"))
+            hasher.update(encoded_key)
+            if isinstance(value, (dict, list)):
+                # The digest of the value is added once it is complete.
+                value_hasher = hashlib.blake2b(digest_size=16)
+                value_hasher.update(b"dict")
+                stack.append((value, _sorted_items(value), value_hasher))
+                break
+            hasher.update(_leaf_digest(value))
+        else:
+            stack.pop()
+            digest = hasher.digest()
+            digests[id(container)] = digest
+            if stack:
+                stack[-1][2].update(digest)
 
-    if isinstance(data, dict):
-        return {k: convert_all_lists_to_dicts(v) for k, v in data.items()}
+    return digests[id(data)]
 
-    if isinstance(data, list):
-        result = dict()
 
-        for k, v in enumerate(data):
-            # need to convert `int` indexes into strings, otherwise the
-            # for-loop in the subsequent operation fails.
-            result[str(k)] = convert_all_lists_to_dicts(v)
+def prune_recognizers(
+    registry: RecognizerRegistry, entities: Iterable[str]
+) -> Tuple[RecognizerRegistry, List[str]]:
+    """
+    Copy the registry without the recognizers that cannot detect any of the
+    entities, so that they are not run at all. The registry is left as is, and
+    the kept recognizers are copied, so that changing them does not affect it.
+    :param registry: Recognizer registry of the analyzer engine
+    :param entities: Entity types to keep the recognizers for
+    :return: The pruned registry and the names of the removed recognizers
+    """
 
-        return result
+    entities = set(entities)
+    kept = []
+    pruned = []
+    for recognizer in registry.recognizers:
+        if entities.intersection(recognizer.supported_entities):
+            kept.append(copy.copy(recognizer))
+        else:
+            pruned.append(recognizer.name)
 
-    raise TypeError("Unknown type of incoming data: " + str(type(data)))
+    return (
+        RecognizerRegistry(
+            recognizers=kept, global_regex_flags=registry.global_regex_flags
+        ),
+        pruned,
+    )
 
 
 def extract_data_types_from_results(
     dict_results: Iterator[DictAnalyzerResult],
+    entity_types: Optional[AbstractSet[str]] = None,
 ) -> Set[str]:
     """
     Extract `entity_type` fields from all nested `RecognizerResult` types within
-    the incoming tree structure of `DictAnalyzerResult`.
+    the incoming tree structure of `DictAnalyzerResult`. Leaves answered from
+    the leaf cache carry a set of entity types instead of recognizer results,
+    which is merged as is.
+    The lazy iterators of `analyze_dict` are consumed one result at a time, so
+    the analysis of the remaining values is skipped once all `entity_types`
+    have been found.
     :param dict_results: Result of running `batch_analyzer.analyze_dict`
     function on JSON object
+    :param entity_types: Entity types after which the extraction stops, `None`
+    extracts from all results
     :return: Set of entity types
     """
 
-    todo = list(dict_results)
+    todo = [iter(dict_results)]
     final = set()
 
     while len(todo) > 0:
+        if entity_types is not None and final >= entity_types:
+            break
+
+        dict_result = next(todo[-1], None)
+        if dict_result is None:
+            todo.pop()
+            continue
+
         # The type of `recognizer_results` is defined here:
         # https://github.com/microsoft/presidio/blob/3c7eb8909a3341f2597453fbcaba6184477aa464/presidio-analyzer/presidio_analyzer/dict_analyzer_result.py#L25
-        recognizer_results = todo.pop().recognizer_results
+        recognizer_results = dict_result.recognizer_results
 
         if isinstance(recognizer_results, list):
             # In this case `recognizer_results` has type
@@ -65,8 +196,11 @@ def extract_data_types_from_results(
                 else:
                     raise TypeError("Unknown type of result: " + str(type(item)))
 
+        elif isinstance(recognizer_results, AbstractSet):
+            final.update(recognizer_results)
+
         elif isinstance(recognizer_results, Iterator):
-            todo.extend(recognizer_results)
+            todo.append(recognizer_results)
 
         else:
             raise TypeError("Unknown type of result: " + str(type(recognizer_results)))
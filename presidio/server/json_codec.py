@@ -0,0 +1,93 @@
+"""JSON parsing and serialization with orjson, when it is installed."""
+
+import json
+from typing import Any, Callable, Optional
+
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    # orjson is in the Pipfile, the standard library serves without it
+    orjson = None
+
+
+def loads(data: Any) -> Any:
+    """
+    Parse a JSON document.
+    :param data: Text or UTF-8 bytes
+    :return: Parsed document
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Integers beyond 64 bits and the like, the standard library
+            # parses them or raises its usual error.
+            pass
+    return json.loads(data)
+
+
+def dumps(
+    data: Any,
+    sort_keys: bool = False,
+    default: Optional[Callable[[Any], Any]] = None,
+) -> bytes:
+    """
+    Serialize a JSON document compactly, without escaping non-ASCII
+    characters.
+    :param data: Document to serialize
+    :param sort_keys: Whether to sort the keys of objects
+    :param default: Called for objects that cannot be serialized otherwise
+    :return: UTF-8 encoded JSON
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                data,
+                default=default,
+                option=orjson.OPT_SORT_KEYS if sort_keys else None,
+            )
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(
+        data,
+        sort_keys=sort_keys,
+        default=default,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode("utf-8", "surrogatepass")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider parsing request bodies and serializing responses with
+    `loads` and `dumps`. `request.get_json()` keeps the parsed body, so every
+    request is parsed once.
+    """
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        """Parse JSON from text or UTF-8 bytes."""
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        """Serialize data as JSON to a string."""
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, sort_keys=self.sort_keys, default=self.default).decode(
+            "utf-8", "surrogatepass"
+        )
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        """Serialize the arguments into a JSON response, skipping the string."""
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        body = dumps(obj, sort_keys=self.sort_keys, default=self.default)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
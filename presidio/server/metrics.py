@@ -0,0 +1,289 @@
+"""Prometheus metrics of the server, shared by its worker processes."""
+
+import multiprocessing
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence
+
+# Values one process can hold, the metrics are allocated once, up front.
+MAX_VALUES = 4096
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = tuple(4**exponent for exponent in range(4, 14))
+COUNT_BUCKETS = tuple(4**exponent for exponent in range(0, 10))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    """Values of a metric with a given set of labels."""
+
+    def __init__(
+        self,
+        metrics: "Metrics",
+        family: "_Family",
+        labels: Dict[str, str],
+        size: int = 1,
+    ):
+        self._metrics = metrics
+        self.family = family
+        self.labels = labels
+        self.size = size
+        self.index = metrics.allocate(size)
+
+
+class Counter(_Metric):
+    """Value that only goes up."""
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Add to the value."""
+        with self._metrics.lock:
+            self._metrics.values[self._metrics.offset + self.index] += amount
+
+    def set(self, value: float) -> None:
+        """Set the value to a counter kept elsewhere, such as by a cache."""
+        with self._metrics.lock:
+            self._metrics.values[self._metrics.offset + self.index] = value
+
+    def render(self, values: Callable[[int], float]) -> List[str]:
+        """Return the exposition lines of the value."""
+        return [f"{self.family.name}{_format_labels(self.labels)} {values(self.index)}"]
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+
+    def dec(self, amount: float = 1.0) -> None:
+        """Subtract from the value."""
+        with self._metrics.lock:
+            self._metrics.values[self._metrics.offset + self.index] -= amount
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over buckets, with their sum and count."""
+
+    def __init__(
+        self,
+        metrics: "Metrics",
+        family: "_Family",
+        labels: Dict[str, str],
+        buckets: Sequence[float],
+    ):
+        # A count per bucket and one above them, then the sum and the count.
+        super().__init__(metrics, family, labels, len(buckets) + 3)
+        self.buckets = buckets
+
+    def observe(self, value: float) -> None:
+        """Record a value."""
+
+        bucket = bisect_left(self.buckets, value)
+        with self._metrics.lock:
+            values = self._metrics.values
+            index = self._metrics.offset + self.index
+            values[index + bucket] += 1
+            values[index + len(self.buckets) + 1] += value
+            values[index + len(self.buckets) + 2] += 1
+
+    def render(self, values: Callable[[int], float]) -> List[str]:
+        """Return the exposition lines of the buckets, sum and count."""
+
+        name = self.family.name
+        lines = []
+        cumulative = 0.0
+        for position, bound in enumerate([*self.buckets, "+Inf"]):
+            cumulative += values(self.index + position)
+            labels = _format_labels({**self.labels, "le": str(bound)})
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+
+        labels = _format_labels(self.labels)
+        lines.append(f"{name}_sum{labels} {values(self.index + len(self.buckets) + 1)}")
+        lines.append(
+            f"{name}_count{labels} {values(self.index + len(self.buckets) + 2)}"
+        )
+        return lines
+
+
+class _Family:
+    """Metrics of the same name, told apart by their labels."""
+
+    def __init__(self, name: str, documentation: str, kind: str):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.metrics: List[_Metric] = []
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms exposed in the Prometheus text
+    format.
+
+    Every process writes its values to its own region of an array in shared
+    memory, so with several worker processes, any of them renders the sum over
+    all of them, as if it served all requests. Therefore all metrics are
+    created before the workers are forked, and every worker selects its region
+    right after the fork. The threads of a process update its values under a
+    lock, as `+=` on the shared array is not atomic.
+
+    When a worker exits, the parent retires its region before starting its
+    successor: the gauges are cleared, so requests in flight in the exited
+    worker no longer count, and the counters and histograms are moved to a
+    region of their own, so their sums keep growing while the successor
+    starts from zero, like the counters it keeps elsewhere.
+
+    Values of components that keep their own counters, such as the caches,
+    are copied into the metrics by collectors. They run when the metrics are
+    rendered and when `collect` is called, e.g. at the end of every request.
+
+    :param workers: Number of processes writing metrics
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(1, workers)
+        # A region per worker, and a last one for the retired workers.
+        self.values = multiprocessing.RawArray("d", (self.workers + 1) * MAX_VALUES)
+        self.offset = 0
+        self.lock = threading.Lock()
+        self._size = 0
+        self._families: Dict[str, _Family] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def select_worker(self, worker_id: int) -> None:
+        """Write the values of this process to the region of the worker."""
+
+        self.offset = worker_id * MAX_VALUES
+        # A thread of the parent may have held the lock during the fork.
+        self.lock = threading.Lock()
+
+    def retire_worker(self, worker_id: int) -> None:
+        """
+        Clear the region of a worker that exited, keeping its counters and
+        histograms in the sums. Called by the parent, before the worker is
+        started again.
+        """
+
+        values = self.values
+        offset = worker_id * MAX_VALUES
+        retired = self.workers * MAX_VALUES
+        for family in self._families.values():
+            for metric in family.metrics:
+                for index in range(metric.index, metric.index + metric.size):
+                    if family.kind != "gauge":
+                        values[retired + index] += values[offset + index]
+                    values[offset + index] = 0.0
+
+    def allocate(self, size: int) -> int:
+        """Reserve values for a metric, return the index of the first."""
+
+        if self._size + size > MAX_VALUES:
+            raise ValueError(f"More than {MAX_VALUES} metric values")
+        index = self._size
+        self._size += size
+        return index
+
+    def counter(self, name: str, documentation: str, **labels: str) -> Counter:
+        """Create a counter, `name` should end with `_total`."""
+        return self._add(Counter, name, documentation, "counter", labels)
+
+    def gauge(self, name: str, documentation: str, **labels: str) -> Gauge:
+        """Create a gauge."""
+        return self._add(Gauge, name, documentation, "gauge", labels)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        **labels: str,
+    ) -> Histogram:
+        """Create a histogram with upper bounds of its buckets, ascending."""
+        return self._add(
+            Histogram, name, documentation, "histogram", labels, buckets=buckets
+        )
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Register a function that copies values kept elsewhere."""
+        self._collectors.append(collector)
+
+    def collect(self) -> None:
+        """Run the collectors."""
+        for collector in self._collectors:
+            collector()
+
+    def render(self) -> bytes:
+        """Return the metrics summed over the workers, in the text format."""
+
+        self.collect()
+        values = self.values
+
+        def summed(index: int) -> float:
+            return sum(
+                values[region * MAX_VALUES + index]
+                for region in range(self.workers + 1)
+            )
+
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for metric in family.metrics:
+                lines.extend(metric.render(summed))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _add(self, metric_class, name, documentation, kind, labels, **kwargs):
+        family = self._families.setdefault(name, _Family(name, documentation, kind))
+        metric = metric_class(self, family, labels, **kwargs)
+        family.metrics.append(metric)
+        return metric
+
+
+class RequestProfile:
+    """Seconds spent per stage of handling a request, and the leaf values."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.leaves = 0
+
+    def add(self, stage: str, seconds: float) -> None:
+        """Add time to a stage."""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """Add the seconds the block takes to a stage."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
@@ -0,0 +1,156 @@
+"""NLP engine batching texts of concurrent requests."""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from presidio_analyzer.nlp_engine import NlpArtifacts, NlpEngine
+
+# A text waiting to be processed: (text, language, future of the result).
+_PendingText = Tuple[str, str, "Future[NlpArtifacts]"]
+
+
+class MicroBatchingNlpEngine(NlpEngine):
+    """
+    NlpEngine collecting the texts of concurrent requests into batches.
+
+    Texts submitted by any thread are gathered for at most `max_wait_seconds`
+    or until `max_batch_size` texts are pending, and are then run through one
+    `process_batch` call of the wrapped engine, i.e. one spaCy `nlp.pipe`. The
+    callers wait for the results of their own texts.
+
+    The batching thread is started lazily in every process, so the engine can
+    be created before forking workers.
+
+    :param nlp_engine: Engine running the NLP pipeline
+    :param max_wait_seconds: Longest time a text waits for others to join its
+    batch
+    :param max_batch_size: Largest number of texts processed in one batch
+    """
+
+    def __init__(
+        self,
+        nlp_engine: NlpEngine,
+        max_wait_seconds: float,
+        max_batch_size: int,
+    ):
+        self.nlp_engine = nlp_engine
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch_size = max_batch_size
+
+        self._queue: "queue.Queue[_PendingText]" = queue.Queue()
+        self._worker_pid: Optional[int] = None
+        self._worker_lock = threading.Lock()
+
+        self.batches = 0
+        self.texts = 0
+
+    def load(self) -> None:
+        """Load the NLP model of the wrapped engine."""
+        self.nlp_engine.load()
+
+    def is_loaded(self) -> bool:
+        """Return True if the model of the wrapped engine is loaded."""
+        return self.nlp_engine.is_loaded()
+
+    def process_text(self, text: str, language: str) -> NlpArtifacts:
+        """Execute the NLP pipeline on a text as part of the next batch."""
+        return self._submit(text, language).result()
+
+    def process_batch(
+        self, texts: Iterable[str], language: str, **kwargs
+    ) -> Iterator[Tuple[str, NlpArtifacts]]:
+        """
+        Execute the NLP pipeline on texts as part of the next batches.
+
+        Returns a tuple of (text, NlpArtifacts)
+        """
+
+        futures = [(text, self._submit(str(text), language)) for text in texts]
+        for text, future in futures:
+            yield text, future.result()
+
+    def is_stopword(self, word: str, language: str) -> bool:
+        """Return true if the given word is a stop word."""
+        return self.nlp_engine.is_stopword(word, language)
+
+    def is_punct(self, word: str, language: str) -> bool:
+        """Return true if the given word is a punctuation word."""
+        return self.nlp_engine.is_punct(word, language)
+
+    def get_supported_entities(self) -> List[str]:
+        """Return the supported entities of the wrapped engine."""
+        return self.nlp_engine.get_supported_entities()
+
+    def stats(self) -> Dict[str, float]:
+        """Return the number of batches and texts processed so far."""
+
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "average_batch_size": self.texts / self.batches if self.batches else 0,
+            "pending_texts": self._queue.qsize(),
+        }
+
+    def _submit(self, text: str, language: str) -> "Future[NlpArtifacts]":
+        self._ensure_worker()
+        future: "Future[NlpArtifacts]" = Future()
+        self._queue.put((text, language, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+
+        with self._worker_lock:
+            if self._worker_pid == pid:
+                return
+
+            self._queue = queue.Queue()
+            threading.Thread(
+                target=self._process_forever,
+                name="micro-batching",
+                daemon=True,
+            ).start()
+            self._worker_pid = pid
+
+    def _process_forever(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(
+                        self._queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+
+            by_language: Dict[str, List[_PendingText]] = {}
+            for pending in batch:
+                by_language.setdefault(pending[1], []).append(pending)
+
+            for language, pending_texts in by_language.items():
+                self._process(language, pending_texts)
+
+            self.batches += 1
+            self.texts += len(batch)
+
+    def _process(self, language: str, pending_texts: List[_PendingText]) -> None:
+        try:
+            results = self.nlp_engine.process_batch(
+                [text for text, _, _ in pending_texts], language
+            )
+            for (_, _, future), (_, nlp_artifacts) in zip(pending_texts, results):
+                future.set_result(nlp_artifacts)
+        except Exception as e:
+            for _, _, future in pending_texts:
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,200 @@
+"""Single-pass scanning of texts with the patterns of all pattern recognizers."""
+
+import logging
+import threading
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import regex
+from presidio_analyzer import PatternRecognizer, RecognizerRegistry, RecognizerResult
+
+try:
+    import hyperscan
+except ImportError:
+    # hyperscan should be installed manually
+    hyperscan = None
+
+logger = logging.getLogger("presidio-analyzer")
+
+# Hyperscan flags matching the regex flags of the pattern recognizers.
+HYPERSCAN_FLAGS = {
+    regex.IGNORECASE: "HS_FLAG_CASELESS",
+    regex.MULTILINE: "HS_FLAG_MULTILINE",
+    regex.DOTALL: "HS_FLAG_DOTALL",
+}
+
+
+class CombinedPatternScanner:
+    """
+    Scans every text once with a Hyperscan automaton of the patterns of all
+    pattern recognizers, and only runs the recognizers whose patterns match.
+
+    Most leaf values match none of the patterns, so the separate regex scans
+    of the recognizers are replaced by a single pass over the text. The
+    patterns are compiled in prefilter mode, which may report matches the
+    original pattern would not find but never misses one. The recognizers of
+    the matching patterns are run as usual, including their checksum
+    validation and context, so the results are the same as without the
+    scanner.
+
+    :param registry: Registry whose pattern recognizers are scanned for
+    """
+
+    def __init__(self, registry: RecognizerRegistry):
+        if hyperscan is None:
+            raise ImportError("hyperscan is not installed")
+
+        scanned = []
+        for recognizer in registry.recognizers:
+            flags = self._flags(recognizer)
+            if flags is not None:
+                scanned.append((recognizer, flags))
+
+        self._database = hyperscan.Database()
+        try:
+            self._compile(scanned)
+        except hyperscan.error:
+            # Leave the recognizers with patterns Hyperscan cannot compile
+            # unscanned.
+            scanned = [
+                (recognizer, flags)
+                for recognizer, flags in scanned
+                if self._compiles(recognizer, flags)
+            ]
+            self._compile(scanned)
+
+        self.recognizers: List[PatternRecognizer] = [
+            recognizer for recognizer, _ in scanned
+        ]
+        self._local = threading.local()
+
+        # The counters are shared by the threads serving requests.
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.runs = 0
+        self.skipped_runs = 0
+
+    def install(self) -> List[str]:
+        """
+        Gate the `analyze` method of every scanned recognizer by the scanner.
+        :return: Names of the scanned recognizers
+        """
+
+        for index, recognizer in enumerate(self.recognizers):
+            recognizer.analyze = self._gate(index, recognizer.analyze)
+
+        return [recognizer.name for recognizer in self.recognizers]
+
+    def matching(self, text: str) -> FrozenSet[int]:
+        """Return the indexes of the recognizers with a pattern matching text."""
+
+        # The recognizers of a text are run one after another, so the scan
+        # of the last text of the thread answers all of them.
+        local = self._local
+        if getattr(local, "text", None) != text:
+            local.matching = self._scan(text)
+            local.text = text
+        return local.matching
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of scans and of run and skipped recognizers."""
+
+        with self._lock:
+            return {
+                "recognizers": len(self.recognizers),
+                "scans": self.scans,
+                "runs": self.runs,
+                "skipped_runs": self.skipped_runs,
+            }
+
+    def _gate(
+        self, index: int, analyze: Callable[..., List[RecognizerResult]]
+    ) -> Callable[..., List[RecognizerResult]]:
+        def gated_analyze(text: str, entities: List[str], *args, **kwargs):
+            # Flags other than the recognizer's own are not part of the scan.
+            if args or kwargs.get("regex_flags"):
+                return analyze(text, entities, *args, **kwargs)
+
+            if index not in self.matching(text):
+                with self._lock:
+                    self.skipped_runs += 1
+                return []
+
+            with self._lock:
+                self.runs += 1
+            return analyze(text, entities, *args, **kwargs)
+
+        return gated_analyze
+
+    def _compile(self, scanned: List[Tuple[PatternRecognizer, int]]) -> None:
+        expressions = []
+        ids = []
+        flags = []
+        for index, (recognizer, recognizer_flags) in enumerate(scanned):
+            for pattern in recognizer.patterns:
+                expressions.append(pattern.regex.encode("utf-8"))
+                ids.append(index)
+                flags.append(recognizer_flags)
+
+        if expressions:
+            self._database.compile(expressions=expressions, ids=ids, flags=flags)
+
+    def _scan(self, text: str) -> FrozenSet[int]:
+        # Scratch space must not be shared between threads.
+        local = self._local
+        if getattr(local, "scratch", None) is None:
+            local.scratch = hyperscan.Scratch(self._database)
+
+        with self._lock:
+            self.scans += 1
+        matching = set()
+        self._database.scan(
+            text.encode("utf-8", "replace"),
+            match_event_handler=self._on_match,
+            context=matching,
+            scratch=local.scratch,
+        )
+        return frozenset(matching)
+
+    @staticmethod
+    def _on_match(
+        index: int, start: int, end: int, flags: int, matching: set
+    ) -> Optional[bool]:
+        matching.add(index)
+        return None
+
+    @staticmethod
+    def _flags(recognizer: object) -> Optional[int]:
+        # Only recognizers whose results all come from their patterns can be
+        # skipped when none of the patterns matches.
+        if not isinstance(recognizer, PatternRecognizer) or not recognizer.patterns:
+            return None
+
+        regex_flags = int(recognizer.global_regex_flags or 0)
+        if regex_flags & ~sum(HYPERSCAN_FLAGS):
+            return None
+
+        flags = (
+            hyperscan.HS_FLAG_PREFILTER
+            | hyperscan.HS_FLAG_SINGLEMATCH
+            | hyperscan.HS_FLAG_ALLOWEMPTY
+            | hyperscan.HS_FLAG_UTF8
+            | hyperscan.HS_FLAG_UCP
+        )
+        for regex_flag, name in HYPERSCAN_FLAGS.items():
+            if regex_flags & regex_flag:
+                flags |= getattr(hyperscan, name)
+
+        return flags
+
+    @staticmethod
+    def _compiles(recognizer: PatternRecognizer, flags: int) -> bool:
+        for pattern in recognizer.patterns:
+            try:
+                hyperscan.Database().compile(
+                    expressions=[pattern.regex.encode("utf-8")], flags=[flags]
+                )
+            except hyperscan.error as e:
+                logger.warning(f"Not scanning for {recognizer.name}. {e}")
+                return False
+
+        return True
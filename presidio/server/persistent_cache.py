@@ -0,0 +1,357 @@
+"""Persistent cache tier surviving restarts of the service."""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .cache import ResultCache
+
+logger = logging.getLogger("presidio-analyzer")
+
+# Number of pending writes after which further writes are dropped instead of
+# slowing down requests.
+MAX_PENDING_WRITES = 10000
+
+# Maximum number of writes committed in a single transaction.
+WRITE_BATCH_SIZE = 512
+
+
+class PersistentCache:
+    """
+    Cache of byte values in a SQLite database on local disk. Reads go through
+    memory-mapped I/O, writes are queued and committed by a background thread,
+    so requests never wait for the disk. When the database grows beyond
+    `max_bytes`, the oldest entries are removed.
+
+    Connections and the writer thread are created lazily in every process, so
+    the cache can be shared by forked workers.
+
+    The entries are stored in a table named after the cache and the
+    fingerprint of what they depend on, such as the versions of presidio and
+    of the NLP models, the recognizers and the cache key rules. Tables of the
+    cache with other fingerprints hold results that may be stale, and are
+    dropped.
+
+    :param path: Location of the database file
+    :param table: Name of the cache, the prefix of its table
+    :param max_bytes: Upper bound for the size of all keys and values
+    :param fingerprint: Digest of what the entries depend on, made of
+    letters and digits
+    """
+
+    def __init__(self, path: str, table: str, max_bytes: int, fingerprint: str = ""):
+        if fingerprint and not fingerprint.isalnum():
+            raise ValueError(f"Invalid fingerprint '{fingerprint}' of cache {table}")
+
+        self.path = path
+        self.table = f"{table}_{fingerprint}" if fingerprint else table
+        self.max_bytes = max_bytes
+
+        self._local = threading.local()
+        self._queue: "queue.Queue[Tuple[bytes, bytes, Optional[float]]]" = queue.Queue(
+            maxsize=MAX_PENDING_WRITES
+        )
+        self._writer_pid: Optional[int] = None
+        self._writer_lock = threading.Lock()
+
+        # Guards the counters of the request threads, the writer thread alone
+        # updates `writes` and `pruned`.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.dropped_writes = 0
+        self.pruned = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        connection = self._connect()
+        with connection:
+            for (stale,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND (name = ? OR name LIKE ? ESCAPE '\\') AND name != ?",
+                (table, table.replace("_", "\\_") + "\\_%", self.table),
+            ).fetchall():
+                logger.info(f"Dropping stale persistent cache table {stale}")
+                connection.execute(f"DROP TABLE {stale}")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key BLOB PRIMARY KEY, "
+                "value BLOB NOT NULL, "
+                "expires_at REAL, "
+                "stored_at REAL NOT NULL)"
+            )
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_stored_at "
+                f"ON {self.table} (stored_at)"
+            )
+
+    def get(self, key: bytes) -> Optional[Tuple[bytes, Optional[float]]]:
+        """
+        Return the stored value for `key` with its expiry timestamp, or `None`
+        when missing or expired.
+        """
+
+        row = (
+            self._connection()
+            .execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            )
+            .fetchone()
+        )
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return row[0], row[1]
+
+    def set(self, key: bytes, value: bytes, ttl_seconds: Optional[float]) -> None:
+        """Queue `value` to be written under `key`."""
+
+        self._ensure_writer()
+        expires_at = time.time() + ttl_seconds if ttl_seconds else None
+        try:
+            self._queue.put_nowait((key, value, expires_at))
+        except queue.Full:
+            with self._lock:
+                self.dropped_writes += 1
+
+    def newest(self, max_bytes: int) -> List[Tuple[bytes, bytes, Optional[float]]]:
+        """
+        Return the most recently stored entries that have not expired.
+        :param max_bytes: Upper bound for the size of the returned entries
+        :return: List of (key, value, expiry timestamp), newest first
+        """
+
+        entries = []
+        total = 0
+        rows = self._connection().execute(
+            f"SELECT key, value, expires_at FROM {self.table} "
+            "WHERE expires_at IS NULL OR expires_at > ? "
+            "ORDER BY stored_at DESC",
+            (time.time(),),
+        )
+        for key, value, expires_at in rows:
+            total += len(key) + len(value)
+            if total > max_bytes:
+                break
+            entries.append((key, value, expires_at))
+
+        return entries
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters describing the state of the cache."""
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "pending_writes": self._queue.qsize(),
+                "dropped_writes": self.dropped_writes,
+                "pruned": self.pruned,
+            }
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA mmap_size={self.max_bytes}")
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections must neither be shared between threads nor be
+        # inherited by forked processes.
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    def _ensure_writer(self) -> None:
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return
+
+        with self._writer_lock:
+            if self._writer_pid == pid:
+                return
+
+            if self._writer_pid is not None:
+                # Writes queued by the parent process belong to the parent.
+                self._queue = queue.Queue(maxsize=MAX_PENDING_WRITES)
+            threading.Thread(
+                target=self._write_forever,
+                name=f"persistent-cache-{self.table}",
+                daemon=True,
+            ).start()
+            self._writer_pid = pid
+
+    def _write_forever(self) -> None:
+        connection = self._connect()
+        stored_bytes = self._stored_bytes(connection)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                now = time.time()
+                with connection:
+                    connection.execute("BEGIN")
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO {self.table} "
+                        "(key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)",
+                        [
+                            (key, value, expires_at, now)
+                            for key, value, expires_at in batch
+                        ],
+                    )
+                self.writes += len(batch)
+
+                # Replaced entries are counted twice, so the estimate is only
+                # used to decide when to look at the exact size.
+                stored_bytes += sum(len(key) + len(value) for key, value, _ in batch)
+                if stored_bytes > self.max_bytes:
+                    stored_bytes = self._prune(connection)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write to the persistent cache. {e}")
+
+    def _stored_bytes(self, connection: sqlite3.Connection) -> int:
+        (total,) = connection.execute(
+            f"SELECT COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM {self.table}"
+        ).fetchone()
+        return total
+
+    def _prune(self, connection: sqlite3.Connection) -> int:
+        with connection:
+            connection.execute("BEGIN")
+            self.pruned += connection.execute(
+                f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
+            total = self._stored_bytes(connection)
+            if total <= self.max_bytes:
+                return total
+
+            # Drop the oldest entries until a tenth of the budget is free.
+            excess = total - int(self.max_bytes * 0.9)
+            removed = 0
+            keys = []
+            for key, size in connection.execute(
+                f"SELECT key, LENGTH(key) + LENGTH(value) FROM {self.table} "
+                "ORDER BY stored_at"
+            ):
+                keys.append((key,))
+                removed += size
+                if removed >= excess:
+                    break
+
+            connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", keys)
+            self.pruned += len(keys)
+            return total - removed
+
+
+class TieredCache:
+    """
+    In-memory `ResultCache` backed by a `PersistentCache`. Lookups missing the
+    memory tier fall back to disk and promote what they find, new entries are
+    written to both tiers.
+
+    :param memory: In-memory tier
+    :param persistent: Persistent tier
+    :param encode: Converts values of the memory tier to bytes
+    :param decode: Converts bytes of the persistent tier back to values
+    """
+
+    def __init__(
+        self,
+        memory: ResultCache,
+        persistent: PersistentCache,
+        encode: Callable[[Any], bytes] = bytes,
+        decode: Callable[[bytes], Any] = bytes,
+    ):
+        self.memory = memory
+        self.persistent = persistent
+        self.encode = encode
+        self.decode = decode
+
+    def warm(self) -> int:
+        """
+        Fill the memory tier with the newest entries of the persistent tier.
+        :return: Number of loaded entries
+        """
+
+        entries = self.persistent.newest(self.memory.max_bytes)
+        # Insert the oldest entries first, so that the newest are the most
+        # recently used ones in the memory tier.
+        for key, value, expires_at in reversed(entries):
+            self.memory.set(
+                key, self.decode(value), size=len(value), expires_at=expires_at
+            )
+
+        return len(entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for `key` from memory or from disk."""
+
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        stored = self.persistent.get(key)
+        if stored is None:
+            return None
+
+        # The entry keeps the expiry it was stored with.
+        stored_value, expires_at = stored
+        value = self.decode(stored_value)
+        self.memory.set(key, value, size=len(stored_value), expires_at=expires_at)
+        return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl_seconds: Optional[float] = None,
+        size: Optional[int] = None,
+    ) -> bool:
+        """Store `value` under `key` in memory and queue it for the disk."""
+
+        self.persistent.set(
+            key,
+            self.encode(value),
+            self.memory.ttl_seconds if ttl_seconds is None else ttl_seconds,
+        )
+        return self.memory.set(key, value, ttl_seconds=ttl_seconds, size=size)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters of both tiers."""
+
+        stats: Dict[str, Any] = self.memory.stats()
+        stats["persistent"] = self.persistent.stats()
+        return stats
+
+
+def encode_entity_types(entity_types: frozenset) -> bytes:
+    """Serialize a set of entity types for the persistent tier."""
+
+    return "\n".join(sorted(entity_types)).encode()
+
+
+def decode_entity_types(value: bytes) -> frozenset:
+    """Deserialize a set of entity types stored by `encode_entity_types`."""
+
+    return frozenset(value.decode().split("\n")) if value else frozenset()
@@ -0,0 +1,149 @@
+"""Lexical prefilter routing leaf values to the recognizers that could match."""
+
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Tuple
+
+# Entity types whose recognizers only match text containing digits.
+DIGIT_ENTITIES = frozenset(
+    {
+        "CREDIT_CARD",
+        "IBAN_CODE",
+        "PHONE_NUMBER",
+        "US_BANK_NUMBER",
+        "US_DRIVER_LICENSE",
+        "US_ITIN",
+        "US_PASSPORT",
+        "US_SSN",
+    }
+)
+
+# Values shorter than this are not run through the NER model.
+MIN_NER_LENGTH = 4
+
+# Numbers with fewer digits than this cannot be any entity, the shortest
+# phone numbers recognized have 4 digits.
+MIN_NUMBER_DIGITS = 4
+
+_DIGIT = re.compile(r"\d")
+_LETTER = re.compile(r"[^\W\d_]")
+
+
+@dataclass(frozen=True)
+class Route:
+    """
+    Analysis applied to a class of leaf values.
+
+    :param name: Name of the route in the counters
+    :param analyze: Whether the value is analyzed at all
+    :param run_ner: Whether the value is run through the NLP pipeline
+    :param excluded_entities: Entity types that cannot be found in the value
+    """
+
+    name: str
+    analyze: bool = True
+    run_ner: bool = True
+    excluded_entities: FrozenSet[str] = frozenset()
+
+
+FULL = Route("full")
+NO_DIGIT_RECOGNIZERS = Route("no_digit_recognizers", excluded_entities=DIGIT_ENTITIES)
+NO_NER = Route("no_ner", run_ner=False)
+NO_NER_NO_DIGIT_RECOGNIZERS = Route(
+    "no_ner_no_digit_recognizers", run_ner=False, excluded_entities=DIGIT_ENTITIES
+)
+SKIP = Route("skip", analyze=False, run_ner=False)
+
+ROUTES: Tuple[Route, ...] = (
+    FULL,
+    NO_DIGIT_RECOGNIZERS,
+    NO_NER,
+    NO_NER_NO_DIGIT_RECOGNIZERS,
+    SKIP,
+)
+
+
+class LexicalPrefilter:
+    """
+    Classifies leaf values by their character classes and length, to only
+    run the recognizers and the NER model that could find something in them:
+
+    - values without letters or digits cannot contain any entity,
+    - values without digits cannot contain numbers like credit cards or
+      phone numbers, so the recognizers of `DIGIT_ENTITIES` are skipped,
+    - short values and values without letters are not run through the NER
+      model, since names and locations are spelled out in words.
+    """
+
+    def __init__(self):
+        # The counters are shared by the threads serving requests.
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {route.name: 0 for route in ROUTES}
+
+    def route(self, text: str) -> Route:
+        """Return the route of a leaf value."""
+
+        has_digit = _DIGIT.search(text) is not None
+        has_letter = _LETTER.search(text) is not None
+
+        if not has_digit and not has_letter:
+            return SKIP
+        if not has_letter or len(text) < MIN_NER_LENGTH:
+            return NO_NER if has_digit else NO_NER_NO_DIGIT_RECOGNIZERS
+        return FULL if has_digit else NO_DIGIT_RECOGNIZERS
+
+    def record(self, route: Route) -> None:
+        """Count a leaf value analyzed along the route."""
+
+        with self._lock:
+            self.counts[route.name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of analyzed leaf values per route."""
+
+        with self._lock:
+            return dict(self.counts)
+
+
+class TypeFilter:
+    """
+    Drops the leaf values that cannot carry any entity by their JSON type,
+    before they are turned into text:
+
+    - booleans, which are only ever `True` or `False`,
+    - numbers with fewer than `min_number_digits` digits, which are too short
+      for credit cards, SSNs, phone numbers and the like.
+
+    `None` and other empty values are never analyzed in the first place.
+
+    :param min_number_digits: Least number of digits of an analyzed number
+    """
+
+    def __init__(self, min_number_digits: int = MIN_NUMBER_DIGITS):
+        self.min_number_digits = min_number_digits
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {"booleans": 0, "short_numbers": 0}
+
+    def accepts(self, value: Any) -> bool:
+        """Return False for a leaf value that cannot carry any entity."""
+
+        if isinstance(value, bool):
+            dropped = "booleans"
+        elif isinstance(value, (int, float)) and (
+            sum(character.isdigit() for character in str(value))
+            < self.min_number_digits
+        ):
+            dropped = "short_numbers"
+        else:
+            return True
+
+        with self._lock:
+            self.counts[dropped] += 1
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of dropped leaf values per type."""
+
+        with self._lock:
+            return dict(self.counts)
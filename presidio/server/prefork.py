@@ -0,0 +1,280 @@
+"""Pre-fork serving of the analyzer from multiple worker processes."""
+
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from waitress.server import create_server
+
+logger = logging.getLogger("presidio-analyzer")
+
+HEARTBEAT_INTERVAL_SECONDS = 1.0
+
+# Delay before a worker that exited is started again, to avoid a tight loop
+# of crashing workers.
+RESPAWN_DELAY_SECONDS = 1.0
+
+# Longest time a worker finishes its requests after SIGTERM, within the grace
+# period of the container.
+DRAIN_TIMEOUT_SECONDS = 25.0
+
+
+def available_cpus() -> int:
+    """
+    Return the number of CPUs the process may use, taking the CPU limit of the
+    container (cgroup v2 `cpu.max`) into account.
+    """
+
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, round(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+
+    return cpus
+
+
+class _HeartbeatTask:
+    """
+    Task of the waitress dispatcher recording a heartbeat of a worker. It is
+    queued through the event loop and serviced by a request thread, so the
+    heartbeats stop once either of them is stuck.
+    """
+
+    def __init__(self, heartbeats: Any, worker_id: int):
+        self.heartbeats = heartbeats
+        self.worker_id = worker_id
+        self.pending = False
+
+    def service(self) -> None:
+        self.heartbeats[self.worker_id] = time.time()
+        self.pending = False
+
+    def cancel(self) -> None:
+        self.pending = False
+
+
+class PreforkServer:
+    """
+    Serves a WSGI application from several forked worker processes, which
+    accept connections on a listening socket shared with the parent.
+
+    The application, including the NLP models, is loaded once by the parent.
+    Since the workers are forked from it, they share the memory pages of the
+    models copy-on-write. The parent restarts workers that exit or stop
+    sending heartbeats. A worker sends them from its event loop and request
+    threads, so a worker that no longer serves requests is restarted as well.
+
+    On SIGTERM, a worker stops accepting connections and exits once the
+    requests it received are answered, or after `DRAIN_TIMEOUT_SECONDS`.
+
+    :param app: WSGI application to serve
+    :param workers: Number of worker processes
+    :param host: Host to listen on
+    :param port: Port to listen on
+    :param backlog: Backlog of the listening socket
+    :param serve_options: Additional arguments for `waitress.serve`
+    :param after_fork: Called in every worker with its index right after the
+    fork, e.g. to start threads that do not survive a fork
+    :param on_exit: Called in the parent with the index of a worker that
+    exited, before it is started again, e.g. to clear the state it shared
+    :param heartbeat_timeout: Seconds without a heartbeat after which a worker
+    is considered unhealthy and killed
+    """
+
+    def __init__(
+        self,
+        app: Callable,
+        workers: int,
+        host: str,
+        port: int,
+        backlog: int,
+        serve_options: Dict[str, Any],
+        after_fork: Optional[Callable[[int], None]] = None,
+        on_exit: Optional[Callable[[int], None]] = None,
+        heartbeat_timeout: float = 30.0,
+    ):
+        self.app = app
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.serve_options = serve_options
+        self.after_fork = after_fork
+        self.on_exit = on_exit
+        self.heartbeat_timeout = heartbeat_timeout
+
+        # Shared with the workers, so that every worker can report the health
+        # of all workers. A pid of 0 marks a worker that is not running.
+        self._pids = multiprocessing.RawArray("i", workers)
+        self._heartbeats = multiprocessing.RawArray("d", workers)
+        self._stopping = False
+
+    def run(self) -> None:
+        """Start the workers and supervise them until SIGTERM or SIGINT."""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        # Objects created so far are never freed, so keep the garbage
+        # collector from writing to their pages and breaking copy-on-write.
+        gc.collect()
+        gc.freeze()
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id, sock)
+
+        while not self._stopping:
+            self._reap()
+            now = time.time()
+            for worker_id, pid in enumerate(self._pids):
+                if not pid:
+                    self._spawn(worker_id, sock)
+                elif now - self._heartbeats[worker_id] > self.heartbeat_timeout:
+                    logger.error(
+                        f"Worker {worker_id} (pid {pid}) missed its heartbeats, "
+                        f"restarting it"
+                    )
+                    self._kill(pid, signal.SIGKILL)
+            time.sleep(RESPAWN_DELAY_SECONDS)
+
+        for pid in self._pids:
+            if pid:
+                self._kill(pid, signal.SIGTERM)
+        for pid in self._pids:
+            if pid:
+                os.waitpid(pid, 0)
+
+    def health(self) -> List[Dict[str, Any]]:
+        """
+        Return pid and seconds since the last heartbeat of every worker. Can be
+        called from the parent as well as from the workers.
+        """
+
+        now = time.time()
+        return [
+            {
+                "worker": worker_id,
+                "pid": pid or None,
+                "heartbeat_age": now - self._heartbeats[worker_id],
+            }
+            for worker_id, pid in enumerate(self._pids)
+        ]
+
+    def _spawn(self, worker_id: int, sock: socket.socket) -> None:
+        self._heartbeats[worker_id] = time.time()
+        pid = os.fork()
+        if pid:
+            logger.info(f"Started worker {worker_id} with pid {pid}")
+            self._pids[worker_id] = pid
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            if self.after_fork is not None:
+                self.after_fork(worker_id)
+            server = create_server(self.app, sockets=[sock], **self.serve_options)
+            signal.signal(signal.SIGTERM, lambda signum, frame: self._drain(server))
+            threading.Thread(
+                target=self._heartbeat_forever,
+                args=(worker_id, server),
+                name="prefork-heartbeat",
+                daemon=True,
+            ).start()
+            server.run()
+        except BaseException:
+            logger.exception(f"Worker {worker_id} failed")
+        finally:
+            os._exit(1)
+
+    def _heartbeat_forever(self, worker_id: int, server: Any) -> None:
+        task = _HeartbeatTask(self._heartbeats, worker_id)
+        while True:
+            # A stuck worker piles up no more than one heartbeat.
+            if not task.pending:
+                task.pending = True
+                server.trigger.pull_trigger(
+                    lambda: server.task_dispatcher.add_task(task)
+                )
+            time.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+    def _drain(self, server: Any) -> None:
+        # Runs in the event loop, which keeps sending the responses. The
+        # listening socket stays open for the other workers.
+        if not server.accepting:
+            return
+        server.accepting = False
+        threading.Thread(
+            target=self._exit_when_idle, args=(server,), name="prefork-drain"
+        ).start()
+
+    @staticmethod
+    def _exit_when_idle(server: Any) -> None:
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+        dispatcher = server.task_dispatcher
+        while time.monotonic() < deadline:
+            channels = [
+                channel
+                for channel in list(server._map.values())
+                if channel is not server and channel is not server.trigger
+            ]
+            if (
+                not dispatcher.queue
+                and dispatcher.active_count == 0
+                and not any(
+                    channel.requests
+                    or channel.request is not None
+                    or channel.total_outbufs_len
+                    for channel in channels
+                )
+            ):
+                break
+            time.sleep(0.05)
+        else:
+            logger.warning("Stopped a worker with requests still in flight")
+        os._exit(0)
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid in self._pids:
+                worker_id = list(self._pids).index(pid)
+                logger.error(
+                    f"Worker {worker_id} (pid {pid}) exited with status "
+                    f"{os.waitstatus_to_exitcode(status)}"
+                )
+                self._pids[worker_id] = 0
+                if self.on_exit is not None:
+                    self.on_exit(worker_id)
+
+    def _stop(self, signum: int, frame: Any) -> None:
+        self._stopping = True
+
+    @staticmethod
+    def _kill(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -1,21 +1,56 @@
 """REST API server for analyzer."""
 
-import json
+import importlib.metadata
 import logging
 import os
+import re
+import time
+from contextlib import contextmanager
+from itertools import islice
 from logging.config import fileConfig
 from pathlib import Path
-from typing import Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from flask import Flask, Response, jsonify, request
-from flask_caching import Cache
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from opentelemetry import trace
+from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from presidio_analyzer.analyzer_engine import AnalyzerEngine
 from presidio_analyzer.analyzer_request import AnalyzerRequest
-from presidio_analyzer.batch_analyzer_engine import BatchAnalyzerEngine
+from presidio_analyzer.nlp_engine import SpacyNlpEngine
 from presidio_anonymizer import BatchAnonymizerEngine
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 
-from .helpers import convert_all_lists_to_dicts, extract_data_types_from_results
+from . import json_codec, metrics
+from .batch_analyzer import CachingBatchAnalyzerEngine
+from .body_codec import JSON, BodyCodec
+from .cache import ResultCache
+from .cache_key import KeyNormalizer, canonical_digest
+from .concurrency import AdaptiveConcurrencyLimiter
+from .deadline import DEADLINE_HEADER, PARTIAL_HEADER, Deadline, DeadlinePolicy
+from .helpers import extract_data_types_from_results, prune_recognizers
+from .json_codec import FastJSONProvider
+from .metrics import Metrics, RequestProfile
+from .micro_batching import MicroBatchingNlpEngine
+from .pattern_scanner import CombinedPatternScanner
+from .persistent_cache import (
+    PersistentCache,
+    TieredCache,
+    decode_entity_types,
+    encode_entity_types,
+)
+from .prefilter import LexicalPrefilter, TypeFilter
+from .tracing import tracer
 
 data_items_set = [
     "CREDIT_CARD",
@@ -37,6 +72,50 @@ data_items_set = [
 ]
 
 LOGGING_CONF_FILE = "logging.ini"
+CACHE_KEY_RULES_FILE = Path(Path(__file__).parent, "conf", "cache_key_rules.yaml")
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_LEAF_CACHE_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_SUBTREE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_PERSISTENT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MICRO_BATCH_SIZE = 32
+DEFAULT_NLP_BATCH_SIZE = 64
+DEFAULT_MIN_NUMBER_DIGITS = 4
+DEFAULT_STREAM_BATCH_SIZE = 64
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_QUEUE_SECONDS = 0.1
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# Version of the results stored in the caches, part of the fingerprint of
+# persisted entries. Bump it when the server analyzes values differently.
+CACHE_VERSION = 1
+
+# Endpoints running the analyzer, whose requests are profiled.
+ANALYSIS_ENDPOINTS = frozenset(
+    {"analyze", "batch_analyze", "bulk_batch_analyze", "stream_batch_analyze"}
+)
+# Endpoints subject to the concurrency limit. A stream would hold its slot and
+# count as a single latency sample for as long as its client sends lines.
+LIMITED_ENDPOINTS = frozenset({"analyze", "batch_analyze", "bulk_batch_analyze"})
+# Stages of handling analysis requests, timed per request.
+STAGES = (
+    "parse",
+    "lookup",
+    "digest",
+    "cache",
+    "nlp",
+    "recognizers",
+    "extract",
+    "flatten",
+    "serialize",
+)
+
+# Endpoints analyzing a request within its deadline.
+DEADLINE_ENDPOINTS = frozenset({"batch_analyze", "bulk_batch_analyze"})
+# Endpoints whose body names the calling service with `derive_purpose`.
+BODY_PURPOSE_ENDPOINTS = frozenset({"batch_analyze", "bulk_batch_analyze"})
+# First `derive_purpose` string of a JSON body, found without parsing it.
+PURPOSE_PATTERN = re.compile(rb'"derive_purpose"\s*:\s*("(?:[^"\\]|\\.)*")')
 
 WELCOME_MESSAGE = r"""
  _______  _______  _______  _______ _________ ______  _________ _______
@@ -50,6 +129,121 @@ WELCOME_MESSAGE = r"""
 """
 
 
+def create_cache(
+    settings: Dict[str, Any],
+    table: str,
+    max_bytes: int,
+    encode: Callable[[Any], bytes] = bytes,
+    decode: Callable[[bytes], Any] = bytes,
+    fingerprint: str = "",
+) -> Optional[Union[ResultCache, TieredCache]]:
+    """
+    Create one of the caches of the server according to the settings.
+    :param settings: Settings of the server
+    :param table: Name of the table of the cache in the persistent database
+    :param max_bytes: Memory budget of the cache, `0` disables the cache
+    :param encode: Converts cached values to bytes for the persistent database
+    :param decode: Converts bytes of the persistent database to cached values
+    :param fingerprint: Digest of what the cached values depend on, see
+    `analysis_fingerprint`
+    :return: The cache, or `None` if it is disabled
+    """
+
+    if not settings["enable_cache"] or max_bytes <= 0:
+        return None
+
+    cache = ResultCache(
+        max_bytes=max_bytes,
+        ttl_seconds=settings.get("cache_ttl_seconds"),
+        policy=settings.get("cache_policy", "tinylfu"),
+    )
+    if not settings.get("persistent_cache_path"):
+        return cache
+
+    return TieredCache(
+        memory=cache,
+        persistent=PersistentCache(
+            path=settings["persistent_cache_path"],
+            table=table,
+            max_bytes=settings.get(
+                "persistent_cache_max_bytes", DEFAULT_PERSISTENT_CACHE_MAX_BYTES
+            ),
+            fingerprint=fingerprint,
+        ),
+        encode=encode,
+        decode=decode,
+    )
+
+
+def analysis_fingerprint(
+    engine: AnalyzerEngine,
+    key_normalizer: KeyNormalizer,
+    entities: Iterable[str],
+    settings: Dict[str, Any],
+) -> str:
+    """
+    Digest of what cached results depend on: the versions of presidio, of
+    this server and of the NLP models, the recognizers with their patterns,
+    the analyzed entity types, the cache key rules and the settings filtering
+    the analyzed values.
+    :param engine: Analyzer engine with its final registry
+    :param key_normalizer: Normalizer of the cache keys
+    :param entities: Entity types the analyzer looks for
+    :param settings: Settings of the server
+    :return: Hexadecimal digest
+    """
+
+    nlp_engine = engine.nlp_engine
+    models = (
+        {
+            language: [nlp.meta.get("name"), nlp.meta.get("version")]
+            for language, nlp in nlp_engine.nlp.items()
+        }
+        if isinstance(nlp_engine, SpacyNlpEngine)
+        else type(nlp_engine).__name__
+    )
+    recognizers = sorted(
+        [
+            recognizer.name,
+            recognizer.version,
+            recognizer.supported_language,
+            sorted(recognizer.supported_entities),
+            [
+                [pattern.name, pattern.regex, pattern.score]
+                for pattern in getattr(recognizer, "patterns", None) or []
+            ],
+            sorted(getattr(recognizer, "context", None) or []),
+        ]
+        for recognizer in engine.registry.recognizers
+    )
+    fingerprint = {
+        "cache_version": CACHE_VERSION,
+        "presidio_analyzer": importlib.metadata.version("presidio-analyzer"),
+        "models": models,
+        "recognizers": recognizers,
+        # Recognizers of several types stay loaded for any one of them.
+        "entities": sorted(entities),
+        "score_threshold": engine.default_score_threshold,
+        "rules": [
+            [rule.name, rule.paths, rule.action] for rule in key_normalizer.rules
+        ],
+        "lexical_prefilter": settings.get("lexical_prefilter", True),
+        "type_filter": settings.get("type_filter", True),
+        "min_number_digits": settings.get(
+            "min_number_digits", DEFAULT_MIN_NUMBER_DIGITS
+        ),
+    }
+    return canonical_digest(fingerprint).hex()
+
+
+def cache_hits(lookups: List[Tuple[Any, Optional[bytes], Optional[bytes]]]) -> int:
+    """Count the looked up requests answered from the cache, not by an error."""
+    return sum(
+        cache_key is not None and cached_response is not None
+        for _, cache_key, cached_response in lookups
+    )
+
+
 class Server:
     """HTTP Server for calling Presidio Analyzer."""
 
@@ -58,26 +252,268 @@ class Server:
         self.logger = logging.getLogger("presidio-analyzer")
         self.logger.setLevel(os.environ.get("LOG_LEVEL", self.logger.level))
         print("enable cache:  " + str(settings["enable_cache"]))
-        self.cache = Cache(
-            config=(
-                {"CACHE_TYPE": "SimpleCache"}
-                if settings["enable_cache"]
-                else {"CACHE_TYPE": "NullCache", "CACHE_NO_NULL_WARNING": True}
-            )
+        self.key_normalizer = KeyNormalizer.from_file(
+            settings.get("cache_key_rules_file") or CACHE_KEY_RULES_FILE
+        )
+        self.logger.info(
+            "Loaded cache key rules: "
+            + ", ".join(rule.name for rule in self.key_normalizer.rules)
         )
         self.app = Flask(__name__)
+        # Request bodies are parsed once, with orjson when it is installed.
+        self.app.json = FastJSONProvider(self.app)
+        # Instrumented first, so that the request span covers the hooks of
+        # the server, such as parsing the body and queuing.
+        FlaskInstrumentor().instrument_app(
+            self.app,
+            excluded_urls="/health,/stats,/metrics",
+        )
         self.logger.info("Starting analyzer engine")
         self.engine = AnalyzerEngine()
-        self.batch_analyzer = BatchAnalyzerEngine(analyzer_engine=self.engine)
+        # Only the allowlisted entity types are reported by /batchanalyze, so
+        # its engine leaves out the recognizers of other types instead of
+        # filtering their results. The engine of /analyze keeps all of them,
+        # and both share the NLP engine.
+        self.entities = list(settings.get("entities") or data_items_set)
+        self.reported_entities = frozenset(self.entities)
+        registry, pruned = prune_recognizers(self.engine.registry, self.entities)
+        self.logger.info(
+            "Pruned recognizers without reported entity types: " + ", ".join(pruned)
+        )
+        self.batch_engine = AnalyzerEngine(
+            registry=registry,
+            nlp_engine=self.engine.nlp_engine,
+            app_tracer=self.engine.app_tracer,
+            log_decision_process=self.engine.log_decision_process,
+            default_score_threshold=self.engine.default_score_threshold,
+            supported_languages=self.engine.supported_languages,
+            context_aware_enhancer=self.engine.context_aware_enhancer,
+        )
+        self.pattern_scanner = None
+        if settings.get("pattern_scanner"):
+            self.pattern_scanner = CombinedPatternScanner(self.batch_engine.registry)
+            self.logger.info(
+                "Scanning for the patterns of: "
+                + ", ".join(self.pattern_scanner.install())
+            )
+        if isinstance(self.engine.nlp_engine, SpacyNlpEngine):
+            # Number of texts spaCy processes at once when the leaves of a
+            # request are analyzed together.
+            for nlp in self.engine.nlp_engine.nlp.values():
+                nlp.batch_size = settings.get("nlp_batch_size", DEFAULT_NLP_BATCH_SIZE)
+        # Persisted results are only reused by servers analyzing alike.
+        fingerprint = analysis_fingerprint(
+            self.batch_engine, self.key_normalizer, self.entities, settings
+        )
+        self.micro_batching = None
+        if settings.get("micro_batch_wait_seconds"):
+            # Texts of concurrent requests share one run of the NLP pipeline.
+            self.micro_batching = MicroBatchingNlpEngine(
+                self.engine.nlp_engine,
+                max_wait_seconds=settings["micro_batch_wait_seconds"],
+                max_batch_size=settings.get(
+                    "micro_batch_size", DEFAULT_MICRO_BATCH_SIZE
+                ),
+            )
+            self.engine.nlp_engine = self.micro_batching
+            self.batch_engine.nlp_engine = self.micro_batching
+        self.prefilter = (
+            LexicalPrefilter() if settings.get("lexical_prefilter", True) else None
+        )
+        self.type_filter = (
+            TypeFilter(
+                min_number_digits=settings.get(
+                    "min_number_digits", DEFAULT_MIN_NUMBER_DIGITS
+                )
+            )
+            if settings.get("type_filter", True)
+            else None
+        )
+        self.cache = create_cache(
+            settings,
+            table="responses",
+            max_bytes=settings.get("cache_max_bytes", DEFAULT_CACHE_MAX_BYTES),
+            fingerprint=fingerprint,
+        )
+        self.leaf_cache = create_cache(
+            settings,
+            table="leaves",
+            max_bytes=settings.get(
+                "leaf_cache_max_bytes", DEFAULT_LEAF_CACHE_MAX_BYTES
+            ),
+            encode=encode_entity_types,
+            decode=decode_entity_types,
+            fingerprint=fingerprint,
+        )
+        self.subtree_cache = create_cache(
+            settings,
+            table="subtrees",
+            max_bytes=settings.get(
+                "subtree_cache_max_bytes", DEFAULT_SUBTREE_CACHE_MAX_BYTES
+            ),
+            encode=encode_entity_types,
+            decode=decode_entity_types,
+            fingerprint=fingerprint,
+        )
+        for name, cache in (
+            ("response", self.cache),
+            ("leaf", self.leaf_cache),
+            ("subtree", self.subtree_cache),
+        ):
+            if isinstance(cache, TieredCache):
+                self.logger.info(
+                    f"Warmed {name} cache with {cache.warm()} persisted entries"
+                )
+        self.batch_analyzer = CachingBatchAnalyzerEngine(
+            analyzer_engine=self.batch_engine,
+            leaf_cache=self.leaf_cache,
+            subtree_cache=self.subtree_cache,
+            batch_size=settings.get("nlp_batch_size", DEFAULT_NLP_BATCH_SIZE),
+            prefilter=self.prefilter,
+            type_filter=self.type_filter,
+        )
+        self.limiter = None
+        if settings.get("concurrency_limiter", True):
+            self.limiter = AdaptiveConcurrencyLimiter(
+                max_limit=settings.get("max_concurrency", DEFAULT_MAX_CONCURRENCY),
+                max_queue_seconds=settings.get(
+                    "max_queue_seconds", DEFAULT_MAX_QUEUE_SECONDS
+                ),
+                weights=settings.get("purpose_weights"),
+                max_concurrency=settings.get("purpose_concurrency"),
+            )
+        self.deadlines = DeadlinePolicy(settings.get("request_budget_seconds"))
+        # Largest body of a batch request, compressed or not, and largest line
+        # of a streamed one.
+        self.max_body_bytes = settings.get("max_body_bytes", DEFAULT_MAX_BODY_BYTES)
+        # Number of documents of /batchanalyze/stream analyzed together.
+        self.stream_batch_size = settings.get(
+            "stream_batch_size", DEFAULT_STREAM_BATCH_SIZE
+        )
         self.batch_anonymizer = BatchAnonymizerEngine()
-        self.cache.init_app(self.app)
+        self.metrics = Metrics(workers=settings.get("workers", 1))
+        self._create_metrics()
+        # Set when serving from several worker processes.
+        self.workers_health: Optional[Callable[[], List[Dict[str, Any]]]] = None
         self.logger.info(WELCOME_MESSAGE)
 
+        @self.app.before_request
+        def start_profile() -> None:
+            """Start timing the stages of analysis requests."""
+            if request.endpoint in ANALYSIS_ENDPOINTS:
+                g.profile = RequestProfile()
+                g.profile_start = time.perf_counter()
+                self.requests_in_flight.inc()
+                self.request_bytes.observe(request.content_length or 0)
+
+        @self.app.teardown_request
+        def record_profile(e: Optional[BaseException]) -> None:
+            profile = g.pop("profile", None)
+            if profile is None:
+                return
+
+            self.request_seconds[request.endpoint].observe(
+                time.perf_counter() - g.pop("profile_start")
+            )
+            self.requests_in_flight.dec()
+            for stage, seconds in profile.seconds.items():
+                self.stage_seconds[stage].observe(seconds)
+            if profile.leaves:
+                self.document_leaves.observe(profile.leaves)
+            self.metrics.collect()
+
+        @self.app.before_request
+        def start_deadline() -> None:
+            """Start the deadline of analysis requests, queuing included."""
+            if request.endpoint in DEADLINE_ENDPOINTS:
+                g.deadline = self.deadlines.start(
+                    request.headers.get(DEADLINE_HEADER),
+                    request.environ.get("waitress.client_disconnected"),
+                )
+
+        @self.app.before_request
+        def limit_concurrency() -> Optional[Tuple[Response, int, Dict[str, str]]]:
+            """Shed analysis requests beyond the concurrency limit."""
+            if self.limiter is None or request.endpoint not in LIMITED_ENDPOINTS:
+                return None
+
+            g.limiter_purpose = self._purpose()
+            g.limiter_start = self.limiter.acquire(g.limiter_purpose)
+            if g.limiter_start is None:
+                return (
+                    jsonify(error="The analyzer is overloaded, retry later."),
+                    503,
+                    {"Retry-After": str(self.limiter.retry_after())},
+                )
+            return None
+
+        @self.app.teardown_request
+        def release_concurrency(e: Optional[BaseException]) -> None:
+            start = g.pop("limiter_start", None)
+            if start is not None:
+                self.limiter.release(start, g.pop("limiter_purpose"))
+
         @self.app.route("/health")
         def health() -> str:
             """Return basic health probe result."""
             return "Presidio Analyzer service is up"
 
+        @self.app.route("/metrics", methods=["GET"])
+        def prometheus_metrics() -> Response:
+            """Return the metrics of the service in the Prometheus format."""
+            return self.app.response_class(
+                self.metrics.render(), content_type=metrics.CONTENT_TYPE
+            )
+
+        @self.app.route("/stats", methods=["GET"])
+        def stats() -> Tuple[Response, int]:
+            """Return counters of the caches used by the service."""
+            return (
+                jsonify(
+                    response_cache=(
+                        self.cache.stats() if self.cache is not None else None
+                    ),
+                    leaf_cache=(
+                        self.leaf_cache.stats() if self.leaf_cache is not None else None
+                    ),
+                    subtree_cache=(
+                        self.subtree_cache.stats()
+                        if self.subtree_cache is not None
+                        else None
+                    ),
+                    cache_key_rules=self.key_normalizer.stats(),
+                    deduplication=self.batch_analyzer.stats(),
+                    prefilter_routes=(
+                        self.prefilter.stats() if self.prefilter is not None else None
+                    ),
+                    type_filter=(
+                        self.type_filter.stats()
+                        if self.type_filter is not None
+                        else None
+                    ),
+                    concurrency_limiter=(
+                        self.limiter.stats() if self.limiter is not None else None
+                    ),
+                    deadlines=self.deadlines.stats(),
+                    pattern_scanner=(
+                        self.pattern_scanner.stats()
+                        if self.pattern_scanner is not None
+                        else None
+                    ),
+                    micro_batching=(
+                        self.micro_batching.stats()
+                        if self.micro_batching is not None
+                        else None
+                    ),
+                    workers=(
+                        self.workers_health()
+                        if self.workers_health is not None
+                        else None
+                    ),
+                ),
+                200,
+            )
+
         @self.app.route("/analyze", methods=["POST"])
         def analyze() -> Tuple[Response, int]:
             """Execute the analyzer function."""
@@ -150,54 +586,51 @@ class Server:
         def http_exception(e):
             return jsonify(error=e.description), e.code
 
-        def make_cache_key():
-            data = request.get_json()
-            if (
-                data is not None
-                and "json_to_analyze" in data
-                and isinstance(data["json_to_analyze"], dict)
-            ):
-                if "clustername" in data["json_to_analyze"]:
-                    del data["json_to_analyze"]["clustername"]
-                if "podname" in data["json_to_analyze"]:
-                    del data["json_to_analyze"]["podname"]
-
-            return json.dumps(data)
-
         @self.app.route("/batchanalyze", methods=["POST"])
-        @self.cache.cached(make_cache_key=make_cache_key)
         def batch_analyze() -> Tuple[Response, int]:
             """Execute the batch analyzer function."""
+            body_codec = self._body_codec()
             # Parse the request params
             try:
-                request_obj = request.get_json()
-                if (
-                    "json_to_analyze" not in request_obj
-                    or request_obj["json_to_analyze"] is None
-                ):
-                    raise Exception(
-                        "Please set a JSON field named 'json_to_analyze' in the body, with the JSON object "
-                        "to analyze."
+                request_obj = self._load_body(body_codec)
+                with self._stage("lookup") as span:
+                    json_to_analyze, cache_key, cached_response = self._lookup(
+                        request_obj
+                    )
+                    span.set_attribute(
+                        "presidio.cache_hit", cached_response is not None
                     )
+                if cached_response is not None:
+                    return self._respond(body_codec, cached_response), 200
 
-                # Note that this function implementation already adds the key as additional 'context'
-                # for the decision (see batch_analyzer_engine.py line 96)
+                # The key of every value is added as additional 'context' for
+                # the decision. The parsed JSON is traversed as is, without
+                # transforming its lists first.
                 recognizer_result_list = self.batch_analyzer.analyze_dict(
-                    input_dict=convert_all_lists_to_dicts(
-                        request_obj["json_to_analyze"]
-                    ),
+                    input_dict=json_to_analyze,
                     language="en",
+                    entities=self.entities,
+                    deadline=g.deadline,
+                    profile=g.profile,
                 )
 
+                # Stops analyzing as soon as every reported type was found.
                 unique_pii_list = extract_data_types_from_results(
-                    recognizer_result_list
+                    recognizer_result_list, entity_types=self.reported_entities
                 )
 
-                unique_valid_pii_list = [
-                    pii for pii in unique_pii_list if pii in data_items_set
-                ]
+                body = self._serialize(unique_pii_list)
+                if g.deadline.exceeded:
+                    return self._respond_partial(body_codec, body, g.deadline), 200
+                if cache_key is not None:
+                    # Only the serialized body is kept, the response object is
+                    # rebuilt around it on a cache hit.
+                    self.cache.set(cache_key, body)
 
-                return jsonify(unique_valid_pii_list), 200
+                return self._respond(body_codec, body), 200
+            except HTTPException:
+                # Invalid and too large bodies keep their status.
+                raise
             except TypeError as te:
                 error_msg = (
                     f"Failed to parse /batchanalyze request "
@@ -212,3 +645,431 @@ class Server:
                     f"BatchAnalyzer.analyze_dict(). {e}"
                 )
                 return jsonify(error=e.args[0]), 500
+
+        @self.app.route("/batchanalyze/bulk", methods=["POST"])
+        def bulk_batch_analyze() -> Tuple[Response, int]:
+            """
+            Execute the batch analyzer function on an array of requests, and
+            return the array of their entity types.
+            """
+            body_codec = self._body_codec()
+            try:
+                request_objs = self._load_body(body_codec)
+                if not isinstance(request_objs, list):
+                    raise Exception(
+                        "Please send a JSON array of objects with a field named "
+                        "'json_to_analyze' each."
+                    )
+
+                with self._stage(
+                    "lookup", {"presidio.documents": len(request_objs)}
+                ) as span:
+                    lookups = [
+                        self._lookup(request_obj) for request_obj in request_objs
+                    ]
+                    span.set_attribute("presidio.cache_hits", cache_hits(lookups))
+                bodies = self._answer(lookups, deadline=g.deadline)
+
+                # Cached and new bodies are serialized arrays already.
+                body = b"[" + b",".join(body.strip() for body in bodies) + b"]\n"
+                if g.deadline.exceeded:
+                    return self._respond_partial(body_codec, body, g.deadline), 200
+                return self._respond(body_codec, body), 200
+            except HTTPException:
+                # Invalid and too large bodies keep their status.
+                raise
+            except TypeError as te:
+                error_msg = (
+                    f"Failed to parse /batchanalyze/bulk request "
+                    f"for AnalyzerEngine.analyze(). {te.args[0]}"
+                )
+                self.logger.error(error_msg)
+                return jsonify(error=error_msg), 400
+
+            except Exception as e:
+                self.logger.error(
+                    f"A fatal error occurred during execution of "
+                    f"BatchAnalyzer.analyze_dicts(). {e}"
+                )
+                return jsonify(error=e.args[0]), 500
+
+        @self.app.route("/batchanalyze/stream", methods=["POST"])
+        def stream_batch_analyze() -> Tuple[Response, int]:
+            """
+            Execute the batch analyzer function on newline delimited requests,
+            and stream a line with the entity types of every request.
+            """
+
+            # The lines are JSON, possibly compressed as a whole.
+            body_codec = BodyCodec(
+                JSON, request.headers.get("Content-Encoding"), self.max_body_bytes
+            )
+            # Streams have no deadline, but stop when the client is gone.
+            deadline = Deadline(
+                None, request.environ.get("waitress.client_disconnected")
+            )
+
+            def generate() -> Iterator[bytes]:
+                lines = body_codec.lines(request.stream)
+                compressor = body_codec.compressor()
+                error = None
+                while error is None:
+                    batch = []
+                    try:
+                        for line in islice(lines, self.stream_batch_size):
+                            if line.strip():
+                                batch.append(line)
+                    except HTTPException as e:
+                        # A line too long or a body that cannot be
+                        # decompressed. The status is sent already, so the
+                        # lines read before are answered, and the stream ends
+                        # with the error.
+                        self.logger.error(
+                            f"Stopped reading /batchanalyze/stream. {e.description}"
+                        )
+                        error = jsonify(error=e.description).get_data()
+                    if not batch and error is None:
+                        break
+
+                    # A span per batch, the profile times parsing and lookups.
+                    with tracer.start_as_current_span(
+                        "presidio.lookup", attributes={"presidio.lines": len(batch)}
+                    ) as span:
+                        lookups = [self._lookup_line(line) for line in batch]
+                        span.set_attribute("presidio.cache_hits", cache_hits(lookups))
+                    bodies = self._answer(lookups, deadline=deadline)
+                    if deadline.exceeded:
+                        self.deadlines.record(deadline)
+                        self.logger.info(
+                            "Abandoned /batchanalyze/stream, the client disconnected"
+                        )
+                        return
+                    if error is not None:
+                        bodies.append(error)
+                    yield compressor.compress(
+                        b"".join(body.strip() + b"\n" for body in bodies)
+                    )
+                yield compressor.finish()
+
+            # Lines are read and answered a batch at a time, while the server
+            # sends the previous results.
+            return (
+                self.app.response_class(
+                    stream_with_context(generate()),
+                    mimetype="application/x-ndjson",
+                    headers=body_codec.headers(),
+                ),
+                200,
+            )
+
+    def _create_metrics(self) -> None:
+        """Create the metrics of the service, before any worker is forked."""
+
+        self.stage_seconds = {
+            stage: self.metrics.histogram(
+                "presidio_stage_seconds",
+                "Seconds spent per stage of handling an analysis request.",
+                stage=stage,
+            )
+            for stage in STAGES
+        }
+        self.request_seconds = {
+            endpoint: self.metrics.histogram(
+                "presidio_request_seconds",
+                "Seconds to answer analysis requests, queuing included.",
+                endpoint=endpoint,
+            )
+            for endpoint in sorted(ANALYSIS_ENDPOINTS)
+        }
+        self.request_bytes = self.metrics.histogram(
+            "presidio_request_bytes",
+            "Size of the bodies of analysis requests, as sent.",
+            buckets=metrics.SIZE_BUCKETS,
+        )
+        self.document_leaves = self.metrics.histogram(
+            "presidio_request_leaves",
+            "Leaf values analyzed per request, those missing the caches.",
+            buckets=metrics.COUNT_BUCKETS,
+        )
+        self.requests_in_flight = self.metrics.gauge(
+            "presidio_requests_in_flight",
+            "Analysis requests being answered, queued ones included.",
+        )
+
+        for name, cache in (
+            ("response", self.cache),
+            ("leaf", self.leaf_cache),
+            ("subtree", self.subtree_cache),
+        ):
+            if cache is not None:
+                self._collect_cache(name, cache)
+
+        if self.limiter is not None:
+            limiter = self.limiter
+            limit = self.metrics.gauge(
+                "presidio_concurrency_limit",
+                "Current adaptive limit of concurrent analysis requests.",
+            )
+            in_flight = self.metrics.gauge(
+                "presidio_concurrency_in_flight",
+                "Analysis requests holding a slot of the concurrency limit.",
+            )
+            queued = self.metrics.gauge(
+                "presidio_concurrency_queued",
+                "Analysis requests waiting for a slot of the concurrency limit.",
+            )
+            shed = self.metrics.counter(
+                "presidio_concurrency_shed_total",
+                "Analysis requests rejected beyond the concurrency limit.",
+            )
+
+            def collect_limiter() -> None:
+                limit.set(int(limiter.limit))
+                in_flight.set(limiter.in_flight)
+                queued.set(limiter.queue_depth)
+                shed.set(limiter.shed)
+
+            self.metrics.add_collector(collect_limiter)
+
+        deadlines = self.deadlines
+        partial = self.metrics.counter(
+            "presidio_partial_responses_total",
+            "Analysis requests answered partially at their deadline.",
+        )
+        abandoned = self.metrics.counter(
+            "presidio_abandoned_requests_total",
+            "Analysis requests abandoned as their client disconnected.",
+        )
+
+        def collect_deadlines() -> None:
+            partial.set(deadlines.partial)
+            abandoned.set(deadlines.abandoned)
+
+        self.metrics.add_collector(collect_deadlines)
+
+    def _collect_cache(self, name: str, cache: Union[ResultCache, TieredCache]) -> None:
+        """Copy the counters of a cache into the metrics."""
+
+        # Only the memory tier is read, which does not touch the disk.
+        memory = cache.memory if isinstance(cache, TieredCache) else cache
+        counters = {
+            counter: self.metrics.counter(
+                f"presidio_cache_{counter}_total",
+                f"Cache {counter} per cache.",
+                cache=name,
+            )
+            for counter in ("hits", "misses", "evictions", "expirations")
+        }
+        gauges = {
+            gauge: self.metrics.gauge(
+                f"presidio_cache_{gauge}", f"Cache {gauge} per cache.", cache=name
+            )
+            for gauge in ("entries", "bytes")
+        }
+
+        def collect_cache() -> None:
+            stats = memory.stats()
+            for counter, metric in counters.items():
+                metric.set(stats[counter])
+            for gauge, metric in gauges.items():
+                metric.set(stats[gauge])
+
+        self.metrics.add_collector(collect_cache)
+
+    def _body_codec(self) -> BodyCodec:
+        """Return the codec of the request body, 415 if it is not supported."""
+        return BodyCodec(
+            request.mimetype,
+            request.headers.get("Content-Encoding"),
+            self.max_body_bytes,
+        )
+
+    def _load_body(self, body_codec: BodyCodec) -> Any:
+        """Parse the request body with its codec."""
+
+        with self._stage(
+            "parse",
+            {
+                "presidio.payload_bytes": request.content_length or 0,
+                "presidio.content_type": body_codec.content_type,
+                "presidio.content_encoding": body_codec.content_encoding,
+            },
+        ):
+            if (request.content_length or 0) > self.max_body_bytes:
+                raise RequestEntityTooLarge(
+                    f"The body exceeds {self.max_body_bytes} bytes"
+                )
+            if body_codec.is_plain_json:
+                return request.get_json()
+            return body_codec.load(request.stream)
+
+    @contextmanager
+    def _stage(
+        self, stage: str, attributes: Optional[Dict[str, Any]] = None
+    ) -> Iterator[trace.Span]:
+        """Time a stage of the request, in its profile and in a span."""
+
+        with (
+            tracer.start_as_current_span(
+                f"presidio.{stage}", attributes=attributes
+            ) as span,
+            g.profile.time(stage),
+        ):
+            yield span
+
+    def _purpose(self) -> str:
+        """
+        Return the calling service of an analysis request, by its
+        `X-Derive-Purpose` header or else the first `derive_purpose` in its
+        body. The body is searched before the limit sheds the request, so it
+        is not parsed, and only uncompressed JSON bodies are searched.
+        """
+
+        purpose = request.headers.get("X-Derive-Purpose")
+        if (
+            purpose is None
+            and request.endpoint in BODY_PURPOSE_ENDPOINTS
+            and request.mimetype in ("", JSON)
+            and (request.headers.get("Content-Encoding") or "identity").lower()
+            == "identity"
+            and (request.content_length or 0) <= self.max_body_bytes
+        ):
+            # Kept for parsing the body, unless the request is shed.
+            match = PURPOSE_PATTERN.search(request.get_data())
+            if match:
+                try:
+                    purpose = json_codec.loads(match.group(1))
+                except ValueError:
+                    # Not a valid string, the body is reported as invalid.
+                    purpose = None
+        return purpose if isinstance(purpose, str) else ""
+
+    def _serialize(self, unique_pii_list: Set[str]) -> bytes:
+        """Serialize the reported entity types found in a document."""
+
+        with g.profile.time("serialize"):
+            return jsonify(
+                [pii for pii in unique_pii_list if pii in self.reported_entities]
+            ).get_data()
+
+    def _respond(self, body_codec: BodyCodec, json_body: bytes) -> Response:
+        """Return a response body serialized as JSON like the request body."""
+
+        if body_codec.is_plain_json:
+            return self.app.response_class(json_body, mimetype="application/json")
+        with g.profile.time("serialize"):
+            return self.app.response_class(
+                body_codec.dump(json_body),
+                mimetype=body_codec.content_type,
+                headers=body_codec.headers(),
+            )
+
+    def _respond_partial(
+        self, body_codec: BodyCodec, json_body: bytes, deadline: Deadline
+    ) -> Response:
+        """
+        Return the entity types found before the deadline, flagged as
+        partial. They are not cached.
+        """
+
+        self.deadlines.record(deadline)
+        trace.get_current_span().set_attribute("presidio.partial", True)
+        if deadline.disconnected:
+            self.logger.info(f"Abandoned {request.path}, the client disconnected")
+        else:
+            self.logger.warning(f"Answered {request.path} partially at its deadline")
+
+        response = self._respond(body_codec, json_body)
+        response.headers[PARTIAL_HEADER] = "true"
+        return response
+
+    def _lookup_line(self, line: bytes) -> Tuple[Any, Optional[bytes], Optional[bytes]]:
+        """
+        Parse a line of /batchanalyze/stream and look up its cached response.
+        A line that cannot be analyzed is answered by its error instead.
+        """
+
+        try:
+            with g.profile.time("parse"):
+                request_obj = json_codec.loads(line)
+            with g.profile.time("lookup"):
+                return self._lookup(request_obj)
+        except Exception as e:
+            self.logger.error(
+                f"Failed to parse /batchanalyze/stream line for "
+                f"BatchAnalyzer.analyze_dicts(). {e}"
+            )
+            return None, None, jsonify(error=str(e)).get_data()
+
+    def _answer(
+        self,
+        lookups: List[Tuple[Any, Optional[bytes], Optional[bytes]]],
+        deadline: Optional[Deadline] = None,
+    ) -> List[bytes]:
+        """
+        Answer looked up /batchanalyze requests. The documents missing the
+        cache are analyzed together, so their values share the NLP batches.
+        :param lookups: Results of `_lookup` for the requests
+        :param deadline: Stops the analysis once expired, the documents
+        missing the cache are answered partially then
+        :return: Serialized entity types of every request
+        """
+
+        bodies: List[Optional[bytes]] = []
+        # Index, document and cache key of the requests missing the cache.
+        misses: List[Tuple[int, Any, Optional[bytes]]] = []
+        for json_to_analyze, cache_key, cached_response in lookups:
+            if cached_response is None:
+                misses.append((len(bodies), json_to_analyze, cache_key))
+            bodies.append(cached_response)
+
+        unique_pii_lists: List[Set[str]] = [set() for _ in misses]
+        for position, result in self.batch_analyzer.analyze_dicts(
+            input_dicts=[json_to_analyze for _, json_to_analyze, _ in misses],
+            language="en",
+            entities=self.entities,
+            deadline=deadline,
+            profile=g.profile,
+        ):
+            unique_pii_lists[position].update(extract_data_types_from_results([result]))
+
+        for (index, _, cache_key), unique_pii_list in zip(misses, unique_pii_lists):
+            body = self._serialize(unique_pii_list)
+            if cache_key is not None and not (deadline and deadline.exceeded):
+                self.cache.set(cache_key, body)
+            bodies[index] = body
+
+        return bodies
+
+    def _lookup(self, request_obj: Any) -> Tuple[Any, Optional[bytes], Optional[bytes]]:
+        """
+        Validate a /batchanalyze request and look up its cached response.
+        The caller times the lookup, with a span per request or batch.
+        :param request_obj: Parsed request body
+        :return: Document to analyze, cache key and cached response body, the
+        latter two are `None` without cache and on a miss respectively
+        """
+
+        if (
+            not isinstance(request_obj, dict)
+            or "json_to_analyze" not in request_obj
+            or request_obj["json_to_analyze"] is None
+        ):
+            raise Exception(
+                "Please set a JSON field named 'json_to_analyze' in the body, with the JSON object "
+                "to analyze."
+            )
+
+        normalized = self.key_normalizer.normalize(request_obj["json_to_analyze"])
+
+        # The key is computed once per request and only depends on the
+        # normalized document, not on the order of its keys.
+        if self.cache is None:
+            return normalized.document, None, None
+
+        cache_key = canonical_digest(normalized.key_document)
+        cached_response = self.cache.get(cache_key)
+        self.key_normalizer.record(
+            normalized, cache_key, hit=cached_response is not None
+        )
+        return normalized.document, cache_key, cached_response
@@ -0,0 +1,52 @@
+"""Tracing of the server with OpenTelemetry."""
+
+import time
+from typing import Optional
+
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+# Spans of the stages of the analysis. Before `setup_tracing`, and without it,
+# the tracer creates no spans.
+tracer = trace.get_tracer("presidio-analyzer")
+
+
+def setup_tracing(
+    sample_ratio: float = 1.0, exporter: Optional[SpanExporter] = None
+) -> TracerProvider:
+    """
+    Export the spans of the service.
+
+    Requests without a sampled parent are traced at the given ratio, decided
+    by their trace id. Requests whose caller traces them are always traced,
+    those whose caller does not trace them never are, so traces stay complete
+    across services.
+
+    :param sample_ratio: Share of requests traced, from 0 to 1
+    :param exporter: Exporter of the spans, OTLP over HTTP by default
+    :return: The tracer provider
+    """
+
+    processor = BatchSpanProcessor(exporter or OTLPSpanExporter())
+
+    provider = TracerProvider(
+        resource=Resource.create(
+            {
+                SERVICE_NAME: "prose.presidio",
+            }
+        ),
+        sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+    )
+    provider.add_span_processor(processor)
+
+    trace.set_tracer_provider(provider)
+    return provider
+
+
+def epoch_ns(perf_counter_time: float) -> int:
+    """Convert a time of `time.perf_counter` to nanoseconds since the epoch."""
+    return time.time_ns() - int((time.perf_counter() - perf_counter_time) * 1e9)
@@ -0,0 +1,225 @@
+"""Tests of the batch analysis of JSON documents."""
+
+from typing import List, Optional
+
+from presidio_analyzer import RecognizerResult
+
+from server.batch_analyzer import CachingBatchAnalyzerEngine
+from server.cache import ResultCache
+from server.helpers import extract_data_types_from_results
+
+
+class FakeNlpEngine:
+    """NLP engine returning no artifacts, recording its batches."""
+
+    def __init__(self):
+        self.batches: List[List[str]] = []
+
+    def process_batch(self, texts, language):
+        self.batches.append(list(texts))
+        return [(text, None) for text in texts]
+
+
+class FakeAnalyzerEngine:
+    """
+    Analyzer finding an email address in values with an `@`, and a person in
+    capitalized values, recording the analyzed values with their context.
+    """
+
+    def __init__(self):
+        self.nlp_engine = FakeNlpEngine()
+        self.calls: List[tuple] = []
+
+    def analyze(self, text, language, context=None, **kwargs):
+        self.calls.append((tuple(context or ()), text))
+        results = []
+        if "@" in text:
+            results.append(RecognizerResult("EMAIL_ADDRESS", 0, len(text), 1.0))
+        if text[:1].isupper():
+            results.append(RecognizerResult("PERSON", 0, len(text), 0.8))
+        return results
+
+
+def batch_engine(
+    leaf_cache: Optional[ResultCache] = None, **kwargs
+) -> CachingBatchAnalyzerEngine:
+    return CachingBatchAnalyzerEngine(
+        analyzer_engine=FakeAnalyzerEngine(), leaf_cache=leaf_cache, **kwargs
+    )
+
+
+def cache() -> ResultCache:
+    return ResultCache(max_bytes=1_000_000, policy="lru")
+
+
+def entity_types(engine: CachingBatchAnalyzerEngine, document) -> set:
+    return extract_data_types_from_results(engine.analyze_dict(document, "en"))
+
+
+DOCUMENT = {
+    "user": {"name": "Alice", "email": "alice@example.com"},
+    "message": "hello",
+    "tags": ["x", "Bob"],
+}
+
+
+def test_leaf_cache_returns_the_entity_types_of_an_uncached_run():
+    uncached = batch_engine()
+    cached = batch_engine(leaf_cache=cache())
+
+    expected = entity_types(uncached, DOCUMENT)
+    assert expected == {"PERSON", "EMAIL_ADDRESS"}
+    assert entity_types(cached, DOCUMENT) == expected
+    assert entity_types(cached, DOCUMENT) == expected
+
+    # Every leaf is analyzed by the first run only.
+    assert len(cached.analyzer_engine.calls) == len(uncached.analyzer_engine.calls)
+    assert len(cached.analyzer_engine.calls) == 5
+
+
+def test_leaf_cache_results_are_sets_of_entity_types():
+    engine = batch_engine(leaf_cache=cache())
+
+    results = {
+        result.key: result.recognizer_results
+        for result in engine.analyze_dict({"name": "Alice", "other": "x"}, "en")
+    }
+
+    assert results == {"name": {"PERSON"}, "other": frozenset()}
+
+
+def test_leaf_cache_is_keyed_by_the_dictionary_key_of_the_value():
+    engine = batch_engine(leaf_cache=cache())
+
+    entity_types(engine, {"name": "Alice"})
+    entity_types(engine, {"name": "Alice", "author": "Alice"})
+
+    # The key is the context of the analysis, so it is part of the cache key.
+    assert engine.analyzer_engine.calls == [
+        (("name",), "Alice"),
+        (("author",), "Alice"),
+    ]
+
+
+def test_subtree_cache_answers_shared_objects_as_a_whole():
+    uncached = batch_engine()
+    cached = batch_engine(subtree_cache=cache())
+    shared = {"name": "Alice", "email": "alice@example.com"}
+    first = {"author": shared, "message": "hello"}
+    # The same object with its keys in another order, in another document.
+    second = {"reviewer": {"email": "alice@example.com", "name": "Alice"}, "id": "a"}
+
+    assert entity_types(cached, first) == entity_types(uncached, first)
+    calls = len(cached.analyzer_engine.calls)
+    assert entity_types(cached, second) == entity_types(uncached, second)
+
+    # Only the value outside of the shared object is analyzed again.
+    assert cached.analyzer_engine.calls[calls:] == [(("id",), "a")]
+    results = {
+        result.key: result.recognizer_results
+        for result in cached.analyze_dict(second, "en")
+    }
+    assert results["reviewer"] == {"PERSON", "EMAIL_ADDRESS"}
+
+
+def test_subtree_cache_is_not_used_with_keys_to_skip():
+    engine = batch_engine(subtree_cache=cache())
+    document = {"user": {"name": "Alice"}, "secret": "Bob"}
+
+    entity_types(engine, document)
+    results = list(engine.analyze_dict(document, "en", keys_to_skip=["secret"]))
+
+    assert [result.key for result in results] == ["user.name"]
+    assert len(engine.analyzer_engine.calls) == 3
+
+
+def test_leaves_share_nlp_batches():
+    engine = batch_engine()
+
+    assert entity_types(engine, DOCUMENT) == {"PERSON", "EMAIL_ADDRESS"}
+
+    # All values of the document run through the NLP pipeline at once.
+    assert engine.analyzer_engine.nlp_engine.batches == [
+        ["Alice", "alice@example.com", "hello", "x", "Bob"]
+    ]
+
+
+def test_batch_size_bounds_the_nlp_batches():
+    engine = batch_engine(batch_size=2)
+
+    assert entity_types(engine, DOCUMENT) == entity_types(batch_engine(), DOCUMENT)
+
+    batches = engine.analyzer_engine.nlp_engine.batches
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert len(engine.analyzer_engine.calls) == 5
+
+
+def test_extraction_stops_once_every_reported_type_was_found():
+    document = {"name": "Alice", **{f"value{index}": "x" for index in range(10)}}
+    full = batch_engine()
+    early = batch_engine(batch_size=2)
+
+    assert extract_data_types_from_results(full.analyze_dict(document, "en")) == {
+        "PERSON"
+    }
+    found = extract_data_types_from_results(
+        early.analyze_dict(document, "en"), entity_types={"PERSON"}
+    )
+
+    assert found == {"PERSON"}
+    assert len(full.analyzer_engine.calls) == 11
+    # Neither the remaining values nor their NLP batches are analyzed.
+    assert early.analyzer_engine.calls == [(("name",), "Alice")]
+    assert len(early.analyzer_engine.nlp_engine.batches) == 1
+
+
+def test_extraction_merges_cached_sets_and_recognizer_results():
+    engine = batch_engine(subtree_cache=cache())
+    entity_types(engine, {"user": {"name": "Alice"}})
+
+    # The subtree is a cached set, the new leaf has recognizer results.
+    results = list(
+        engine.analyze_dict(
+            {"user": {"name": "Alice"}, "email": "alice@example.com"}, "en"
+        )
+    )
+
+    assert [type(result.recognizer_results) for result in results] == [
+        frozenset,
+        list,
+    ]
+    assert extract_data_types_from_results(iter(results)) == {
+        "PERSON",
+        "EMAIL_ADDRESS",
+    }
+
+
+def test_repeated_values_are_analyzed_once_per_request():
+    engine = batch_engine()
+    document = {
+        "rows": [{"name": "Alice"}, {"name": "Alice"}, {"name": "Bob"}],
+        "author": "Alice",
+    }
+
+    results = list(engine.analyze_dict(document, "en"))
+
+    # Repeats under the same key share the analysis of the first occurrence,
+    # the same value under another key has a context of its own.
+    assert engine.analyzer_engine.calls == [
+        (("name",), "Alice"),
+        (("name",), "Bob"),
+        (("author",), "Alice"),
+    ]
+    assert engine.analyzer_engine.nlp_engine.batches == [["Alice", "Bob"]]
+    assert [result.key for result in results] == [
+        "rows.0.name",
+        "rows.1.name",
+        "rows.2.name",
+        "author",
+    ]
+    assert results[1].recognizer_results == results[0].recognizer_results
+    assert extract_data_types_from_results(iter(results)) == {"PERSON"}
+
+    stats = engine.stats()
+    assert (stats["leaf_values"], stats["duplicate_leaf_values"]) == (4, 1)
+    assert stats["duplicate_ratio"] == 0.25
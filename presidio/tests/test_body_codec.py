@@ -0,0 +1,169 @@
+"""Tests of the decoding of compressed and binary request bodies."""
+
+import gzip
+import io
+
+import cbor2
+import msgpack
+import pytest
+import zstandard
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+from server import body_codec
+from server.body_codec import CBOR, JSON, MSGPACK, READ_SIZE, BodyCodec
+
+
+def compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data)
+    return zstandard.ZstdCompressor().compress(data)
+
+
+@pytest.mark.parametrize(
+    "content_type, content_encoding",
+    [("text/plain", None), (JSON, "br"), (JSON, "deflate")],
+)
+def test_unsupported_types_and_encodings_are_rejected(content_type, content_encoding):
+    with pytest.raises(UnsupportedMediaType):
+        BodyCodec(content_type, content_encoding)
+
+
+@pytest.mark.parametrize(
+    "module, content_type, content_encoding",
+    [
+        ("zstandard", JSON, "zstd"),
+        ("msgpack", MSGPACK, None),
+        ("cbor2", CBOR, None),
+    ],
+)
+def test_codecs_of_missing_modules_are_unsupported(
+    monkeypatch, module, content_type, content_encoding
+):
+    monkeypatch.setattr(body_codec, module, None)
+
+    with pytest.raises(UnsupportedMediaType, match=module):
+        BodyCodec(content_type, content_encoding)
+
+
+def test_defaults_to_uncompressed_json():
+    codec = BodyCodec(None, " GZIP ")
+
+    assert codec.content_type == JSON
+    assert codec.content_encoding == "gzip"
+    assert not codec.is_plain_json
+    assert BodyCodec("", "").is_plain_json
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_loads_compressed_bodies(encoding):
+    body = compress(encoding, b'{"json_to_analyze": {"a": "b"}}')
+
+    assert BodyCodec(JSON, encoding, max_bytes=1024).load(io.BytesIO(body)) == {
+        "json_to_analyze": {"a": "b"}
+    }
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_bodies_expanding_beyond_the_limit_are_too_large(encoding):
+    # Compresses to about a thousandth of its size.
+    body = compress(encoding, b'{"a": "' + b"x" * 1_000_000 + b'"}')
+    assert len(body) < 10_000
+
+    with pytest.raises(RequestEntityTooLarge):
+        BodyCodec(JSON, encoding, max_bytes=100_000).load(io.BytesIO(body))
+
+
+def test_bodies_of_the_limit_are_read():
+    data = b'"' + b"x" * 98 + b'"'
+
+    codec = BodyCodec(JSON, "gzip", max_bytes=len(data))
+
+    assert codec.read(io.BytesIO(gzip.compress(data))) == data
+    with pytest.raises(RequestEntityTooLarge):
+        BodyCodec(JSON, "gzip", max_bytes=len(data) - 1).read(
+            io.BytesIO(gzip.compress(data))
+        )
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_corrupt_compressed_bodies_are_bad_requests(encoding):
+    with pytest.raises(BadRequest, match=f"Invalid {encoding} body"):
+        BodyCodec(JSON, encoding).load(io.BytesIO(b"not compressed"))
+
+
+@pytest.mark.parametrize(
+    "content_type, body",
+    [(JSON, b'{"a": '), (MSGPACK, b"\xc1"), (CBOR, b"\xff")],
+)
+def test_malformed_bodies_are_bad_requests(content_type, body):
+    with pytest.raises(BadRequest, match=f"Invalid {content_type} body"):
+        BodyCodec(content_type, None).load(io.BytesIO(body))
+
+
+@pytest.mark.parametrize(
+    "content_type, document, message",
+    [
+        (MSGPACK, {"a": [b"binary"]}, "bytes value at 'a.0'"),
+        (CBOR, {"a": {"b": b"binary"}}, "bytes value at 'a.b'"),
+        (CBOR, {"a": cbor2.CBORTag(4000, "x")}, "CBORTag value at 'a'"),
+        (CBOR, {"a": {1: "x"}}, "int key in 'a'"),
+        (CBOR, {(1, 2): "x"}, "tuple key in ''"),
+    ],
+)
+def test_values_json_does_not_have_are_bad_requests(content_type, document, message):
+    if content_type == MSGPACK:
+        body = msgpack.packb(document, use_bin_type=True)
+    else:
+        body = cbor2.dumps(document)
+
+    with pytest.raises(BadRequest, match=message):
+        BodyCodec(content_type, None).load(io.BytesIO(body))
+
+
+def test_lines_are_limited_one_at_a_time():
+    lines = b"x" * 10 + b"\n" + b"y" * 10 + b"\n" + b"z" * 11 + b"\n"
+    codec = BodyCodec(JSON, "gzip", max_bytes=10)
+
+    read = codec.lines(io.BytesIO(gzip.compress(lines)))
+
+    assert next(read) == b"x" * 10 + b"\n"
+    assert next(read) == b"y" * 10 + b"\n"
+    with pytest.raises(RequestEntityTooLarge):
+        next(read)
+
+
+def test_lines_of_a_truncated_body_end_with_bad_request():
+    lines = b"".join(b"%d\n" % index for index in range(100_000))
+    body = gzip.compress(lines)[: 2 * READ_SIZE]
+
+    read = BodyCodec(JSON, "gzip").lines(io.BytesIO(body))
+
+    # The lines before the cut are read.
+    assert next(read) == b"0\n"
+    with pytest.raises(BadRequest, match="Invalid gzip body"):
+        list(read)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_lines_of_a_corrupt_body_are_bad_requests(encoding):
+    read = BodyCodec(JSON, encoding).lines(io.BytesIO(b"not compressed\n"))
+
+    with pytest.raises(BadRequest, match=f"Invalid {encoding} body"):
+        next(read)
+
+
+def test_last_line_without_newline_is_read():
+    codec = BodyCodec(JSON, None, max_bytes=10)
+
+    assert list(codec.lines(io.BytesIO(b"a\nbc"))) == [b"a\n", b"bc"]
+
+
+@pytest.mark.parametrize("content_type", [MSGPACK, CBOR])
+@pytest.mark.parametrize("encoding", [None, "gzip", "zstd"])
+def test_responses_are_encoded_like_requests(content_type, encoding):
+    codec = BodyCodec(content_type, encoding)
+
+    body = codec.dump(b'["EMAIL_ADDRESS"]')
+
+    assert codec.load(io.BytesIO(body)) == ["EMAIL_ADDRESS"]
+    assert codec.headers() == ({"Content-Encoding": encoding} if encoding else {})
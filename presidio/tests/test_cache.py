@@ -0,0 +1,124 @@
+"""Tests of the bounded result cache."""
+
+import time
+
+from server.cache import ENTRY_OVERHEAD_BYTES, ResultCache
+
+
+def entry_size(key: str, value: bytes) -> int:
+    return len(key) + len(value) + ENTRY_OVERHEAD_BYTES
+
+
+def test_counts_the_bytes_of_keys_values_and_overhead():
+    cache = ResultCache(max_bytes=10_000, policy="lru")
+
+    assert cache.set("a", b"x" * 100)
+    assert cache.set("bb", b"y" * 10)
+
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] == entry_size("a", b"x" * 100) + entry_size("bb", b"y" * 10)
+
+
+def test_replacing_an_entry_releases_its_bytes():
+    cache = ResultCache(max_bytes=10_000, policy="lru")
+
+    cache.set("a", b"x" * 100)
+    cache.set("a", b"x" * 10)
+
+    assert cache.stats()["bytes"] == entry_size("a", b"x" * 10)
+    assert cache.get("a") == b"x" * 10
+
+
+def test_explicit_size_overrides_the_length_of_the_value():
+    cache = ResultCache(max_bytes=10_000, policy="lru")
+
+    cache.set("a", {"not": "bytes"}, size=500)
+
+    assert cache.stats()["bytes"] == 500 + len("a") + ENTRY_OVERHEAD_BYTES
+
+
+def test_lru_evicts_the_least_recently_used_entries():
+    value = b"x" * 100
+    cache = ResultCache(max_bytes=3 * entry_size("a", value), policy="lru")
+    for key in "abc":
+        cache.set(key, value)
+
+    # Reading "a" makes "b" the least recently used entry.
+    cache.get("a")
+    cache.set("d", value)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == value
+    assert cache.get("c") == value
+    assert cache.get("d") == value
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 3 * entry_size("a", value)
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+def test_evicts_as_many_entries_as_a_large_value_needs():
+    small = b"x" * 100
+    cache = ResultCache(max_bytes=4 * entry_size("a", small), policy="lru")
+    for key in "abcd":
+        cache.set(key, small)
+
+    large = b"y" * (2 * len(small) + ENTRY_OVERHEAD_BYTES)
+    assert cache.set("e", large)
+
+    assert len(cache) == 3
+    assert cache.stats()["evictions"] == 2
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+
+
+def test_rejects_values_larger_than_the_cache():
+    cache = ResultCache(max_bytes=1_000, policy="lru")
+
+    assert not cache.set("a", b"x" * 1_000)
+    assert len(cache) == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_tinylfu_keeps_popular_entries_over_one_off_keys():
+    value = b"x" * 100
+    cache = ResultCache(max_bytes=2 * entry_size("a", value), policy="tinylfu")
+    cache.set("a", value)
+    cache.set("b", value)
+    for _ in range(5):
+        cache.get("a")
+        cache.get("b")
+
+    # Requested once only, less often than the entry it would evict.
+    cache.get("c")
+    assert not cache.set("c", value)
+
+    assert cache.stats()["rejections"] == 1
+    assert cache.get("a") == value
+    assert cache.get("b") == value
+
+
+def test_expired_entries_are_missing():
+    cache = ResultCache(max_bytes=10_000, ttl_seconds=60, policy="lru")
+    cache.set("a", b"x")
+    cache.set("b", b"y", ttl_seconds=0.01)
+    time.sleep(0.02)
+
+    assert cache.get("a") == b"x"
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert stats["bytes"] == entry_size("a", b"x")
+
+
+def test_counts_hits_and_misses():
+    cache = ResultCache(max_bytes=10_000)
+    cache.set("a", b"x")
+
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["sets"]) == (2, 1, 1)
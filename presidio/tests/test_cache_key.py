@@ -0,0 +1,171 @@
+"""Tests of the rules normalizing cache keys."""
+
+import sys
+
+import pytest
+
+from server.cache_key import KeyNormalizer, KeyRule, canonical_digest
+
+
+def normalizer(*rules: KeyRule) -> KeyNormalizer:
+    return KeyNormalizer(list(rules))
+
+
+def test_canonical_digest_ignores_the_order_of_keys():
+    assert canonical_digest({"a": 1, "b": [1, 2]}) == canonical_digest(
+        {"b": [1, 2], "a": 1}
+    )
+    assert canonical_digest({"a": [1, 2]}) != canonical_digest({"a": [2, 1]})
+
+
+def test_drop_removes_the_field_from_the_document_and_the_key():
+    normalized = normalizer(KeyRule("replica", ["podname"], "drop")).normalize(
+        {"podname": "pod-1", "message": "hello"}
+    )
+
+    assert normalized.document == {"message": "hello"}
+    assert normalized.key_document == {"message": "hello"}
+    assert normalized.applied_rules == {0}
+
+
+def test_exclude_removes_the_field_from_the_key_only():
+    normalized = normalizer(KeyRule("ids", ["request_id"], "exclude")).normalize(
+        {"request_id": "1234", "message": "hello"}
+    )
+
+    assert normalized.document == {"request_id": "1234", "message": "hello"}
+    assert normalized.key_document == {"message": "hello"}
+
+
+def test_exclude_moves_the_following_list_elements_up():
+    normalized = normalizer(KeyRule("second", ["items.1"], "exclude")).normalize(
+        {"items": ["a", "b", "c"]}
+    )
+
+    assert normalized.document == {"items": ["a", "b", "c"]}
+    assert normalized.key_document == {"items": ["a", "c"]}
+
+
+@pytest.mark.parametrize(
+    "value, marker",
+    [
+        ("2024-01-01", "<string>"),
+        (3, "<integer>"),
+        (1.5, "<number>"),
+        (True, "<boolean>"),
+        (None, "<null>"),
+        ({"seconds": 1}, "<object>"),
+        ([1], "<array>"),
+    ],
+)
+def test_placeholder_replaces_the_value_by_its_type_in_the_key(value, marker):
+    normalized = normalizer(KeyRule("time", ["timestamp"], "placeholder")).normalize(
+        {"timestamp": value}
+    )
+
+    assert normalized.document == {"timestamp": value}
+    assert normalized.key_document == {"timestamp": marker}
+
+
+def test_globs_match_keys_and_list_indexes_at_any_depth():
+    normalized = normalizer(
+        KeyRule("ids", ["**.request_id"], "exclude"),
+        KeyRule("reviews", ["reviews.*.timestamp"], "placeholder"),
+    ).normalize(
+        {
+            "request_id": 1,
+            "nested": {"deeper": {"request_id": 2, "kept": 3}},
+            "reviews": [{"timestamp": "t1", "text": "a"}, {"timestamp": "t2"}],
+        }
+    )
+
+    assert normalized.key_document == {
+        "nested": {"deeper": {"kept": 3}},
+        "reviews": [{"timestamp": "<string>", "text": "a"}, {"timestamp": "<string>"}],
+    }
+    assert normalized.applied_rules == {0, 1}
+
+
+def test_the_first_matching_rule_applies_to_the_field_as_a_whole():
+    normalized = normalizer(
+        KeyRule("metadata", ["metadata"], "placeholder"),
+        KeyRule("ids", ["**.request_id"], "drop"),
+    ).normalize({"metadata": {"request_id": 1}})
+
+    # The second rule does not apply within the field matched by the first.
+    assert normalized.document == {"metadata": {"request_id": 1}}
+    assert normalized.key_document == {"metadata": "<object>"}
+    assert normalized.applied_rules == {0}
+
+
+def test_documents_without_matches_are_not_copied():
+    document = {"a": {"b": [1, 2]}}
+    normalized = normalizer(KeyRule("ids", ["**.request_id"], "drop")).normalize(
+        document
+    )
+
+    assert normalized.document is document
+    assert normalized.key_document is document
+    assert normalized.applied_rules == frozenset()
+
+
+def test_deeply_nested_documents_are_normalized_without_recursion():
+    depth = 2 * sys.getrecursionlimit()
+    document = {"request_id": 0, "kept": 0}
+    for level in range(1, depth):
+        document = {"request_id": level, "child": [document]}
+
+    normalized = normalizer(KeyRule("ids", ["**.request_id"], "exclude")).normalize(
+        document
+    )
+
+    key_document = normalized.key_document
+    for _ in range(1, depth):
+        assert list(key_document) == ["child"]
+        key_document = key_document["child"][0]
+    assert key_document == {"kept": 0}
+    assert normalized.document is not document
+    assert normalized.document["request_id"] == depth - 1
+    assert len(normalized.matched_fields[0]) == depth
+
+
+def test_unknown_actions_and_empty_paths_are_rejected():
+    with pytest.raises(ValueError):
+        KeyRule("bad", ["a"], "hash")
+    with pytest.raises(ValueError):
+        KeyRule("bad", [""], "drop")
+
+
+def test_record_counts_hits_rescued_by_a_rule():
+    key_normalizer = normalizer(KeyRule("ids", ["request_id"], "exclude"))
+
+    def request(request_id: str, hit: bool) -> None:
+        normalized = key_normalizer.normalize(
+            {"request_id": request_id, "message": "hello"}
+        )
+        key_normalizer.record(
+            normalized, canonical_digest(normalized.key_document), hit
+        )
+
+    request("1", hit=False)
+    # A hit only thanks to the rule, the request id differs.
+    request("2", hit=True)
+    # A hit that also would have been one without the rule.
+    request("2", hit=True)
+
+    assert key_normalizer.stats() == {
+        "ids": {"applied": 3, "hits": 2, "rescued_hits": 1}
+    }
+
+
+def test_record_ignores_rules_that_did_not_apply():
+    key_normalizer = normalizer(
+        KeyRule("ids", ["request_id"], "exclude"),
+        KeyRule("time", ["timestamp"], "placeholder"),
+    )
+    normalized = key_normalizer.normalize({"request_id": "1"})
+    key_normalizer.record(normalized, canonical_digest(normalized.key_document), True)
+
+    stats = key_normalizer.stats()
+    assert stats["ids"]["applied"] == 1
+    assert stats["time"] == {"applied": 0, "hits": 0, "rescued_hits": 0}
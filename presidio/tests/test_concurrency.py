@@ -0,0 +1,133 @@
+"""Tests of the adaptive concurrency limit."""
+
+import threading
+import time
+from typing import Optional
+
+from server.concurrency import AdaptiveConcurrencyLimiter
+
+
+class Acquirer(threading.Thread):
+    """Acquires a slot in a thread of its own."""
+
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter, purpose: str = ""):
+        super().__init__(daemon=True)
+        self.limiter = limiter
+        self.purpose = purpose
+        self.start_time: Optional[float] = None
+        self.start()
+
+    def run(self) -> None:
+        self.start_time = self.limiter.acquire(self.purpose)
+
+
+def wait_for_queue(limiter: AdaptiveConcurrencyLimiter, depth: int) -> None:
+    deadline = time.monotonic() + 5
+    while limiter.stats()["queue_depth"] != depth:
+        assert time.monotonic() < deadline, "The request was not queued"
+        time.sleep(0.001)
+
+
+def test_requests_within_the_limit_are_accepted():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+
+    assert limiter.acquire() is not None
+    assert limiter.acquire() is not None
+
+    stats = limiter.stats()
+    assert (stats["in_flight"], stats["accepted"], stats["shed"]) == (2, 2, 0)
+
+
+def test_waiting_requests_are_shed_after_the_queue_time():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_queue_seconds=0.05)
+    limiter.acquire()
+
+    start = time.monotonic()
+    assert limiter.acquire() is None
+
+    assert time.monotonic() - start >= 0.05
+    stats = limiter.stats()
+    assert (stats["queued"], stats["shed"], stats["queue_depth"]) == (1, 1, 0)
+
+
+def test_requests_beyond_a_full_queue_are_shed_right_away():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_queue_seconds=5)
+    start = limiter.acquire()
+    waiting = Acquirer(limiter)
+    wait_for_queue(limiter, 1)
+
+    shed_start = time.monotonic()
+    assert limiter.acquire() is None
+    assert time.monotonic() - shed_start < 1
+
+    # The queued request gets the slot once it is free.
+    limiter.release(start)
+    waiting.join(5)
+    assert waiting.start_time is not None
+    assert limiter.stats()["shed"] == 1
+
+
+def test_a_service_below_its_share_is_queued_while_others_are_shed():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_queue_seconds=5)
+    starts = [limiter.acquire("bulk"), limiter.acquire("bulk")]
+    bulk = []
+    for depth in (1, 2):
+        bulk.append(Acquirer(limiter, "bulk"))
+        wait_for_queue(limiter, depth)
+
+    assert limiter.acquire("bulk") is None
+    checkout = Acquirer(limiter, "checkout")
+    wait_for_queue(limiter, 3)
+
+    # The first queued requests of both services are served before the
+    # second one of the service that queued more.
+    for start in starts:
+        limiter.release(start, "bulk")
+    checkout.join(5)
+    bulk[0].join(5)
+    assert checkout.start_time is not None
+    assert bulk[0].start_time is not None
+    assert bulk[1].is_alive()
+
+    purposes = limiter.stats()["purposes"]
+    assert purposes["bulk"]["shed"] == 1
+    assert purposes["checkout"]["shed"] == 0
+
+    limiter.release(checkout.start_time, "checkout")
+    bulk[1].join(5)
+    assert bulk[1].start_time is not None
+
+
+def test_concurrency_of_a_service_is_capped():
+    limiter = AdaptiveConcurrencyLimiter(
+        initial_limit=4, max_queue_seconds=0.05, max_concurrency={"reports": 1}
+    )
+
+    assert limiter.acquire("reports") is not None
+    assert limiter.acquire("reports") is None
+    assert limiter.acquire("checkout") is not None
+
+
+def test_rising_latency_shrinks_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, min_limit=2)
+    for _ in range(20):
+        limiter.release(limiter.acquire() - 0.01)
+    baseline = limiter.stats()["limit"]
+
+    starts = [limiter.acquire() for _ in range(baseline)]
+    for start in starts:
+        limiter.release(start - 1.0)
+
+    assert limiter.stats()["limit"] < baseline
+    assert limiter.stats()["limit"] >= 2
+    assert limiter.retry_after() >= 1
+
+
+def test_steady_latency_at_the_limit_grows_it():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=16)
+    for _ in range(10):
+        starts = [limiter.acquire() for _ in range(limiter.stats()["limit"])]
+        for start in starts:
+            limiter.release(start - 0.01)
+
+    assert 4 < limiter.stats()["limit"] <= 16
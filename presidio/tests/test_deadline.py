@@ -0,0 +1,131 @@
+"""Tests of request deadlines and of stopping the analysis at them."""
+
+import time
+from typing import List
+
+from presidio_analyzer import RecognizerResult
+
+from server.batch_analyzer import CachingBatchAnalyzerEngine
+from server.deadline import Deadline, DeadlinePolicy
+
+
+class FakeNlpEngine:
+    """NLP engine returning no artifacts."""
+
+    def process_batch(self, texts, language):
+        return [(text, None) for text in texts]
+
+
+class FakeAnalyzerEngine:
+    """Analyzer finding a person in every value, counting the values."""
+
+    def __init__(self):
+        self.nlp_engine = FakeNlpEngine()
+        self.texts: List[str] = []
+
+    def analyze(self, text, language, **kwargs) -> List[RecognizerResult]:
+        self.texts.append(text)
+        return [RecognizerResult("PERSON", 0, len(text), 1.0)]
+
+
+def test_deadline_expires():
+    deadline = Deadline(0.01)
+
+    assert not deadline.expired()
+    time.sleep(0.02)
+    assert deadline.expired()
+    assert deadline.exceeded and not deadline.disconnected
+
+
+def test_no_deadline_never_expires():
+    deadline = Deadline(None)
+
+    assert not deadline.expired()
+    assert deadline.expires_at is None
+
+
+def test_disconnected_client_exceeds_the_deadline():
+    connected = [True]
+    deadline = Deadline(None, client_disconnected=lambda: not connected[0])
+
+    assert not deadline.expired()
+    connected[0] = False
+    assert deadline.expired()
+    assert deadline.exceeded and deadline.disconnected
+
+
+def test_earlier_of_header_and_budget_wins():
+    policy = DeadlinePolicy(budget_seconds=1.0)
+
+    start = time.monotonic()
+    header_deadline = policy.start("100")
+    budget_deadline = policy.start("5000")
+
+    assert header_deadline.expires_at - start < 0.2
+    assert 0.9 < budget_deadline.expires_at - start < 1.1
+    assert policy.stats()["deadlines"] == 2
+
+
+def test_malformed_header_keeps_the_budget():
+    policy = DeadlinePolicy(budget_seconds=1.0)
+
+    start = time.monotonic()
+    deadline = policy.start("soon")
+
+    assert 0.9 < deadline.expires_at - start < 1.1
+
+
+def test_negative_header_expires_at_once():
+    deadline = DeadlinePolicy().start("-5")
+
+    assert deadline.expired()
+
+
+def test_requests_without_deadline_are_not_counted():
+    policy = DeadlinePolicy()
+
+    deadline = policy.start(None)
+
+    assert deadline.expires_at is None
+    assert policy.stats()["deadlines"] == 0
+
+
+def test_record_tells_partial_from_abandoned():
+    policy = DeadlinePolicy()
+    met = Deadline(None)
+    expired = Deadline(0)
+    disconnected = Deadline(None, client_disconnected=lambda: True)
+    for deadline in (met, expired, disconnected):
+        deadline.expired()
+        policy.record(deadline)
+
+    assert policy.stats() == {"deadlines": 0, "partial": 1, "abandoned": 1}
+
+
+def test_analysis_stops_at_the_deadline():
+    analyzer_engine = FakeAnalyzerEngine()
+    engine = CachingBatchAnalyzerEngine(analyzer_engine=analyzer_engine, batch_size=2)
+    deadline = Deadline(None)
+    document = {"name": "Alice", "other": "Bob", "third": "Carol", "last": "Dave"}
+
+    results = []
+    for result in engine.analyze_dict(document, "en", deadline=deadline):
+        results.append(result.key)
+        if len(results) == 1:
+            deadline.expires_at = time.monotonic()
+
+    assert results == ["name"]
+    assert analyzer_engine.texts == ["Alice"]
+    assert deadline.exceeded and not deadline.disconnected
+
+
+def test_analysis_stops_when_the_client_disconnects():
+    analyzer_engine = FakeAnalyzerEngine()
+    engine = CachingBatchAnalyzerEngine(analyzer_engine=analyzer_engine)
+    deadline = Deadline(None, client_disconnected=lambda: True)
+
+    results = list(engine.analyze_dict({"name": "Alice"}, "en", deadline=deadline))
+
+    assert results == []
+    assert analyzer_engine.texts == []
+    assert deadline.disconnected
@@ -0,0 +1,101 @@
+"""Tests of the traversal and digests of parsed JSON."""
+
+import sys
+
+from server.helpers import digest_subtrees, iter_json
+
+DOCUMENT = {
+    "b": {"name": "Alice", "tags": ["x", {"deep": "y"}]},
+    "a": 1,
+    "empty": [],
+}
+
+
+def test_leaves_are_iterated_in_document_order():
+    # Empty containers have no leaves.
+    assert list(iter_json(DOCUMENT)) == [
+        (("b", "name"), "Alice"),
+        (("b", "tags", "0"), "x"),
+        (("b", "tags", "1", "deep"), "y"),
+        (("a",), 1),
+    ]
+
+
+def test_list_items_are_keyed_by_their_index():
+    assert list(iter_json(["x", ["y", "z"]])) == [
+        (("0",), "x"),
+        (("1", "0"), "y"),
+        (("1", "1"), "z"),
+    ]
+
+
+def test_scalar_documents_are_a_single_leaf():
+    assert list(iter_json("Alice")) == [((), "Alice")]
+
+
+def test_descend_prunes_containers_it_rejects():
+    visited = []
+
+    def descend(path, value):
+        visited.append(path)
+        return path != ("b", "tags")
+
+    assert list(iter_json(DOCUMENT, descend=descend)) == [
+        (("b", "name"), "Alice"),
+        (("b", "tags"), ["x", {"deep": "y"}]),
+        (("a",), 1),
+    ]
+    # The rejected list is yielded as a whole and not visited further.
+    assert visited == [("b",), ("b", "tags"), ("empty",)]
+
+
+def test_deeply_nested_documents_are_iterated_without_recursion():
+    depth = 2 * sys.getrecursionlimit()
+    document = "leaf"
+    for _ in range(depth):
+        document = {"a": [document]}
+
+    ((path, value),) = iter_json(document)
+
+    assert path == ("a", "0") * depth
+    assert value == "leaf"
+    digests = {}
+    digest_subtrees(document, digests)
+    assert len(digests) == 2 * depth
+
+
+def test_digests_do_not_depend_on_the_order_of_keys():
+    reordered = {
+        "empty": [],
+        "a": 1,
+        "b": {"tags": ["x", {"deep": "y"}], "name": "Alice"},
+    }
+    digests, reordered_digests = {}, {}
+
+    assert digest_subtrees(DOCUMENT, digests) == digest_subtrees(
+        reordered, reordered_digests
+    )
+    assert digests[id(DOCUMENT["b"])] == reordered_digests[id(reordered["b"])]
+
+
+def test_digests_tell_values_lists_and_types_apart():
+    def digest(data):
+        return digest_subtrees(data, {})
+
+    assert digest({"a": ["x", "y"]}) != digest({"a": ["y", "x"]})
+    assert digest({"a": 1}) != digest({"a": "1"})
+    assert digest({"a": "x"}) != digest({"b": "x"})
+    assert digest({"a": {"b": 1}}) != digest({"a": {"b": 2}})
+
+
+def test_every_container_is_digested_by_its_id():
+    digests = {}
+    digest_subtrees(DOCUMENT, digests)
+
+    assert set(digests) == {
+        id(DOCUMENT),
+        id(DOCUMENT["b"]),
+        id(DOCUMENT["b"]["tags"]),
+        id(DOCUMENT["b"]["tags"][1]),
+        id(DOCUMENT["empty"]),
+    }
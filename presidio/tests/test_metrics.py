@@ -0,0 +1,75 @@
+"""Tests of the metrics shared by the worker processes."""
+
+import threading
+
+from server.metrics import Metrics
+
+
+def render(metrics: Metrics) -> dict:
+    lines = metrics.render().decode().splitlines()
+    return dict(
+        line.rsplit(" ", 1) for line in lines if line and not line.startswith("#")
+    )
+
+
+def test_concurrent_increments_are_not_lost():
+    metrics = Metrics()
+    counter = metrics.counter("requests_total", "Requests")
+    histogram = metrics.histogram("latency_seconds", "Latency", buckets=(1.0,))
+
+    def work():
+        for _ in range(10000):
+            counter.inc()
+            histogram.observe(0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    values = render(metrics)
+    assert float(values["requests_total"]) == 80000
+    assert float(values["latency_seconds_count"]) == 80000
+    assert float(values['latency_seconds_bucket{le="1.0"}']) == 80000
+
+
+def test_values_are_summed_over_workers():
+    metrics = Metrics(workers=2)
+    counter = metrics.counter("requests_total", "Requests")
+
+    metrics.select_worker(0)
+    counter.inc(2)
+    metrics.select_worker(1)
+    counter.inc(3)
+
+    assert float(render(metrics)["requests_total"]) == 5
+
+
+def test_retired_worker_keeps_counters_and_clears_gauges():
+    metrics = Metrics(workers=2)
+    counter = metrics.counter("requests_total", "Requests")
+    cache_hits = metrics.counter("cache_hits_total", "Hits")
+    in_flight = metrics.gauge("requests_in_flight", "In flight")
+    histogram = metrics.histogram("latency_seconds", "Latency", buckets=(1.0,))
+
+    metrics.select_worker(1)
+    counter.inc(4)
+    cache_hits.set(7)
+    in_flight.inc(3)
+    histogram.observe(2.0)
+
+    metrics.retire_worker(1)
+    values = render(metrics)
+    assert float(values["requests_total"]) == 4
+    assert float(values["cache_hits_total"]) == 7
+    assert float(values["requests_in_flight"]) == 0
+    assert float(values['latency_seconds_bucket{le="+Inf"}']) == 1
+    assert float(values["latency_seconds_sum"]) == 2.0
+
+    # The successor starts from zero, its counters add to those retired.
+    counter.inc()
+    cache_hits.set(1)
+    values = render(metrics)
+    assert float(values["requests_total"]) == 5
+    assert float(values["cache_hits_total"]) == 8
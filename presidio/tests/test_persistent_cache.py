@@ -0,0 +1,93 @@
+"""Tests of the persistent cache tier."""
+
+import sqlite3
+import time
+from types import SimpleNamespace
+
+from server.cache import ResultCache
+from server.cache_key import KeyNormalizer
+from server.persistent_cache import PersistentCache, TieredCache
+from server.server import analysis_fingerprint, create_cache
+
+
+def wait_for_writes(cache: PersistentCache, writes: int) -> None:
+    deadline = time.monotonic() + 5
+    while cache.stats()["writes"] < writes:
+        assert time.monotonic() < deadline, "The writes were not committed"
+        time.sleep(0.01)
+
+
+def tables(path: str) -> set:
+    with sqlite3.connect(path) as connection:
+        return {
+            name
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+
+
+def test_promotion_keeps_the_expiry_of_the_stored_entry(tmp_path):
+    path = str(tmp_path / "cache.db")
+    persistent = PersistentCache(path, "responses", 1 << 20, fingerprint="abc")
+    persistent.set(b"key", b"value", ttl_seconds=0.5)
+    wait_for_writes(persistent, 1)
+
+    # The memory tier would keep the entry for an hour by itself.
+    cache = TieredCache(ResultCache(1 << 20, ttl_seconds=3600), persistent)
+    assert cache.get(b"key") == b"value"
+    time.sleep(0.6)
+
+    assert cache.get(b"key") is None
+
+
+def test_warming_keeps_the_expiry_of_the_stored_entries(tmp_path):
+    path = str(tmp_path / "cache.db")
+    persistent = PersistentCache(path, "responses", 1 << 20)
+    persistent.set(b"short", b"value", ttl_seconds=0.5)
+    persistent.set(b"long", b"value", ttl_seconds=3600)
+    wait_for_writes(persistent, 2)
+
+    cache = TieredCache(ResultCache(1 << 20), persistent)
+    assert cache.warm() == 2
+    time.sleep(0.6)
+
+    assert cache.memory.get(b"short") is None
+    assert cache.memory.get(b"long") == b"value"
+
+
+def test_entries_of_other_fingerprints_are_dropped(tmp_path):
+    path = str(tmp_path / "cache.db")
+    old = PersistentCache(path, "responses", 1 << 20, fingerprint="old")
+    old.set(b"key", b"stale", ttl_seconds=None)
+    wait_for_writes(old, 1)
+    PersistentCache(path, "subtrees", 1 << 20, fingerprint="old")
+
+    new = PersistentCache(path, "responses", 1 << 20, fingerprint="new")
+
+    assert new.get(b"key") is None
+    # Only the tables of the same cache are dropped.
+    assert tables(path) == {"responses_new", "subtrees_old"}
+
+
+def test_changing_the_entities_changes_the_table(tmp_path):
+    # Stands in for an analyzer engine, only what the fingerprint reads.
+    engine = SimpleNamespace(
+        nlp_engine=None,
+        registry=SimpleNamespace(recognizers=[]),
+        default_score_threshold=0,
+    )
+    key_normalizer = KeyNormalizer([])
+    settings = {
+        "enable_cache": True,
+        "persistent_cache_path": str(tmp_path / "cache.db"),
+    }
+
+    def table(entities) -> str:
+        fingerprint = analysis_fingerprint(engine, key_normalizer, entities, settings)
+        return create_cache(
+            settings, "responses", 1 << 20, fingerprint=fingerprint
+        ).persistent.table
+
+    assert table(["PERSON", "LOCATION"]) == table(["LOCATION", "PERSON"])
+    assert table(["PERSON", "LOCATION"]) != table(["LOCATION"])
@@ -0,0 +1,142 @@
+"""Tests of the routing of leaf values before their analysis."""
+
+import threading
+
+import pytest
+import spacy
+from presidio_analyzer import AnalyzerEngine
+from presidio_analyzer.nlp_engine import SpacyNlpEngine
+
+from server.batch_analyzer import CachingBatchAnalyzerEngine
+from server.helpers import extract_data_types_from_results
+from server.prefilter import (
+    DIGIT_ENTITIES,
+    FULL,
+    NO_DIGIT_RECOGNIZERS,
+    NO_NER,
+    NO_NER_NO_DIGIT_RECOGNIZERS,
+    SKIP,
+    LexicalPrefilter,
+    TypeFilter,
+)
+
+
+@pytest.fixture(scope="module")
+def analyzer_engine() -> AnalyzerEngine:
+    # The predefined recognizers with a blank pipeline: the pattern based
+    # recognizers work as usual, the NER model finds nothing.
+    nlp_engine = SpacyNlpEngine(models=[{"lang_code": "en", "model_name": "blank"}])
+    nlp_engine.nlp = {"en": spacy.blank("en")}
+    return AnalyzerEngine(nlp_engine=nlp_engine, supported_languages=["en"])
+
+
+def entity_types(analyzer_engine: AnalyzerEngine, document, **kwargs) -> set:
+    engine = CachingBatchAnalyzerEngine(analyzer_engine=analyzer_engine, **kwargs)
+    return extract_data_types_from_results(engine.analyze_dict(document, "en"))
+
+
+@pytest.mark.parametrize(
+    "text, route",
+    [
+        ("4111111111111111", NO_NER),
+        ("212-555-1234", NO_NER),
+        ("2024-01-15", NO_NER),
+        ("Call 212-555-1234", FULL),
+        ("Alice Smith", NO_DIGIT_RECOGNIZERS),
+        ("Bob", NO_NER_NO_DIGIT_RECOGNIZERS),
+        ("A1", NO_NER),
+        ("--- / ---", SKIP),
+        ("", SKIP),
+    ],
+)
+def test_values_are_routed_by_their_characters_and_length(text, route):
+    assert LexicalPrefilter().route(text) == route
+
+
+def test_only_digit_recognizers_are_excluded_from_values_without_digits():
+    assert NO_DIGIT_RECOGNIZERS.excluded_entities == DIGIT_ENTITIES
+    assert not NO_NER.excluded_entities
+    assert not SKIP.analyze
+
+
+def test_prefilter_keeps_the_detected_entities(analyzer_engine):
+    document = {
+        "card": "4111111111111111",
+        "phone": "212-555-1234",
+        "date": "2024-01-15",
+        "email": "alice@example.com",
+        "note": "Call 212-555-1234 on 2024-01-15",
+        "code": "A1",
+        "separator": "---",
+    }
+
+    found = entity_types(analyzer_engine, document, prefilter=LexicalPrefilter())
+
+    assert {"CREDIT_CARD", "PHONE_NUMBER", "DATE_TIME", "EMAIL_ADDRESS"} <= found
+    assert found == entity_types(analyzer_engine, document)
+
+
+def test_routes_are_counted_across_threads():
+    prefilter = LexicalPrefilter()
+
+    def work():
+        for _ in range(10000):
+            prefilter.record(FULL)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert prefilter.stats()["full"] == 80000
+
+
+@pytest.mark.parametrize(
+    "value, accepted",
+    [
+        (True, False),
+        (False, False),
+        (7, False),
+        (123, False),
+        (12.5, False),
+        (1234, True),
+        (4111111111111111, True),
+        (2125551234, True),
+        (1.234, True),
+        ("7", True),
+        ("true", True),
+    ],
+)
+def test_type_filter_drops_booleans_and_short_numbers(value, accepted):
+    assert TypeFilter().accepts(value) == accepted
+
+
+def test_type_filter_counts_the_dropped_values():
+    type_filter = TypeFilter(min_number_digits=2)
+    for value in (True, 1, 12, "x"):
+        type_filter.accepts(value)
+
+    assert type_filter.stats() == {"booleans": 1, "short_numbers": 1}
+
+
+def test_filters_keep_the_detected_entities(analyzer_engine):
+    document = {
+        "card": 4111111111111111,
+        "phone": "212-555-1234",
+        "date": "2024-01-15",
+        "active": True,
+        "count": 7,
+        "price": 9.5,
+        "contact": {"email": "alice@example.com", "verified": False},
+    }
+
+    found = entity_types(
+        analyzer_engine,
+        document,
+        prefilter=LexicalPrefilter(),
+        type_filter=TypeFilter(),
+    )
+
+    assert {"CREDIT_CARD", "PHONE_NUMBER", "DATE_TIME", "EMAIL_ADDRESS"} <= found
+    assert found == entity_types(analyzer_engine, document)
@@ -0,0 +1,144 @@
+"""Tests of the batch analysis endpoints through the Flask test client."""
+
+import gzip
+import json
+from typing import List
+
+import msgpack
+import pytest
+import spacy
+from flask.testing import FlaskClient
+from presidio_analyzer import AnalyzerEngine
+from presidio_analyzer.nlp_engine import SpacyNlpEngine
+
+from server import server as server_module
+from server.body_codec import MSGPACK
+from server.server import Server
+
+
+def blank_nlp_engine() -> SpacyNlpEngine:
+    # The pattern based recognizers work as usual, the NER model finds nothing.
+    nlp_engine = SpacyNlpEngine(models=[{"lang_code": "en", "model_name": "blank"}])
+    nlp_engine.nlp = {"en": spacy.blank("en")}
+    return nlp_engine
+
+
+@pytest.fixture
+def server() -> Server:
+    nlp_engine = blank_nlp_engine()
+
+    def analyzer_engine(**kwargs) -> AnalyzerEngine:
+        kwargs.setdefault("nlp_engine", nlp_engine)
+        kwargs.setdefault("supported_languages", ["en"])
+        return AnalyzerEngine(**kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(server_module, "AnalyzerEngine", analyzer_engine)
+        return Server(
+            {
+                "enable_cache": True,
+                "concurrency_limiter": False,
+                "stream_batch_size": 2,
+            }
+        )
+
+
+@pytest.fixture
+def client(server: Server) -> FlaskClient:
+    return server.app.test_client()
+
+
+@pytest.fixture
+def analyzed(server: Server, monkeypatch) -> List[list]:
+    """Record the documents of every analysis run."""
+
+    runs = []
+    analyze_dicts = server.batch_analyzer.analyze_dicts
+
+    def record(input_dicts, *args, **kwargs):
+        runs.append(list(input_dicts))
+        return analyze_dicts(input_dicts, *args, **kwargs)
+
+    monkeypatch.setattr(server.batch_analyzer, "analyze_dicts", record)
+    return runs
+
+
+CARD = {"json_to_analyze": {"card": "4111111111111111"}}
+EMAIL = {"json_to_analyze": {"contact": {"email": "alice@example.com"}}}
+NOTHING = {"json_to_analyze": {"note": "hello"}}
+
+
+def entity_types(response) -> List[set]:
+    assert response.status_code == 200
+    return [set(entity_types) for entity_types in response.get_json()]
+
+
+def test_bulk_answers_hits_and_misses_in_order(client, analyzed):
+    card, nothing = entity_types(
+        client.post("/batchanalyze/bulk", json=[CARD, NOTHING])
+    )
+    assert "CREDIT_CARD" in card
+    assert nothing == set()
+
+    # The cached documents are answered as they are, only the copies of the
+    # new one are analyzed, and the answers keep the order of the requests.
+    email, *answers = entity_types(
+        client.post("/batchanalyze/bulk", json=[EMAIL, CARD, NOTHING, EMAIL])
+    )
+    assert "EMAIL_ADDRESS" in email
+    assert answers == [card, nothing, email]
+
+    assert analyzed == [
+        [CARD["json_to_analyze"], NOTHING["json_to_analyze"]],
+        [EMAIL["json_to_analyze"], EMAIL["json_to_analyze"]],
+    ]
+
+
+def test_bulk_answers_match_single_requests(client):
+    bulk = entity_types(client.post("/batchanalyze/bulk", json=[CARD, EMAIL, NOTHING]))
+
+    # The second requests are answered from the cache filled by the first.
+    single = [
+        set(client.post("/batchanalyze", json=request_obj).get_json())
+        for request_obj in (CARD, EMAIL, NOTHING)
+    ]
+
+    assert bulk == single
+
+
+def test_stream_ends_with_an_error_line_when_decompression_fails(client):
+    lines = b"".join(
+        json.dumps({"json_to_analyze": {"email": f"user{index}@example.com"}}).encode()
+        + b"\n"
+        for index in range(10_000)
+    )
+    # Cut after the first batches of lines.
+    body = gzip.compress(lines)[:4096]
+
+    response = client.post(
+        "/batchanalyze/stream",
+        data=body,
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+    )
+
+    assert response.status_code == 200
+    # The lines read before are answered, and the stream ends with the error.
+    *answers, error = gzip.decompress(response.get_data()).splitlines()
+    assert len(answers) > 2
+    assert all("EMAIL_ADDRESS" in json.loads(answer) for answer in answers)
+    assert json.loads(error)["error"].startswith("Invalid gzip body")
+
+
+@pytest.mark.parametrize("endpoint", ["/batchanalyze", "/batchanalyze/bulk"])
+def test_undecodable_bodies_are_bad_requests(client, endpoint):
+    binary = msgpack.packb({"json_to_analyze": {"photo": b"\x89PNG"}})
+    truncated = gzip.compress(json.dumps(CARD).encode())[:-8]
+
+    for body, headers in (
+        (binary, {"Content-Type": MSGPACK}),
+        (truncated, {"Content-Type": "application/json", "Content-Encoding": "gzip"}),
+    ):
+        response = client.post(endpoint, data=body, headers=headers)
+
+        assert response.status_code == 400
+        assert "error" in response.get_json()